@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Check and benchmark of the ERA5-Land download manager (crspy.era5_land.era5_download)
+with a local fake CDS client, so no account or network is needed.
+
+The fake client takes a fixed time per request (the CDS spends most of its time queueing
+and preparing a request), fails a fraction of requests and writes a synthetic month of
+ERA5-Land data. The script checks that:
+    - running requests at once scales with the number of workers
+    - failed requests are retried until every month is complete
+    - a second run skips every month
+    - a truncated month is found and downloaded again
+
+Run with crspy installed (e.g. pip install -e .):
+    python benchmarks/bench_era5_download.py
+"""
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from crspy.era5_land import era5_jobs, era5_download, era5_file_complete
+
+nld = {'config': {'defaultdir': ''}}
+VARIABLES = {'t2m': 285.0, 'sp': 98000.0, 'tp': 0.0001, 'swvl1': 0.3, 'swvl2': 0.3, 'swvl3': 0.3,
+             'swvl4': 0.3, 'd2m': 280.0, 'sd': 0.0}
+
+
+def synthetic_month(filepath, year, month, area, res=0.1, seed=0):
+    """
+    Write a month of hourly ERA5-Land like data on a regular grid covering area [N, W, S, E]
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(year=year, month=month, day=1)
+    time_ = pd.date_range(start, periods=start.days_in_month*24, freq="h")
+    lat = np.round(np.arange(area[0], area[2] - res/2, -res), 2)
+    lon = np.round(np.arange(area[1], area[3] + res/2, res), 2)
+    shape = (len(time_), len(lat), len(lon))
+    ds = xr.Dataset({name: (('time', 'latitude', 'longitude'),
+                            (value*(1 + 0.01*rng.standard_normal(shape))).astype(np.float32))
+                     for name, value in VARIABLES.items()},
+                    coords={'time': time_, 'latitude': lat, 'longitude': lon})
+    ds.to_netcdf(filepath)
+
+
+class FakeClient:
+    """
+    Stands in for cdsapi.Client, retrieve() writes a synthetic file after a delay
+    """
+
+    def __init__(self, delay=0.5, failrate=0.2, seed=0):
+        self.delay = delay
+        self.failrate = failrate
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def retrieve(self, name, request, target):
+        with self.lock:
+            self.requests += 1
+            fail = self.rng.random() < self.failrate
+        time.sleep(self.delay)
+        if fail:
+            raise ConnectionError("fake CDS error")
+        synthetic_month(target, int(request['year']), int(request['month']), request['area'])
+
+
+def run(jobs, ledger, workers, client):
+    start = time.perf_counter()
+    entries = era5_download(jobs, client=client, workers=workers, retries=5, backoff=0, ledger=ledger, nld=nld)
+    return time.perf_counter() - start, entries
+
+
+if __name__ == "__main__":
+    area = [52, -3, 51, -2]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for workers in [1, 4]:
+            store = os.path.join(tmpdir, "w"+str(workers))+"/"
+            os.makedirs(store)
+            jobs = era5_jobs(area, [2015], range(1, 13), list(VARIABLES), "TEST", saveloc=store, nld=nld)
+            client = FakeClient()
+            elapsed, entries = run(jobs, store+"ledger.json", workers, client)
+            assert all(e['status'] == 'complete' for e in entries.values())
+            print(str(workers)+" worker(s): "+str(len(jobs))+" months in "+str(round(elapsed, 2))+" s (" +
+                  str(client.requests)+" requests with retries)")
+
+        # Restarting skips complete months
+        client = FakeClient()
+        elapsed, entries = run(jobs, store+"ledger.json", 4, client)
+        assert client.requests == 0
+        print("Second run: "+str(client.requests)+" requests in "+str(round(elapsed, 2))+" s")
+
+        # A truncated month is downloaded again
+        with open(jobs[5]['target'], 'r+b') as f:
+            f.truncate(500)
+        assert not era5_file_complete(jobs[5]['target'], 2015, 6)
+        client = FakeClient(failrate=0)
+        run(jobs, store+"ledger.json", 4, client)
+        assert client.requests == 1 and era5_file_complete(jobs[5]['target'], 2015, 6)
+        print("Truncated month found and downloaded again")
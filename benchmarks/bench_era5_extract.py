@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Check and benchmark of extracting sites from monthly ERA5-Land files in parallel
+(era5landnetcdf(..., workers=n)) on synthetic monthly grids.
+
+The script checks that the site store made with a process pool is the same as the one
+made one file at a time, and gives the time taken for each number of workers. Each file
+is read and extracted independently so the time should fall with the number of cores
+(up to the speed of the disk).
+
+Run with crspy installed (e.g. pip install -e .) from the benchmarks folder:
+    python bench_era5_extract.py
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from crspy.era5_land import era5landnetcdf, era5_site
+from bench_era5_download import synthetic_month
+
+YEAR = 2015
+MONTHS = range(1, 13)
+AREA = [53, -4, 50, -1]
+NSITES = 40
+WORKERS = [None, 2, 4]
+
+
+def site_metadata(filepath, nsites, area, seed=0):
+    """
+    Write a metadata.csv with sites spread over area [N, W, S, E]
+    """
+    rng = np.random.default_rng(seed)
+    pd.DataFrame({'COUNTRY': "XXX", 'SITENUM': np.arange(1, nsites+1),
+                  'LATITUDE': rng.uniform(area[2], area[0], nsites).round(3),
+                  'LONGITUDE': rng.uniform(area[1], area[3], nsites).round(3)}).to_csv(filepath, index=False)
+
+
+if __name__ == "__main__":
+    print("CPU cores: "+str(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(tmpdir+"/data/era5land/store")
+        site_metadata(tmpdir+"/data/metadata.csv", NSITES, AREA)
+        for month in MONTHS:
+            synthetic_month(tmpdir+"/data/era5land/store/TEST_"+str(YEAR)+"_month"+str(month)+".nc",
+                            YEAR, month, AREA, seed=month)
+        nld = {'config': {'defaultdir': tmpdir}}
+
+        times = {}
+        for workers in WORKERS:
+            savename = "TEST_w"+str(workers)
+            start = time.perf_counter()
+            era5landnetcdf([YEAR], MONTHS, 0.1, "TEST", savename, workers=workers, nld=nld)
+            times[workers] = time.perf_counter() - start
+
+        # Every store has the same data in the same order
+        base = tmpdir+"/data/era5land/TEST_wNone.nc"
+        for workers in WORKERS[1:]:
+            with xr.open_dataset(base) as a, xr.open_dataset(tmpdir+"/data/era5land/TEST_w"+str(workers)+".nc") as b:
+                xr.testing.assert_identical(a.load(), b.load())
+        site = era5_site(base, "XXX_SITE_001")
+        assert site.sizes['time'] == pd.Timestamp(YEAR, 12, 31).dayofyear*24
+        assert (np.diff(site['time'].values) == np.timedelta64(1, 'h')).all()
+
+        print(str(len(MONTHS))+" months, "+str(NSITES)+" sites")
+        for workers in WORKERS:
+            print(("1 at a time" if workers is None else str(workers)+" workers").ljust(12) +
+                  str(round(times[workers], 2)).rjust(7)+" s   speed up: " +
+                  str(round(times[None]/times[workers], 2))+"x")
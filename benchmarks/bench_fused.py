@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Check and benchmark of the fused kernel (crspy.fused) against the reference calculation
+used by neutcoeffs and thetaprocess (neutron_correction_funcs, theta.sm_calc and
+theta.d86_avg), on a synthetic hourly record with missing data.
+
+The script exits with an error if the fused values differ from the reference, for the
+numpy kernel and (when numba is installed) the compiled loop, with both theta methods.
+check_fused.py compares fused_process with the neutcoeffs and thetaprocess functions
+themselves.
+
+Run with crspy installed (e.g. pip install -e .):
+    python benchmarks/bench_fused.py
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from crspy.neutron_correction_funcs import pv, humfact, pressfact_B, finten, RcCorr, agb
+from crspy.theta import sm_calc, d86_avg
+from crspy.fused import fused_theta, FUSEDCOLS, njit
+
+nld = {'config': {'pv0': '0', 'a0': '0.0808', 'a1': '0.372', 'a2': '0.115', 'jung_ref': '159'}}
+SITE = dict(beta=0.0076, refpres=1000.0, gv=3.2, agbval=2.0, N0=2000, bd=1.3, lw=0.03, soc=0.01, sm_max=0.5)
+
+
+def site_record(years=10, missing=0.02, seed=1):
+    """
+    Synthetic hourly MOD, PRESS, VP, TEMP and NMDB_COUNT with missing values
+    """
+    rng = np.random.default_rng(seed)
+    n = years*8760
+    rec = dict(mod=rng.poisson(1500, n).astype(float),
+               press=rng.normal(1000, 8, n),
+               temp=rng.normal(12, 8, n),
+               count=rng.normal(160, 3, n))
+    rec['vp'] = 100*6.112*np.exp((17.67*rec['temp'])/(243.5+rec['temp']))*rng.uniform(0.3, 1, n)
+    for key in rec:
+        rec[key][rng.random(n) < missing] = np.nan
+    return rec
+
+
+def reference(rec, theta_method):
+    """
+    Corrections as in neutcoeffs then SM and D86avg as in thetaprocess, as dataframe columns
+    """
+    df = pd.DataFrame({'MOD': rec['mod'], 'PRESS': rec['press'], 'VP': rec['vp'], 'TEMP': rec['temp'],
+                       'NMDB_COUNT': rec['count']})
+    df['pv'] = df.apply(lambda row: pv(row['VP'], row['TEMP']), axis=1)
+    df['pv'] = df['pv']*1000
+    df["fawv"] = df.apply(lambda row: humfact(row['pv'], float(nld['config']['pv0'])), axis=1)
+    df['fbar'] = df.apply(lambda row: pressfact_B(float(row['PRESS']), SITE['beta'], SITE['refpres']), axis=1)
+    df['finten_noGV'] = df.apply(lambda row: finten(int(nld['config']['jung_ref']), row['NMDB_COUNT']), axis=1)
+    df['finten'] = (df['finten_noGV'] - 1) * RcCorr(SITE['gv']) + 1
+    df['fagb'] = df.apply(lambda row: agb(SITE['agbval']), axis=1)
+    df['MOD_CORR'] = df['MOD'] * df['fbar'] * df['finten'] * df['fawv'] * df['fagb']
+    df['MOD_CORR'] = df['MOD_CORR'].apply(np.floor)
+    df['MOD_ERR'] = (np.sqrt(df['MOD'])/df['MOD']) * df['MOD_CORR']
+    df['MOD_ERR'] = df['MOD_ERR'].apply(np.floor)
+    df.loc[df['finten'].isnull(), :] = np.nan
+    df = df.assign(**sm_calc(df['MOD_CORR'], df['MOD_ERR'], SITE['N0'], SITE['bd'], SITE['lw'], SITE['soc'],
+                             SITE['sm_max'], theta_method=theta_method, nld=nld))
+    df['D86avg'] = d86_avg(df['PRESS'], df['SM'], SITE['bd'])
+    return df
+
+
+def fused(rec, theta_method, usenumba):
+    return fused_theta(rec['mod'], rec['press'], rec['vp'], rec['temp'], rec['count'], SITE['beta'],
+                       SITE['refpres'], float(nld['config']['jung_ref']), RcCorr(SITE['gv']),
+                       agb(SITE['agbval']), SITE['N0'], SITE['bd'], SITE['lw'], SITE['soc'], SITE['sm_max'],
+                       theta_method=theta_method, usenumba=usenumba, nld=nld)
+
+
+if __name__ == "__main__":
+    rec = site_record()
+    print("Record: "+str(len(rec['mod']))+" hours")
+    kernels = [("numpy", False)] + ([("numba", True)] if njit is not None else [])
+    for theta_method in ["desilets", "kohli"]:
+        start = time.perf_counter()
+        ref = reference(rec, theta_method)
+        print(theta_method.ljust(9)+"reference".ljust(10)+str(round(time.perf_counter()-start, 3)).rjust(7)+" s")
+        for name, usenumba in kernels:
+            fused(rec, theta_method, usenumba)  # compile
+            start = time.perf_counter()
+            out = fused(rec, theta_method, usenumba)
+            elapsed = time.perf_counter()-start
+            for col in FUSEDCOLS:
+                np.testing.assert_allclose(out[col], ref[col].to_numpy(), rtol=1e-9, atol=1e-9, equal_nan=True,
+                                           err_msg=theta_method+" "+name+" "+col)
+            print(theta_method.ljust(9)+name.ljust(10)+str(round(elapsed, 3)).rjust(7)+" s   matches reference")
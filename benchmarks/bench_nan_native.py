@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of keeping site data nan inside crspy rather than converting between the
+noval sentinel (-999) and nan in every processing stage.
+
+The real stages (prepare_data -> neutcoeffs -> flag_and_remove -> thetaprocess) are run on
+the same synthetic site with two copies of crspy: one from before the change and this one.
+Each copy is run in its own process. The script gives the time and the tracemalloc peak
+memory of each stage, then checks that the tables both copies write are the same.
+
+Make a copy of the code from before the change with git and pass its path:
+    git worktree add ../crspy-base 04c82e9
+    python benchmarks/bench_nan_native.py ../crspy-base
+"""
+import filecmp
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+YEARS = 4
+N0 = 2500
+STAGES = ["prepare_data", "neutcoeffs", "flag_and_remove", "thetaprocess"]
+NEW = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_site(wd, years=YEARS, seed=0):
+    """
+    Write a config.ini, metadata.csv and hourly raw file for one site (XXX_SITE_001) in wd
+    """
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(NEW, "crspy", "config.ini")) as f:
+        config = f.read().replace("/path/to/wd/here", wd)
+    with open(os.path.join(wd, "config.ini"), "w") as f:
+        f.write(config)
+    for folder in ["crns_data/raw", "crns_data/tidy", "crns_data/level1", "crns_data/final",
+                   "crns_data/dupe_check", "crns_data/theta", "figures", "qa", "nmdb"]:
+        os.makedirs(os.path.join(wd, "data", folder), exist_ok=True)
+    pd.DataFrame([dict(COUNTRY="XXX", SITENUM=1, SITE_NAME="Test", LATITUDE=51.0, LONGITUDE=-2.0, ELEV=100,
+                       GV=4.0, LW=0.02, SOC=0.01, BD=1.3, BD_ISRIC=1.35, N0=N0, AGBWEIGHT=np.nan,
+                       BETA_COEFF=0.0076, REFERENCE_PRESS=1000.0, SM_MAX=0.5)]).to_csv(wd+"/data/metadata.csv", index=False)
+    t = pd.date_range("2010-01-01 00:30", periods=years*8760, freq="H")
+    n = len(t)
+    sm = 0.25 + 0.1*np.sin(np.arange(n)/500)
+    mod = rng.poisson(N0*(0.0808/(sm/1.3 + 0.115 + 0.02 + 0.01*0.556) + 0.372)).astype(float)
+    mod[rng.random(n) < 0.02] = -999
+    raw = pd.DataFrame({"TIME": t.strftime("%Y-%m-%d %H:%M:%S"), "MOD": mod, "UNMOD": rng.poisson(300, n),
+                        "PRESS1": 1000 + rng.normal(0, 2, n), "PRESS2": 1000 + rng.normal(0, 2, n),
+                        "I_TEM": 20.0, "I_RH": 40.0, "BATT": 12.5, "E_TEM": 10 + 5*np.sin(np.arange(n)/24),
+                        "E_RH": 70.0, "RAIN": 0.1})
+    raw.loc[100:150, "PRESS2"] = -999
+    raw.to_csv(wd+"/data/crns_data/raw/XXX_SITE_001.txt", sep="\t", index=False)
+
+
+def fake_nmdb(seed=1):
+    """
+    Stand in for nmdb_get giving random hourly counts, so no download is needed
+    """
+    rng = np.random.default_rng(seed)
+
+    def nmdb_get(startdate, enddate, station="JUNG", nld=None):
+        idx = pd.date_range(startdate, pd.Timestamp(enddate) + pd.Timedelta("23H"), freq="H")
+        return dict(zip(idx, [str(159 + rng.normal(0, 2)) for _ in idx]))
+    return nmdb_get
+
+
+def run_stages(code, wd):
+    """
+    Run the stages with the crspy found in code (in this process) and return the time and
+    peak memory of each
+    """
+    os.chdir(wd)
+    sys.path.insert(0, code)
+    import matplotlib
+    matplotlib.use("Agg")
+    import crspy.tidy_data
+    from crspy import prepare_data, neutcoeffs, flag_and_remove, thetaprocess
+
+    crspy.tidy_data.nmdb_get = fake_nmdb()
+
+    stages = [
+        lambda x: prepare_data(wd+"/data/crns_data/raw/XXX_SITE_001.txt", False),
+        lambda x: neutcoeffs(x[0], x[1], x[2], False) + (x[1], x[2]),
+        lambda x: (flag_and_remove(x[0], N0, x[2], x[3]), x[1], x[2], x[3]),
+        lambda x: thetaprocess(x[0], x[1], x[2], x[3], agg24=False),
+    ]
+    results = {}
+    for trace in [False, True]:
+        out = None
+        for name, stage in zip(STAGES, stages):
+            if trace:
+                tracemalloc.start()
+                out = stage(out)
+                results[name]['peak'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                start = time.perf_counter()
+                out = stage(out)
+                results[name] = {'time': time.perf_counter() - start}
+    return results
+
+
+def compare_tables(wd_a, wd_b):
+    """
+    List the written tables that differ between two working directories
+    """
+    differ = []
+    for root, dirs, files in os.walk(wd_a+"/data/crns_data"):
+        for name in files:
+            path_a = os.path.join(root, name)
+            path_b = os.path.join(wd_b, os.path.relpath(path_a, wd_a))
+            if name.endswith(".txt") and not filecmp.cmp(path_a, path_b, shallow=False):
+                differ.append(os.path.relpath(path_a, wd_a))
+    return differ
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--stages":
+        print(json.dumps(run_stages(sys.argv[2], sys.argv[3])))
+        sys.exit()
+    codes = [("before", os.path.abspath(sys.argv[1])), ("now", NEW)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = {}
+        for label, code in codes:
+            wd = os.path.join(tmpdir, label)
+            os.makedirs(wd)
+            synthetic_site(wd)
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--stages", code, wd],
+                                 capture_output=True, text=True, check=True).stdout
+            results[label] = json.loads(out.strip().splitlines()[-1])
+
+        print(str(YEARS)+" years of hourly data")
+        print("stage".ljust(18)+"".join((label+" time (s)").rjust(17)+(label+" peak (MB)").rjust(17)
+                                         for label, code in codes))
+        for name in STAGES:
+            print(name.ljust(18)+"".join(str(round(results[label][name]['time'], 2)).rjust(17) +
+                                         str(round(results[label][name]['peak']/1e6, 1)).rjust(17)
+                                         for label, code in codes))
+        differ = compare_tables(os.path.join(tmpdir, "before"), os.path.join(tmpdir, "now"))
+        print("Written tables differ: "+", ".join(differ) if differ else "Written tables are the same")
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Check that fused_process gives the same values as the processing stages it stands in for.
+
+A synthetic site (see bench_nan_native.synthetic_site) is run through prepare_data, then
+through neutcoeffs and thetaprocess, and the same tidy data is given to fused_process. The
+MOD_CORR, MOD_ERR, SM, SM_RAW, SM_PLUS_ERR, SM_MINUS_ERR and D86avg columns must match for
+both theta methods with the numpy kernel and with the loop kernel. When numba is not
+installed the loop is run uncompiled (slowly) so its calculation is still checked.
+
+The script exits with an error if any column differs. Run from the benchmarks folder:
+    python check_fused.py
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from bench_nan_native import synthetic_site, fake_nmdb
+
+YEARS = 1
+# thetaprocess rounds soil moisture and D86avg to 3 decimal places
+ATOL = 0.0005 + 1e-9
+
+
+def check(wd):
+    # crspy reads config.ini from the working directory when it is imported
+    os.chdir(wd)
+    import matplotlib
+    matplotlib.use("Agg")
+    import crspy.fused
+    import crspy.tidy_data
+    from crspy import prepare_data, neutcoeffs, thetaprocess
+    from crspy.fused import fused_process, FUSEDCOLS
+
+    crspy.tidy_data.nmdb_get = fake_nmdb()
+    tidy, country, sitenum, meta = prepare_data(wd+"/data/crns_data/raw/XXX_SITE_001.txt", False, savefile=False)
+    lvl1, meta = neutcoeffs(tidy.copy(), country, sitenum, False, savefile=False)
+
+    if crspy.fused.njit is None:
+        # fused_theta only takes the loop when numba is there, the loop itself is plain python
+        crspy.fused.njit = True
+        loop = "loop (numba not installed, run uncompiled)"
+    else:
+        loop = "loop (numba)"
+    for theta_method in ["desilets", "kohli"]:
+        ref = thetaprocess(lvl1.copy(), meta, country, sitenum, agg24=False, yearlysmfig=False,
+                           theta_method=theta_method, inmemory=True, savefile=False)
+        for name, usenumba in [("numpy", False), (loop, True)]:
+            out = fused_process(tidy, meta, country, sitenum, theta_method=theta_method, usenumba=usenumba)
+            for col in FUSEDCOLS:
+                np.testing.assert_allclose(out[col].to_numpy(), ref[col].to_numpy(), rtol=0, atol=ATOL,
+                                           equal_nan=True, err_msg=theta_method+" "+name+" "+col)
+            print(theta_method.ljust(9)+name.ljust(45)+"matches neutcoeffs + thetaprocess")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmpdir:
+        synthetic_site(tmpdir, years=YEARS)
+        try:
+            check(tmpdir)
+        finally:
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -15,6 +15,10 @@ from .neutron_coeff_creation import *
 from .neutron_correction_funcs import *
 from .qa import *
 from .theta import *
+from .smoothing import *
+from .footprint import *
+from .fused import *
+from .sensitivity import *
 from .tidy_data import *
 from .additional_metadata import *
 from .full_process_wrapper import *
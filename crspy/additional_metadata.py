@@ -7,6 +7,7 @@ Created on Mon May 18 11:12:09 2020
 """
 
 import requests
+import re
 import xarray as xr
 import pandas as pd
 import cdsapi
@@ -17,8 +18,9 @@ from bs4 import BeautifulSoup
 import numpy as np
 import math
 # crspy funcs
-from crspy.gen_funcs import getlistoffiles
+from crspy.gen_funcs import getlistoffiles, file_lock
 from crspy.mass_atten import betacoeff
+from crspy.era5_land import era5_site
 
 
 """
@@ -333,11 +335,39 @@ def get_agb(lat, lon, tol=0.001, nld=nld):
 
 ############################## Get Jungfraujoch Data ##########################
 
+# A row of the NMDB.eu ascii output e.g. "2015-10-01 00:00:00;   159.123"
+NMDB_ROW = re.compile(r"^\s*(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\s*;\s*([^;\s]*)", flags=re.M)
 
-def nmdb_get(startdate, enddate, station="JUNG", nld=nld):
-    """nmdb_get will collect data for Junfraujoch station that is required to calculate fsol.
-    Returns a dictionary that can be used to fill in values to the main dataframe
-    of each site.
+
+def nmdb_parse(body):
+    """nmdb_parse reads the hourly counts from the ascii output of NMDB.eu in memory. The rows
+    ("2015-10-01 00:00:00;159.123") are found with one regular expression and the dates and
+    counts converted in one go. Nothing is written to file so it can be called from many threads
+    (or processes) at once.
+
+    Parameters
+    ----------
+    body : bytes or str
+        html response from NMDB.eu (or the text of its <pre> block)
+
+    Returns
+    -------
+    series
+        counts indexed by time, nan where NMDB gives no value
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    pre = BeautifulSoup(body, features="html.parser").find('pre')
+    text = pre.text if pre is not None else body
+    rows = NMDB_ROW.findall(text)
+    dates = pd.to_datetime([row[0] for row in rows], format="%Y-%m-%d %H:%M:%S")
+    counts = pd.to_numeric(pd.Series([row[1] for row in rows], dtype=object), errors='coerce')
+    return pd.Series(counts.to_numpy(dtype=float), index=pd.DatetimeIndex(dates))
+
+
+def nmdb_fetch(startdate, enddate, station="JUNG", nld=nld):
+    """nmdb_fetch downloads hourly neutron monitor counts from NMDB.eu. This is the default fetcher
+    of the NMDB archive (see nmdb_archive).
 
     Parameters
     ----------
@@ -354,46 +384,163 @@ def nmdb_get(startdate, enddate, station="JUNG", nld=nld):
 
     Returns
     -------
-    dict
-        dictionary of neutron count data from NMDB.eu
+    series
+        counts indexed by time
     """
     nld = nld['config']
     # split for use in url
     sy, sm, sd = str(startdate).split("-")
     ey, em, ed = str(enddate).split("-")
 
-    # Collect html from request and extract table and write to dict
+    # Collect html from request and parse the table in memory
     url = "http://nest.nmdb.eu/draw_graph.php?formchk=1&stations[]={station}&tabchoice=1h&dtype=corr_for_efficiency&tresolution=60&force=1&yunits=0&date_choice=bydate&start_day={sd}&start_month={sm}&start_year={sy}&start_hour=0&start_min=0&end_day={ed}&end_month={em}&end_year={ey}&end_hour=23&end_min=59&output=ascii"
     url = url.format(station=station, sd=sd, sm=sm, sy=sy, ed=ed, em=em, ey=ey)
-    response = urllib.request.urlopen(url)
-    html = response.read()
-    soup = BeautifulSoup(html, features="html.parser")
-    pre = soup.find_all('pre')
-    pre = pre[0].text
-    pre = pre[pre.find('start_date_time'):]
-    pre = pre.replace("start_date_time   1HCOR_E", "")
-    f = open(nld['defaultdir']+"/data/nmdb/tmp.txt", "w")
-    f.write(pre)
-    f.close()
-    df = open(nld['defaultdir']+"/data/nmdb/tmp.txt", "r")
-    lines = df.readlines()
-    df.close()
-    lines = lines[1:]
-    dfneut = pd.DataFrame(lines)
-    dfneut = dfneut[0].str.split(";", n=2, expand=True)
-    cols = ['DATE', 'COUNT']
-    dfneut.columns = cols
-    dates = pd.to_datetime(dfneut['DATE'])
-    count = dfneut['COUNT']
-
-    dfdict = dict(zip(dates, count))
-
-    return dfdict
-
-
-def nmdb_get_alt(startdate, enddate, nld=nld):
-    """nmdb_get_alt alternative to the above nmdb_get which will use a recorded file saved in the folder
-    This is brought in to deal with when nmdb may be down
+    with urllib.request.urlopen(url) as response:
+        return nmdb_parse(response.read())
+
+
+# Fetcher used by nmdb_archive when none is given, see nmdb_set_fetcher
+_nmdb = {'fetcher': None}
+
+
+def nmdb_set_fetcher(fetcher=None):
+    """nmdb_set_fetcher sets the function nmdb_archive (and so nmdb_get) uses to fetch missing data,
+    e.g. a local stand-in for tests or a mirror of NMDB.eu.
+
+    Parameters
+    ----------
+    fetcher : function, optional
+        takes (startdate, enddate, station) as "YYYY-mm-dd" strings and returns a series of counts
+        indexed by time, by default None which uses nmdb_fetch
+    """
+    _nmdb['fetcher'] = fetcher
+
+
+def nmdb_missing(fetched, startday, endday):
+    """nmdb_missing finds the days between startday and endday not yet in the archive.
+
+    Parameters
+    ----------
+    fetched : array
+        (n, 2) first and last day (days since 1970-01-01) of each range already fetched
+    startday : int
+        first day wanted
+    endday : int
+        last day wanted
+
+    Returns
+    -------
+    list
+        (first day, last day) of each range to fetch
+    """
+    missing = []
+    day = startday
+    for first, last in sorted((int(a), int(b)) for a, b in fetched):
+        if last < day:
+            continue
+        if first > endday:
+            break
+        if first > day:
+            missing.append((day, first - 1))
+        day = max(day, last + 1)
+    if day <= endday:
+        missing.append((day, endday))
+    return missing
+
+
+def nmdb_archive(startdate, enddate, station="JUNG", fetcher=None, offline=False, nld=nld):
+    """nmdb_archive gives hourly neutron monitor counts from the local NMDB archive, fetching
+    only the days it doesn't have yet. There is an archive for each station in data/nmdb
+    (station.npz) holding the counts as one float array on an hourly grid and the day ranges
+    already fetched, so once the dates needed are in it no connection is needed. Days that are
+    not over yet (UTC) are fetched again next time.
+
+    Parameters
+    ----------
+    startdate : datetime
+        start date of desire data in format YYYY-mm-dd
+            e.g 2015-10-01
+    enddate : datetime
+        end date of desired data in format YYY-mm-dd
+    station : str, optional
+        if using different station provide the value here (NMDB.eu shows alternatives), by default "JUNG"
+    fetcher : function, optional
+        function to fetch missing data (see nmdb_set_fetcher), by default None which uses the one set
+        with nmdb_set_fetcher or nmdb_fetch
+    offline : bool, optional
+        only use the data already in the archive, by default False
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    series
+        counts for every hour from startdate to the end of enddate (nan where NMDB has no data)
+    """
+    config = nld['config']
+    if fetcher is None:
+        fetcher = _nmdb['fetcher'] if _nmdb['fetcher'] is not None else lambda s, e, st: nmdb_fetch(s, e, st, nld=nld)
+    filepath = config['defaultdir']+"/data/nmdb/"+str(station)+".npz"
+    oneday = np.timedelta64(1, 'D')
+    startday = pd.Timestamp(str(startdate)).to_datetime64().astype('datetime64[D]')
+    endday = pd.Timestamp(str(enddate)).to_datetime64().astype('datetime64[D]')
+
+    def read():
+        if not os.path.exists(filepath):
+            return np.datetime64('1970-01-01T00', 'h'), np.empty(0), np.empty((0, 2), dtype=np.int64)
+        with np.load(filepath) as archive:
+            return (archive['start'].astype('datetime64[h]'), archive['count'],
+                    archive['fetched'].reshape(-1, 2))
+
+    start, count, fetched = read()
+    missing = nmdb_missing(fetched, int(startday.astype(np.int64)), int(endday.astype(np.int64)))
+    if missing and not offline:
+        # Fetched without holding the lock as downloads can take longer than the lock timeout
+        today = np.datetime64(pd.Timestamp.now(tz='UTC').tz_localize(None).to_datetime64(), 'D')
+        new = []
+        for first, last in missing:
+            first, last = np.datetime64(first, 'D'), np.datetime64(last, 'D')
+            print("Fetching NMDB data for "+str(station)+" from "+str(first)+" to "+str(last))
+            counts = fetcher(str(first), str(last), str(station))
+            hours = pd.DatetimeIndex(counts.index).to_numpy().astype('datetime64[h]')
+            keep = (hours >= first) & (hours < last + oneday)
+            new.append((first, last, hours[keep], np.asarray(counts, dtype=float)[keep]))
+
+        with file_lock(filepath+".lock"):
+            # Read again in case another process added to it in the meantime
+            start, count, fetched = read()
+            for first, last, hours, values in new:
+                # Grow the hourly grid to cover the new days and put the counts in place
+                if len(count):
+                    newstart = min(start, first.astype('datetime64[h]'))
+                    newend = max(start + len(count), (last + oneday).astype('datetime64[h]'))
+                else:
+                    newstart, newend = first.astype('datetime64[h]'), (last + oneday).astype('datetime64[h]')
+                grid = np.full(int((newend - newstart).astype(np.int64)), np.nan)
+                offset = int((start - newstart).astype(np.int64))
+                grid[offset:offset+len(count)] = count
+                grid[(hours - newstart).astype(np.int64)] = values
+                start, count = newstart, grid
+                if first < today:
+                    done = [first.astype(np.int64), min(last, today - oneday).astype(np.int64)]
+                    fetched = np.vstack([fetched, np.array(done, dtype=np.int64)[None, :]])
+            np.savez_compressed(filepath+".tmp.npz", start=np.array(start.astype(np.int64)), count=count, fetched=fetched)
+            os.replace(filepath+".tmp.npz", filepath)
+
+    hours = np.arange(startday.astype('datetime64[h]'), (endday + oneday).astype('datetime64[h]'))
+    pos = (hours - start).astype(np.int64)
+    inside = (pos >= 0) & (pos < len(count))
+    out = np.full(len(hours), np.nan)
+    out[inside] = count[pos[inside]]
+    return pd.Series(out, index=pd.DatetimeIndex(hours.astype('datetime64[ns]')))
+
+
+def nmdb_get(startdate, enddate, station="JUNG", nld=nld):
+    """nmdb_get will collect data for Junfraujoch station that is required to calculate fsol.
+    Returns a dictionary that can be used to fill in values to the main dataframe
+    of each site. Data comes from the local NMDB archive (see nmdb_archive) which only
+    fetches dates it doesn't have yet.
 
     Parameters
     ----------
@@ -402,6 +549,8 @@ def nmdb_get_alt(startdate, enddate, nld=nld):
             e.g 2015-10-01
     enddate : datetime
         end date of desired data in format YYY-mm-dd
+    station : str, optional
+        if using different station provide the value here (NMDB.eu shows alternatives), by default "JUNG"
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -411,24 +560,35 @@ def nmdb_get_alt(startdate, enddate, nld=nld):
     dict
         dictionary of neutron count data from NMDB.eu
     """
-    nld=nld['config']
-    df = open(nld['defaultdir']+"/data/nmdb/tmp.txt", "r")
-    lines = df.readlines()
-    df.close()
-    lines = lines[1:]
-    dfneut = pd.DataFrame(lines)
-    dfneut = dfneut[0].str.split(";", n=2, expand=True)
-    cols = ['DATE', 'COUNT']
-    dfneut.columns = cols
+    counts = nmdb_archive(startdate, enddate, station=station, nld=nld).dropna()
+    return dict(zip(counts.index, counts.to_numpy()))
 
-    dfneut['DATE'] = pd.to_datetime(dfneut['DATE'])
 
-    dates = dfneut['DATE']
-    count = dfneut['COUNT']
+def nmdb_get_alt(startdate, enddate, station="JUNG", nld=nld):
+    """nmdb_get_alt alternative to the above nmdb_get which only uses the data already in the local
+    NMDB archive (see nmdb_archive), nothing is fetched.
+    This is brought in to deal with when nmdb may be down
 
-    dfdict = dict(zip(dates, count))
+    Parameters
+    ----------
+    startdate : datetime
+        start date of desire data in format YYYY-mm-dd
+            e.g 2015-10-01
+    enddate : datetime
+        end date of desired data in format YYY-mm-dd
+    station : str, optional
+        if using different station provide the value here (NMDB.eu shows alternatives), by default "JUNG"
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
 
-    return dfdict
+    Returns
+    -------
+    dict
+        dictionary of neutron count data from NMDB.eu
+    """
+    counts = nmdb_archive(startdate, enddate, station=station, offline=True, nld=nld).dropna()
+    return dict(zip(counts.index, counts.to_numpy()))
 
 
 ############## Koppen Gieger classification ###################################
@@ -469,7 +629,7 @@ def KG_func(meta, country, sitenum, useera=None, nld=nld):
     # CHECK IF LOCAL TEMP AND PRECIP IS AVAILABLE
     dfcheck = nld['defaultdir']+"/data/crns_data/raw/"+str(sitecode)+".txt"
     try:
-        dfcheck = pd.read_csv(dfcheck, sep="\t")
+        dfcheck = pd.read_csv(dfcheck, sep="\t", na_values=[int(nld['noval'])])
     except:
         print("No raw data to check... moving along!")
         # Introduced as if no data currently availabel it will crash (still may want to check on info)
@@ -480,16 +640,12 @@ def KG_func(meta, country, sitenum, useera=None, nld=nld):
     # Added check if wanted to use era5 land by default
 
     if useera == True:
-            era5 = xr.open_dataset(
-                nld['defaultdir']+"data/era5land/"+nld['era5_filename']+".nc")
             try:
-                era5site = era5.sel(site=str(sitecode))
-            except:
-                if len(era5.site) > 1:
-                    print("No ERA5-Land data available for "+str(sitecode))
-                    return
-                else:
-                    era5site = era5  # If user only has one site it breaks here - this stops that
+                era5site = era5_site(nld['defaultdir']+"/data/era5land/"+nld['era5_filename']+".nc", str(sitecode),
+                                     variables=['temperature', 'precipitation'])
+            except KeyError:
+                print("No ERA5-Land data available for "+str(sitecode))
+                return
 
             df = pd.DataFrame()
             df['DT'] = pd.to_datetime(era5site.time.values)
@@ -522,21 +678,16 @@ def KG_func(meta, country, sitenum, useera=None, nld=nld):
             df = df.drop(df[df.dupes == True].index)
             idx = pd.date_range(
                 df.DT.iloc[0], df.DT.iloc[-1], freq='1H', closed='left')
-            df = df.reindex(idx, fill_value=int(nld['noval']))
+            df = df.reindex(idx, fill_value=np.nan)
             df['DT'] = df.index
-            df = df.replace(int(nld['noval']), np.nan)
 
         else:
-            era5 = xr.open_dataset(
-                nld['defaultdir']+"data/era5land/"+nld['era5_filename']+".nc")
             try:
-                era5site = era5.sel(site=str(sitecode))
-            except:
-                if len(era5.site) > 1:
-                    print("No ERA5-Land data available for "+str(sitecode))
-                    return
-                else:
-                    era5site = era5  # If user only has one site it breaks here - this stops that
+                era5site = era5_site(nld['defaultdir']+"/data/era5land/"+nld['era5_filename']+".nc", str(sitecode),
+                                     variables=['temperature', 'precipitation'])
+            except KeyError:
+                print("No ERA5-Land data available for "+str(sitecode))
+                return
 
             df = pd.DataFrame()
             df['DT'] = pd.to_datetime(era5site.time.values)
@@ -11,9 +11,18 @@ Requires setting up computer as outlined in readme.md due to a requirement to re
 
 Set up like this as it can take a LONG time to download. Best to leave running over a few days depending on amount being downloaded.
 """
+import os
+import json
+import time
+import threading
+import math
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
 import pandas as pd
-import itertools
 import xarray as xr
+import netCDF4
 import cdsapi
 
 """
@@ -26,10 +35,376 @@ nld.read('config.ini')
 
 
 
-def era5landdl(area, years, months, variables, savename, nld=nld, saveloc=None):
+# Files opened by era5_open (filepath: (modified time, dataset)) and the cache of site series
+# ((filepath, site, variable): dataarray) in least recently used order
+_era5_files = {}
+_era5_sites = OrderedDict()
+_era5_cache = {'nbytes': 0, 'maxbytes': 512*2**20}
+# Shared memory blocks made by era5_share in this process (name: SharedMemory) and the
+# files attached to by era5_attach (filepath: sites, arrays and blocks)
+_era5_blocks = {}
+_era5_shared = {}
+
+# All days and hours of a month, the CDS gives only the valid days of each month
+DAYS = ['{:02}'.format(d) for d in range(1, 32)]
+TIMES = ['{:02}:00'.format(h) for h in range(24)]
+
+
+def era5_request(area, year, month, variables):
+    """era5_request the CDS request for one month of ERA5-Land data
+
+    Parameters
+    ----------
+    area : list
+        [north, west, south, east]
+    year : int
+        year e.g. 2015
+    month : int
+        month e.g. 6
+    variables : list
+        list of ERA5-Land variable names
+
+    Returns
+    -------
+    dict
+        request for cdsapi.Client().retrieve('reanalysis-era5-land', ...)
+    """
+    return {
+        'variable': variables,
+        'year': year,
+        'month': month,
+        'day': DAYS,
+        'area': area,
+        'time': TIMES,
+        'format': 'netcdf'
+    }
+
+
+def era5_file_complete(filepath, year, month, minsize=1000, partial=False):
+    """era5_file_complete checks a downloaded month is usable: the file exists, is not
+    truncated (at least minsize bytes), opens and has every hour of the month. With partial
+    the month only has to have every hour from its start up to the last hour in the file,
+    for a month that isn't fully published yet.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the netcdf file
+    year : int
+        year of the file
+    month : int
+        month of the file
+    minsize : int, optional
+        smallest acceptable file size in bytes, by default 1000
+    partial : bool, optional
+        accept a month that stops early (with no gaps), by default False
+
+    Returns
+    -------
+    bool
+        True if the month is complete
+    """
+    if not os.path.exists(filepath) or os.path.getsize(filepath) < minsize:
+        return False
+    start = pd.Timestamp(year=int(year), month=int(month), day=1)
+    expected = pd.date_range(start, periods=start.days_in_month*24, freq="h")
+    try:
+        with xr.open_dataset(filepath) as ds:
+            tname = 'time' if 'time' in ds.coords else 'valid_time'  # newer CDS files use valid_time
+            times = pd.DatetimeIndex(ds[tname].values)
+    except Exception:
+        return False
+    if partial and len(times):
+        expected = expected[expected <= times.max()]
+    return len(times) == len(expected) and len(times) > 0 and times[0] == expected[0] and times[-1] == expected[-1]
+
+
+def era5_jobs(area, years, months, variables, savename, saveloc=None, nld=nld):
+    """era5_jobs makes the list of monthly download jobs for era5_download, saved with the
+    same names as era5landdl.
+
+    Parameters
+    ----------
+    area : list
+        [north, west, south, east]
+    years : list
+        years that are required
+    months : list
+        months that are required (numerical format)
+    variables : list
+        list of ERA5-Land variable names
+    savename : string
+        string appended to file name when saving e.g. "USA_SITES_"
+    saveloc : None | string
+        folder to save into, by default None which is the store folder of the working directory
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    list
+        a dict for each month with year, month, request and target
+    """
+    nld=nld['config']
+    if saveloc == None:
+        saveloc = nld['defaultdir']+"/data/era5land/store/"
+    return [{'year': year, 'month': month, 'request': era5_request(area, year, month, variables),
+             'target': saveloc+savename+"_"+str(year)+"_month"+str(month)+".nc"}
+            for year in years for month in months]
+
+
+def era5_download(jobs, client=None, workers=4, retries=3, backoff=60, ledger=None, lag=5, nld=nld):
+    """era5_download downloads ERA5-Land jobs (see era5_jobs) with a bounded number of requests
+    running at once. Months that are already complete (see era5_file_complete) are skipped,
+    so an interrupted download can be restarted and only the missing months are requested.
+    Failed requests are retried, waiting longer each time, and each download is written to a
+    temporary file that only replaces the target once it is complete.
+
+    ERA5-Land is published about 5 days behind real time so a month that ends less than lag days
+    ago can't be complete yet. If it has every hour from its start to the end of the data it is
+    kept with status "partial" and downloaded again next time.
+
+    Progress is kept in a json ledger (status, attempts and last error of each file).
+
+    Parameters
+    ----------
+    jobs : list
+        dicts with year, month, request and target (see era5_jobs)
+    client : object, optional
+        object with a retrieve(name, request, target) method, e.g. cdsapi.Client() or a fake for testing.
+        By default None which makes a cdsapi.Client for each worker
+    workers : int, optional
+        number of requests to run at once, by default 4 (the CDS queues requests per user)
+    retries : int, optional
+        number of retries after a failed request, by default 3
+    backoff : float, optional
+        seconds to wait before the first retry, doubled for each retry after, by default 60
+    ledger : str, optional
+        location of the ledger, by default data/era5land/store/download_ledger.json
+    lag : float, optional
+        days ERA5-Land is behind real time, by default 5
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dict
+        the ledger entry of each target
+    """
+    nld=nld['config']
+    if ledger is None:
+        ledger = nld['defaultdir']+"/data/era5land/store/download_ledger.json"
+    entries = dict()
+    if os.path.exists(ledger):
+        with open(ledger) as f:
+            entries = json.load(f)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def record(job, **values):
+        with lock:
+            entry = entries.setdefault(os.path.basename(job['target']),
+                                       {'year': job['year'], 'month': job['month'], 'attempts': 0})
+            entry.update(values)
+            entry['updated'] = pd.Timestamp.now().isoformat(timespec='seconds')
+            with open(ledger+".tmp", 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(ledger+".tmp", ledger)
+
+    def getclient():
+        if client is not None:
+            return client
+        if not hasattr(local, 'client'):
+            local.client = cdsapi.Client()
+        return local.client
+
+    def run(job):
+        target = job['target']
+        if era5_file_complete(target, job['year'], job['month']):
+            record(job, status='complete', error=None)
+            return
+        part = target[:-3]+".part.nc"
+        # A month that ends after the latest data published can only be partial
+        monthend = pd.Timestamp(year=int(job['year']), month=int(job['month']), day=1) + pd.DateOffset(months=1)
+        recent = monthend > pd.Timestamp.now(tz='UTC').tz_localize(None) - pd.Timedelta(days=lag)
+        for attempt in range(retries + 1):
+            try:
+                getclient().retrieve('reanalysis-era5-land', job['request'], part)
+                if era5_file_complete(part, job['year'], job['month']):
+                    status = 'complete'
+                elif recent and era5_file_complete(part, job['year'], job['month'], partial=True):
+                    status = 'partial'
+                else:
+                    raise ValueError("downloaded file is incomplete")
+                os.replace(part, target)
+                entry = entries.get(os.path.basename(target), {})
+                record(job, status=status, error=None, attempts=entry.get('attempts', 0) + 1)
+                print("Downloaded "+target+("" if status == 'complete' else " (partial, not all published yet)"))
+                return
+            except Exception as e:
+                entry = entries.get(os.path.basename(target), {})
+                record(job, status='failed', error=str(e), attempts=entry.get('attempts', 0) + 1)
+                print("Download of "+target+" failed ("+str(e)+")")
+                if attempt < retries:
+                    time.sleep(backoff * 2**attempt)
+
+    os.makedirs(os.path.dirname(os.path.abspath(ledger)), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, jobs))
+    return {os.path.basename(job['target']): entries[os.path.basename(job['target'])] for job in jobs}
+
+
+def site_spans(meta=None, rawloc=None, nld=nld):
+    """site_spans gives the location and the time span of the raw data of each site in the metadata,
+    for planning which ERA5-Land data is needed (see era5_plan). Only the TIME column of each raw file
+    is read.
+
+    Parameters
+    ----------
+    meta : dataframe, optional
+        metadata, by default None which reads data/metadata.csv
+    rawloc : str, optional
+        folder of the raw files, by default data/crns_data/raw/ of the working directory
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dataframe
+        SITE (e.g. USA_SITE_011), LATITUDE, LONGITUDE, START and END of each site with raw data
+    """
+    nld=nld['config']
+    if meta is None:
+        meta = pd.read_csv(nld['defaultdir']+"/data/metadata.csv")
+    if rawloc is None:
+        rawloc = nld['defaultdir']+"/data/crns_data/raw/"
+    rows = []
+    for i in range(len(meta)):
+        site = meta['COUNTRY'].iloc[i]+"_SITE_"+"{:03}".format(int(meta['SITENUM'].iloc[i]))
+        rawfile = os.path.join(rawloc, site+".txt")
+        if not os.path.exists(rawfile):
+            print("No raw data for "+site+", not included")
+            continue
+        times = pd.to_datetime(pd.read_csv(rawfile, sep="\t", usecols=['TIME'])['TIME'])
+        rows.append({'SITE': site, 'LATITUDE': float(meta['LATITUDE'].iloc[i]),
+                     'LONGITUDE': float(meta['LONGITUDE'].iloc[i]), 'START': times.min(), 'END': times.max()})
+    return pd.DataFrame(rows, columns=['SITE', 'LATITUDE', 'LONGITUDE', 'START', 'END'])
+
+
+def cluster_sites(sites, boxsize=1.0, pad=0.1):
+    """cluster_sites groups sites that fall in the same boxsize x boxsize degree cell, and gives each group
+    the smallest area (snapped out to the 0.1 degree ERA5-Land grid) that covers its sites plus pad.
+
+    Parameters
+    ----------
+    sites : dataframe
+        SITE, LATITUDE and LONGITUDE of each site (e.g. from site_spans)
+    boxsize : float, optional
+        size of the cells used to group sites (degrees), by default 1.0
+    pad : float, optional
+        margin around the sites (degrees) so the nearest grid is always included, by default 0.1
+
+    Returns
+    -------
+    dataframe
+        sites with a BOX column
+    dict
+        area [north, west, south, east] of each box
+    """
+    sites = sites.copy()
+    lat0 = np.floor(sites['LATITUDE'] / boxsize) * boxsize
+    lon0 = np.floor(sites['LONGITUDE'] / boxsize) * boxsize
+    sites['BOX'] = [("N" if la >= 0 else "S")+format(abs(la), 'g')+("E" if lo >= 0 else "W")+format(abs(lo), 'g')
+                    for la, lo in zip(lat0, lon0)]
+    areas = dict()
+    for box, group in sites.groupby('BOX'):
+        areas[box] = [round(math.ceil((group['LATITUDE'].max() + pad) * 10) / 10, 1),
+                      round(math.floor((group['LONGITUDE'].min() - pad) * 10) / 10, 1),
+                      round(math.floor((group['LATITUDE'].min() - pad) * 10) / 10, 1),
+                      round(math.ceil((group['LONGITUDE'].max() + pad) * 10) / 10, 1)]
+    return sites, areas
+
+
+def era5_plan(sites, variables, savename, boxsize=1.0, pad=0.1, saveloc=None, missing=True, nld=nld):
+    """era5_plan works out the ERA5-Land requests needed for a network. Sites are clustered into small
+    boxes (see cluster_sites) and each box is only requested for the months that its sites have raw
+    data. Months already complete in the store (see era5_file_complete) are left out, so the result
+    is the set of requests still missing, ready for era5_download.
+
+    Parameters
+    ----------
+    sites : dataframe
+        SITE, LATITUDE, LONGITUDE, START and END of each site, from site_spans
+    variables : list
+        list of ERA5-Land variable names
+    savename : string
+        string added to the file names e.g. "COSMOS", files are savename_box_year_monthM.nc
+    boxsize : float, optional
+        size of the cells used to group sites (degrees), by default 1.0
+    pad : float, optional
+        margin around the sites (degrees), by default 0.1
+    saveloc : None | string
+        folder of the downloaded files, by default the store folder of the working directory
+    missing : bool, optional
+        only give the requests that are missing from the store, by default True. Use False for the
+        full plan e.g. to extract the sites with era5landnetcdf
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    list
+        a job (dict of year, month, box, area, sites, request and target) for each missing request
+        (or each request if missing is False)
+    """
+    nld=nld['config']
+    if saveloc == None:
+        saveloc = nld['defaultdir']+"/data/era5land/store/"
+    sites, areas = cluster_sites(sites, boxsize=boxsize, pad=pad)
+    jobs = dict()
+    for _, site in sites.iterrows():
+        for period in pd.period_range(site['START'], site['END'], freq="M"):
+            key = (site['BOX'], period.year, period.month)
+            if key not in jobs:
+                jobs[key] = {'year': period.year, 'month': period.month, 'box': site['BOX'],
+                             'area': areas[site['BOX']], 'sites': [],
+                             'request': era5_request(areas[site['BOX']], period.year, period.month, variables),
+                             'target': saveloc+savename+"_"+site['BOX']+"_"+str(period.year)+"_month" +
+                             str(period.month)+".nc"}
+            jobs[key]['sites'].append(site['SITE'])
+    jobs = [jobs[key] for key in sorted(jobs)]
+    missing_jobs = [job for job in jobs if not era5_file_complete(job['target'], job['year'], job['month'])]
+
+    # Grid cells x hours requested compared to one box around every site for every month
+    def cells(area):
+        return (round((area[0] - area[2]) * 10) + 1) * (round((area[3] - area[1]) * 10) + 1)
+    planned = sum(cells(j['area']) * pd.Period(year=j['year'], month=j['month'], freq="M").days_in_month * 24
+                  for j in jobs)
+    allmonths = pd.period_range(sites['START'].min(), sites['END'].max(), freq="M")
+    single = cells([math.ceil((sites['LATITUDE'].max() + pad) * 10) / 10,
+                    math.floor((sites['LONGITUDE'].min() - pad) * 10) / 10,
+                    math.floor((sites['LATITUDE'].min() - pad) * 10) / 10,
+                    math.ceil((sites['LONGITUDE'].max() + pad) * 10) / 10]) * sum(p.days_in_month * 24 for p in allmonths)
+    print(str(len(sites))+" sites in "+str(len(areas))+" boxes, "+str(len(jobs))+" monthly requests of which " +
+          str(len(missing_jobs))+" are missing from the store")
+    print("Grid cell hours requested: "+str(planned)+" ("+format(100*planned/single, ".3g") +
+          "% of one box around all sites for every month)")
+    if missing:
+        return missing_jobs
+    return jobs
+
+
+def era5landdl(area, years, months, variables, savename, nld=nld, saveloc=None, workers=1, retries=3, client=None):
     """era5landdl automate download of ERA5_Land data. See readme for instructions
     on preparing the computer log in to era5 land system necessary to run this code (www.github.com/danpower101/crspy)
 
+    Months that have already been downloaded are skipped, so the download can be restarted
+    if it is interrupted (see era5_download).
+
     Parameters
     ----------
     area : list
@@ -57,57 +432,412 @@ def era5landdl(area, years, months, variables, savename, nld=nld, saveloc=None):
     saveloc : None | string
         customloc is by default None and will save into the working directory structure as standard. If you wish to save
         your files in a custom location this can be replace with a string of the directory location.
+    workers : int, optional
+        number of requests to run at once, by default 1
+    retries : int, optional
+        number of retries after a failed request, by default 3
+    client : object, optional
+        client with a retrieve method, by default None which uses cdsapi.Client()
     """
-    nld=nld['config']
+    jobs = era5_jobs(area, years, months, variables, savename, saveloc=saveloc, nld=nld)
+    era5_download(jobs, client=client, workers=workers, retries=retries, nld=nld)
+
+
+# ERA5-Land short names and the names used in the crspy site file
+ERA5VARS = {'t2m': 'temperature', 'sp': 'pressure', 'tp': 'precipitation', 'swvl1': 'soil_moisture_1',
+            'swvl2': 'soil_moisture_2', 'swvl3': 'soil_moisture_3', 'swvl4': 'soil_moisture_4',
+            'd2m': 'dewpoint_temperature', 'sd': 'snow_water_equiv'}
+
+
+def era5_extract(ds, sites, tol):
+    """era5_extract takes the grid nearest to each site (within tol) from an ERA5-Land dataset. The grid
+    indices of all sites are found once and every variable is taken for every site with a single
+    pointwise isel, giving a (time, site) dataset. Sites with no grid within tol are left out.
 
-    for year in years:
-        for month in months:
-            if saveloc == None:
-                slocation = nld['defaultdir']+"/data/era5land/store/" + \
-                    savename+"_"+str(year)+"_month"+str(month)+".nc"
-            else:
-                slocation = saveloc+savename+"_"+str(year)+"_month"+str(month)+".nc"
-            c = cdsapi.Client()
-            c.retrieve(
-                'reanalysis-era5-land',
-                {
-                    'variable': variables,
-                    'year': year,
-                    'month': month,  # change month to monthlist if yearly
-                    'day': [
-                        '01', '02', '03',
-                        '04', '05', '06',
-                        '07', '08', '09',
-                        '10', '11', '12',
-                        '13', '14', '15',
-                        '16', '17', '18',
-                        '19', '20', '21',
-                        '22', '23', '24',
-                        '25', '26', '27',
-                        '28', '29', '30',
-                        '31',
-                    ],
-                    'area': area,
-                    'time': [
-                        '00:00', '01:00', '02:00',
-                        '03:00', '04:00', '05:00',
-                        '06:00', '07:00', '08:00',
-                        '09:00', '10:00', '11:00',   # All times
-                        '12:00', '13:00', '14:00',
-                        '15:00', '16:00', '17:00',
-                        '18:00', '19:00', '20:00',
-                        '21:00', '22:00', '23:00',
-                    ],
-                    'format': 'netcdf'
-                },
-
-                slocation)
-
-
-def era5landnetcdf(years, months, tol, loadname, savename, loadloc=None, saveloc=None, ogfile=None, nld=nld):
+    Parameters
+    ----------
+    ds : dataset
+        ERA5-Land data with time (or valid_time), latitude and longitude
+    sites : dataframe
+        SITE, LATITUDE and LONGITUDE of each site
+    tol : float
+        tolerance (degrees) on finding nearest grid to site location
+
+    Returns
+    -------
+    dataset
+        ERA5VARS variables (crspy names) with dimensions time and site
+    """
+    if 'valid_time' in ds.dims and 'time' not in ds.dims:
+        ds = ds.rename({'valid_time': 'time'})
+    ilat = ds.indexes['latitude'].get_indexer(sites['LATITUDE'].to_numpy(dtype=float), method='nearest', tolerance=tol)
+    ilon = ds.indexes['longitude'].get_indexer(sites['LONGITUDE'].to_numpy(dtype=float), method='nearest', tolerance=tol)
+    found = (ilat >= 0) & (ilon >= 0)
+    # Sites in name order, sorted here rather than after the (lazy) isel
+    order = np.argsort(sites['SITE'].to_numpy()[found], kind='stable')
+    names = sites['SITE'].to_numpy()[found][order]
+    variables = [v for v in ERA5VARS if v in ds.data_vars]
+    out = ds[variables].isel(latitude=xr.DataArray(ilat[found][order], dims='site'),
+                             longitude=xr.DataArray(ilon[found][order], dims='site'))
+    out = out.drop_vars([c for c in out.coords if c not in ('time',)]).assign_coords(site=names)
+    return out.rename({v: ERA5VARS[v] for v in variables}).transpose('time', 'site')
+
+
+def meta_sites(meta):
+    """meta_sites gives SITE (e.g. USA_SITE_011), LATITUDE and LONGITUDE of each row of the metadata
+
+    Parameters
+    ----------
+    meta : dataframe
+        metadata
+
+    Returns
+    -------
+    dataframe
+        SITE, LATITUDE and LONGITUDE
+    """
+    return pd.DataFrame({'SITE': [c+"_SITE_"+"{:03}".format(int(n)) for c, n in zip(meta['COUNTRY'], meta['SITENUM'])],
+                         'LATITUDE': meta['LATITUDE'].to_numpy(dtype=float),
+                         'LONGITUDE': meta['LONGITUDE'].to_numpy(dtype=float)})
+
+
+def era5_store_append(filepath, ds, timechunk=744):
+    """era5_store_append writes a (time, site) dataset, e.g. a month from era5_extract, into the site store.
+    The store is a netCDF4 file with unlimited time and site dimensions, chunked by site and time (one
+    site x timechunk hours), so months and new sites are added in place rather than rewriting the file
+    and one site can be read without reading the others. Times already in the store are overwritten,
+    so a month can be extracted again.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the store, made if it doesn't exist
+    ds : dataset
+        data with dimensions time and site
+    timechunk : int, optional
+        hours per chunk, by default 744 (31 days)
+    """
+    # The file can't be written while it is open for reading
+    era5_close(filepath)
+    ds = ds.transpose('time', 'site')
+    hours = np.asarray((pd.DatetimeIndex(ds['time'].values) - pd.Timestamp('1900-01-01')) / pd.Timedelta(hours=1))
+    sites = [str(x) for x in ds['site'].values]
+    with netCDF4.Dataset(filepath, 'a' if os.path.exists(filepath) else 'w') as nc:
+        if 'time' not in nc.dimensions:
+            nc.createDimension('time', None)
+            nc.createDimension('site', None)
+            t = nc.createVariable('time', 'f8', ('time',), chunksizes=(timechunk,))
+            t.units = 'hours since 1900-01-01 00:00:00'
+            t.calendar = 'gregorian'
+            nc.createVariable('site', str, ('site',))
+        elif not nc.dimensions['time'].isunlimited():
+            raise ValueError(filepath+" can't be appended to, convert it with era5landnetcdf(ogfile=...)")
+
+        variables = list(ds.data_vars)
+        for v in variables:
+            if v not in nc.variables:
+                nc.createVariable(v, 'f4', ('time', 'site'), chunksizes=(timechunk, 1),
+                                  fill_value=np.float32(np.nan))
+        datavars = [v for v in nc.variables if nc[v].dimensions == ('time', 'site')]
+
+        # Positions of the sites and times in the store, new ones go on the end
+        nsite = len(nc.dimensions['site'])
+        storesites = {str(x): i for i, x in enumerate(nc['site'][:])} if nsite else {}
+        newsites = [x for x in dict.fromkeys(sites) if x not in storesites]
+        for x in newsites:
+            storesites[x] = len(storesites)
+            nc['site'][storesites[x]] = x
+        ntime = len(nc.dimensions['time'])
+        storetimes = dict(zip(np.asarray(nc['time'][:]).tolist(), range(ntime))) if ntime else {}
+        newtimes = [h for h in dict.fromkeys(hours.tolist()) if h not in storetimes]
+        for h in newtimes:
+            storetimes[h] = len(storetimes)
+
+        # Fill the new rows and columns with nan first (all variables) so nothing is left unwritten
+        for v in datavars:
+            if newtimes:
+                nc[v][ntime:len(storetimes), :] = np.full((len(newtimes), len(storesites)), np.nan, dtype=np.float32)
+            if newsites and ntime:
+                nc[v][:ntime, nsite:len(storesites)] = np.full((ntime, len(newsites)), np.nan, dtype=np.float32)
+        if newtimes:
+            nc['time'][ntime:len(storetimes)] = np.array(newtimes)
+
+        tidx = np.array([storetimes[h] for h in hours.tolist()])
+        sidx = np.array([storesites[x] for x in sites])
+        torder = np.argsort(tidx)
+        sorder = np.argsort(sidx)
+        tidx, sidx = tidx[torder], sidx[sorder]
+        # Contiguous blocks (the usual case) are written in one go
+        tsel = slice(tidx[0], tidx[-1]+1) if tidx[-1] - tidx[0] == len(tidx) - 1 else tidx
+        ssel = slice(sidx[0], sidx[-1]+1) if sidx[-1] - sidx[0] == len(sidx) - 1 else sidx
+        for v in variables:
+            nc[v][tsel, ssel] = ds[v].values[torder][:, sorder].astype(np.float32)
+
+
+def era5_open(filepath):
+    """era5_open gives the ERA5-Land file opened (lazily) once for the process. It is opened
+    again if the file has changed since, e.g. after more months were added by another process.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the site store
+
+    Returns
+    -------
+    dataset
+        the open file, closed by era5_close
+    """
+    filepath = os.path.abspath(filepath)
+    mtime = os.path.getmtime(filepath)
+    if filepath in _era5_files and _era5_files[filepath][0] != mtime:
+        era5_close(filepath)
+    if filepath not in _era5_files:
+        _era5_files[filepath] = (mtime, xr.open_dataset(filepath))
+    return _era5_files[filepath][1]
+
+
+def era5_invalidate(filepath=None, site=None):
+    """era5_invalidate removes site series from the cache so they are read again.
+
+    Parameters
+    ----------
+    filepath : str, optional
+        only remove the sites of this file, by default None which removes all files
+    site : str, optional
+        only remove this site, by default None which removes all sites
+    """
+    filepath = filepath if filepath is None else os.path.abspath(filepath)
+    for key in [k for k in _era5_sites if (filepath is None or k[0] == filepath) and (site is None or k[1] == site)]:
+        _era5_cache['nbytes'] -= _era5_sites.pop(key).nbytes
+
+
+def era5_close(filepath=None):
+    """era5_close closes ERA5-Land files opened by era5_open and removes their sites from the cache.
+
+    Parameters
+    ----------
+    filepath : str, optional
+        file to close, by default None which closes all of them
+    """
+    filepath = filepath if filepath is None else os.path.abspath(filepath)
+    for key in [k for k in _era5_files if filepath is None or k == filepath]:
+        _era5_files.pop(key)[1].close()
+        era5_invalidate(key)
+
+
+def era5_cache_limit(maxbytes):
+    """era5_cache_limit sets the size of the cache of site series, the least recently used sites
+    are removed first when it is full.
+
+    Parameters
+    ----------
+    maxbytes : int
+        size of the cache in bytes, 0 turns the cache off
+    """
+    _era5_cache['maxbytes'] = maxbytes
+    while _era5_sites and _era5_cache['nbytes'] > maxbytes:
+        _era5_cache['nbytes'] -= _era5_sites.popitem(last=False)[1].nbytes
+
+
+def era5_share(filepath, sites=None, variables=None):
+    """era5_share loads ERA5-Land variables from the site store once into shared memory blocks
+    (one block per variable, sites x time) so processes running sites in parallel can read them
+    with era5_attach without each loading and decoding the file. Free the blocks with
+    era5_unshare when finished.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the site store
+    sites : list, optional
+        sites to load e.g. ["USA_SITE_011"], by default None which loads all
+    variables : list, optional
+        variables to load e.g. ["temperature", "precipitation"], by default None which loads all
+
+    Returns
+    -------
+    dict
+        description of the blocks to give to era5_attach in each process
+    """
+    filepath = os.path.abspath(filepath)
+    ds = era5_open(filepath)
+    storesites = [str(x) for x in ds['site'].values]
+    sites = storesites if sites is None else [x for x in sites if x in storesites]
+    if variables is None:
+        variables = [v for v in ds.data_vars if ds[v].dims == ('time', 'site')]
+    order = np.argsort(ds['time'].values, kind='stable')
+    handle = {'filepath': filepath, 'sites': sites, 'blocks': {},
+              'attrs': {v: dict(ds[v].attrs) for v in variables}}
+    for name in ['time'] + list(variables):
+        if name == 'time':
+            values = ds['time'].values[order].astype('datetime64[ns]')
+        else:
+            values = ds[name].isel(site=[storesites.index(x) for x in sites]).transpose('site', 'time').values[:, order]
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, values.dtype, buffer=shm.buf)[...] = values
+        _era5_blocks[shm.name] = shm
+        handle['blocks'][name] = (shm.name, values.shape, values.dtype.str)
+    # Processes forked from here don't need the file open
+    era5_close(filepath)
+    print("Shared "+str(len(variables))+" ERA5-Land variables of "+str(len(sites))+" sites (" +
+          str(round(sum(_era5_blocks[b[0]].size for b in handle['blocks'].values())/1e6, 1))+" MB)")
+    return handle
+
+
+def era5_attach(handle):
+    """era5_attach gives this process read only views of the shared memory blocks made by era5_share,
+    e.g. as the initializer of a process pool. era5_site then reads the shared sites from memory
+    rather than from the file.
+
+    Parameters
+    ----------
+    handle : dict
+        description of the blocks from era5_share
+    """
+    shms = {name: _era5_blocks[block[0]] if block[0] in _era5_blocks else shared_memory.SharedMemory(name=block[0])
+            for name, block in handle['blocks'].items()}
+    arrays = {}
+    for name, (shmname, shape, dtype) in handle['blocks'].items():
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=shms[name].buf)
+        arrays[name].flags.writeable = False
+    _era5_shared[handle['filepath']] = {'sites': {x: i for i, x in enumerate(handle['sites'])},
+                                         'arrays': arrays, 'attrs': handle['attrs'], 'shm': shms}
+
+
+def era5_detach(filepath=None):
+    """era5_detach stops this process reading from the shared memory blocks of a file.
+
+    Parameters
+    ----------
+    filepath : str, optional
+        file to detach, by default None which detaches all files
+    """
+    filepath = filepath if filepath is None else os.path.abspath(filepath)
+    for key in [k for k in _era5_shared if filepath is None or k == filepath]:
+        shared = _era5_shared.pop(key)
+        shared['arrays'].clear()
+        for shm in shared['shm'].values():
+            if shm.name not in _era5_blocks:
+                shm.close()
+
+
+def era5_unshare(handle):
+    """era5_unshare frees the shared memory blocks made by era5_share, once every process using
+    them has finished.
+
+    Parameters
+    ----------
+    handle : dict
+        description of the blocks from era5_share
+    """
+    era5_detach(handle['filepath'])
+    for shmname, shape, dtype in handle['blocks'].values():
+        shm = _era5_blocks.pop(shmname)
+        shm.close()
+        shm.unlink()
+
+
+def era5_site(filepath, site, variables=None, start=None, end=None):
+    """era5_site reads the ERA5-Land data of one site from the site store (or a file from an older
+    version of era5landnetcdf). The file is opened once for the process (see era5_open) and only
+    the variables and times asked for are read. These are kept for each site and variable in a
+    least recently used cache (see era5_cache_limit), so running the same site again doesn't
+    re-read and decode the file.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the site store
+    site : str
+        site e.g. "USA_SITE_011"
+    variables : list, optional
+        variables to read e.g. ["temperature", "precipitation"], by default None which reads all
+    start : datetime, optional
+        first time to read, by default None
+    end : datetime, optional
+        last time to read, by default None
+
+    Returns
+    -------
+    dataset
+        data of the site with dimension time (in time order)
+    """
+    shared = _era5_shared.get(os.path.abspath(filepath))
+    if shared is not None and site in shared['sites'] and (variables is None or
+                                                           all(v in shared['arrays'] for v in variables)):
+        # Views of the shared memory, nothing is copied
+        arrays = shared['arrays']
+        i = shared['sites'][site]
+        time = arrays['time']
+        lo = 0 if start is None else np.searchsorted(time, np.datetime64(pd.Timestamp(start)), side='left')
+        hi = len(time) if end is None else np.searchsorted(time, np.datetime64(pd.Timestamp(end)), side='right')
+        variables = [v for v in arrays if v != 'time'] if variables is None else variables
+        return xr.Dataset({v: ('time', arrays[v][i, lo:hi], shared['attrs'][v]) for v in variables},
+                          coords={'time': time[lo:hi], 'site': site})
+
+    ds = era5_open(filepath)
+    if 'site' in ds.dims:
+        sites = [str(x) for x in ds['site'].values]
+        if site in sites:
+            ds = ds.isel(site=sites.index(site))
+        elif len(sites) == 1:
+            ds = ds.isel(site=0)  # If user only has one site
+        else:
+            raise KeyError("No ERA5-Land data available for "+str(site))
+    time = ds['time'].values
+    lo = time.min() if start is None else max(np.datetime64(pd.Timestamp(start)), time.min())
+    hi = time.max() if end is None else min(np.datetime64(pd.Timestamp(end)), time.max())
+    variables = list(ds.data_vars) if variables is None else list(variables)
+    data = {}
+    for var in variables:
+        key = (os.path.abspath(filepath), site, var)
+        cached = _era5_sites.get(key)
+        if cached is not None and cached.sizes['time'] > 0 and cached['time'].values[0] <= lo \
+                and cached['time'].values[-1] >= hi:
+            _era5_sites.move_to_end(key)
+            vardata = cached
+        else:
+            # Only the variable and times asked for are read, a cached window of the variable is
+            # extended rather than read again
+            first, last = (lo, hi) if cached is None or cached.sizes['time'] == 0 else \
+                (min(lo, cached['time'].values[0]), max(hi, cached['time'].values[-1]))
+            rows = np.flatnonzero((time >= first) & (time <= last))
+            # An empty slice if no times are asked for (the file can't be indexed with an empty array)
+            vardata = ds[var].isel(time=rows if len(rows) else slice(0, 0)).compute()
+            vardata = vardata.isel(time=np.argsort(vardata['time'].values, kind='stable'))
+            if cached is not None:
+                _era5_cache['nbytes'] -= _era5_sites.pop(key).nbytes
+            if 0 < vardata.nbytes <= _era5_cache['maxbytes']:
+                _era5_sites[key] = vardata
+                _era5_cache['nbytes'] += vardata.nbytes
+                era5_cache_limit(_era5_cache['maxbytes'])
+        vartime = vardata['time'].values
+        data[var] = vardata.isel(time=np.flatnonzero((vartime >= lo) & (vartime <= hi)))
+    # A copy so the cached series can't be changed by the caller
+    return xr.Dataset(data, attrs=ds.attrs).copy(deep=True)
+
+
+def _era5_extract_file(task):
+    """
+    Extract the sites from one ERA5-Land file (run in a worker when parallel)
+    """
+    ncfile, jobsites, tol = task
+    with xr.open_dataset(ncfile) as ds:
+        return era5_extract(ds, jobsites, tol).load()
+
+
+def era5landnetcdf(years, months, tol, loadname, savename, loadloc=None, saveloc=None, ogfile=None, jobs=None,
+                   workers=None, nld=nld):
     """era5landnetcdf takes individual era5land files downloaded from the era5 cds and extracts the required grids.
     It then combines them into a single netcdf file with dimensions date and site.
 
+    The file is a site store (see era5_store_append), each month is appended in place. If the
+    store already exists the months are added to it (months already in it are replaced).
+
+    With workers the files are extracted at once in a process pool, each worker reading one file
+    and returning its sites. The results are appended to the store in the order of the files.
+
     It will identify the correct grid using the nearest lat and lon within a defined
     tolerance (to ensure grids aren't taken from too far away from site.)
 
@@ -136,8 +866,14 @@ def era5landnetcdf(years, months, tol, loadname, savename, loadloc=None, saveloc
         customloc is by default None and will save into the working directory structure as standard. If you wish to save
         your files in a custom location this can be replace with a string of the directory location.
     ogfile : string, optional
-        location of the original netcdf file that you wish to append data to (if available)
+        location of the original netcdf file that you wish to append data to (if available). It is copied into
+        the store first, which also converts a file made by an older version of crspy
         e.g. nld['defaultdir'] + "/data/era5land/store/ogfile.nc", by default None
+    jobs : list, optional
+        files to extract from in place of years/months/loadname e.g. era5_plan(..., missing=False), each
+        only for its own sites. By default None
+    workers : int, optional
+        number of processes extracting files at once, by default None which extracts one at a time
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -149,94 +885,33 @@ def era5landnetcdf(years, months, tol, loadname, savename, loadloc=None, saveloc
         return
 
     meta = pd.read_csv(nld['defaultdir']+"/data/metadata.csv")
-    meta['SITENUM'] = meta.SITENUM.map("{:03}".format)  # Add leading zeros
+    sites = meta_sites(meta)
+
+    store = nld['defaultdir']+"/data/era5land/"+savename+'.nc'
+    if ogfile != None and os.path.abspath(ogfile) != os.path.abspath(store):
+        print("Copying "+ogfile+" into "+store)
+        with xr.open_dataset(ogfile) as og:
+            era5_store_append(store, og.load())
 
-    # Create placeholder
-    ds_1 = xr.Dataset()
-    if ogfile == None:
-        era5_all = xr.Dataset()
-    else:
-        era5_all = xr.open_dataset(ogfile)
+    if jobs is None:
+        if loadloc == None:
+            loadloc = nld['defaultdir']+"/data/era5land/store/"
+        jobs = [{'target': loadloc+loadname+"_"+str(year)+"_month"+str(month)+".nc"}
+                for year in years for month in months]
 
     # take from metadata
-    for year in years:
-        for month in months:
-            if loadloc == None:
-                ncfile = nld['defaultdir']+"/data/era5land/store/" + \
-                    loadname+"_"+str(year)+"_month"+str(month)+".nc"
-            else:
-                ncfile = loadloc+loadname+"_"+str(year)+"_month"+str(month)+".nc"
-            print("Extracting data from "+ncfile)
-            with xr.open_dataset(ncfile) as ds:
-                timearray = list(ds.time.values)  # Extract the times
-
-                """
-                Trial and error method. Go through the metadata, extract lat lon,
-                extract site name and code, then attempt to find the data within the 
-                defined tolerance from the data in the store folder.
-                If not found will move onto the next.
-                """
-
-                for i in range(len(meta)):
-                    # Assign values of sitename, and location of site.
-                    lon = meta.loc[i, "LONGITUDE"]
-                    lat = meta.loc[i, "LATITUDE"]
-                    sitename = meta['COUNTRY'][i]+"_SITE_"+meta['SITENUM'][i]
-                    timearray = list(ds.time.values)
-                    sitelist = list(itertools.repeat(sitename, len(timearray)))
-
-                    # Set index for series - time and site
-                    idx = pd.MultiIndex.from_arrays(
-                        arrays=[timearray, sitelist], names=["time", "site"])
-
-                    # Create series for each var
-                    try:
-                        temp_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).t2m.values, index=idx)
-                        press_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).sp.values, index=idx)
-                        precip_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).tp.values, index=idx)
-                        sm_1_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).swvl1.values, index=idx)
-                        sm_2_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).swvl2.values, index=idx)
-                        sm_3_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).swvl3.values, index=idx)
-                        sm_4_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).swvl4.values, index=idx)
-                        dewtemp_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).d2m.values, index=idx)
-                        snowequiv_s = pd.Series(ds.sel(
-                            latitude=lat, longitude=lon, method='nearest', tolerance=tol).sd.values, index=idx)
-
-                        # Create dataarray for each var
-                        temp_da = xr.DataArray.from_series(temp_s)
-                        press_da = xr.DataArray.from_series(press_s)
-                        precip_da = xr.DataArray.from_series(precip_s)
-                        sm_1_da = xr.DataArray.from_series(sm_1_s)
-                        sm_2_da = xr.DataArray.from_series(sm_2_s)
-                        sm_3_da = xr.DataArray.from_series(sm_3_s)
-                        sm_4_da = xr.DataArray.from_series(sm_4_s)
-                        dewtemp_da = xr.DataArray.from_series(dewtemp_s)
-                        snowequiv_da = xr.DataArray.from_series(snowequiv_s)
-
-                        dstemp = xr.Dataset(data_vars={"temperature": temp_da,
-                                                       "pressure": press_da,
-                                                       "precipitation": precip_da,
-                                                       "soil_moisture_1": sm_1_da,
-                                                       "soil_moisture_2": sm_2_da,
-                                                       "soil_moisture_3": sm_3_da,
-                                                       "soil_moisture_4": sm_4_da,
-                                                       "dewpoint_temperature": dewtemp_da,
-                                                       "snow_water_equiv": snowequiv_da})
-
-                        ds_1 = ds_1.combine_first(dstemp)
-                        dstemp.close()
-                        print("Writing "+sitename)
-                    except:
-                        pass
-                era5_all = xr.merge([era5_all, ds_1], join="outer")
-                # Save each iteration incase of crash!
-                era5_all.to_netcdf(nld['defaultdir'] +
-                                   "/data/era5land/"+savename+'.nc')
+    tasks = [(job['target'], sites if 'sites' not in job else sites[sites['SITE'].isin(job['sites'])], tol)
+             for job in jobs]
+    executor = ProcessPoolExecutor(max_workers=workers) if workers is not None else None
+    try:
+        # map gives the results in the order of the files whichever finishes first
+        results = map(_era5_extract_file, tasks) if executor is None else executor.map(_era5_extract_file, tasks)
+        for (ncfile, jobsites, _), ds_1 in zip(tasks, results):
+            print("Extracted data from "+ncfile)
+            print("Found "+str(ds_1.sizes['site'])+" of "+str(len(jobsites))+" sites")
+            if ds_1.sizes['site']:
+                # Appended in place so each month is saved as it goes
+                era5_store_append(store, ds_1)
+    finally:
+        if executor is not None:
+            executor.shutdown()
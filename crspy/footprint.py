@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Footprint weighted measurement depth
+
+D86avg in thetaprocess averages D86 (Schron et al., 2017) at three radii. Here D86 is
+instead averaged over the whole footprint using the radial weighting functions (WrX, WrA
+and WrB) for the pressure, humidity and soil moisture of each hour.
+
+The integral over the footprint is slow to calculate for every hour so it is calculated
+once on a grid of pressure, humidity and soil moisture and saved to the working directory.
+Each hour is then interpolated from the table. As D86 is proportional to 1/bd the table is
+made for a bulk density of 1 and scaled for each site.
+
+"""
+import os
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+# crspy funcs
+from crspy.n0_calibration import WrX, WrA, WrB, D86, rscaled
+"""
+To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
+to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
+"""
+from configparser import RawConfigParser
+nld = RawConfigParser()
+nld.read('config.ini')
+
+# Interpolators for tables already read in, keyed by file location
+_interpolators = {}
+
+
+def footprint_integral(press, hum, sm, rmax=300, nr=601):
+    """footprint_integral finds the radially weighted D86 (for a bulk density of 1) over the
+    footprint by the trapezium rule. Weights are applied per unit area (weight * r) using the
+    same radial weighting functions as the calibration (WrX within 5m, WrA within 50m and
+    WrB beyond).
+
+    Parameters
+    ----------
+    press : float
+        pressure (mb)
+    hum : array
+        absolute air humidity (g/m^3)
+    sm : array
+        soil moisture (m^3/m^3)
+    rmax : float, optional
+        furthest distance from the sensor to integrate to (m), by default 300
+    nr : int, optional
+        number of radii in the integral, by default 601
+
+    Returns
+    -------
+    array
+        footprint D86 (cm) for bd = 1 with the shape of hum and sm broadcast together
+    """
+    r = np.linspace(0, rmax, nr)
+    hum = np.asarray(hum, dtype=float)[..., None]
+    sm = np.asarray(sm, dtype=float)[..., None]
+    rs = rscaled(r, press, 0, sm)
+    weight = np.where(r <= 5, WrX(rs, hum, sm), np.where(r <= 50, WrA(rs, hum, sm), WrB(rs, hum, sm)))
+    weight = weight * r
+    # Trapezium rule on evenly spaced radii, the spacing cancels in the ratio
+    wd = weight * D86(rs, 1, sm)
+    return ((wd[..., 1:] + wd[..., :-1]).sum(axis=-1) /
+            (weight[..., 1:] + weight[..., :-1]).sum(axis=-1))
+
+
+def build_footprint_table(filepath, press=np.arange(500, 1101, 10), hum=np.arange(0, 31, 1),
+                          sm=np.arange(0.01, 0.61, 0.01)):
+    """build_footprint_table calculates footprint_integral on a grid of pressure, humidity and soil
+    moisture and saves it (with the grid) as a .npz file.
+
+    Parameters
+    ----------
+    filepath : str
+        location to save the table e.g. nld['defaultdir']+"/data/footprint/D86_footprint.npz"
+    press : array, optional
+        pressures (mb), by default 500 to 1100 every 10
+    hum : array, optional
+        absolute humidities (g/m^3), by default 0 to 30 every 1
+    sm : array, optional
+        soil moistures (m^3/m^3), by default 0.01 to 0.6 every 0.01
+    """
+    print("Building the footprint D86 table (only needed once)...")
+    hh, ss = np.meshgrid(hum, sm, indexing='ij')
+    table = np.empty((len(press), len(hum), len(sm)))
+    for i, p in enumerate(press):
+        table[i] = footprint_integral(p, hh, ss)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    np.savez(filepath, press=press, hum=hum, sm=sm, d86=table)
+    print("Done")
+
+
+def footprint_d86(press, hum, sm, bd, filepath=None, nld=nld):
+    """footprint_d86 gives the footprint weighted D86 for each hour by interpolating the
+    precomputed table (see build_footprint_table), which is built the first time it is
+    needed. Values outside the table are taken from the edge of the table.
+
+    Parameters
+    ----------
+    press : series or array
+        pressure (mb)
+    hum : series or array
+        absolute air humidity (g/m^3)
+    sm : series or array
+        soil moisture (m^3/m^3)
+    bd : float
+        bulk density (g/cm^3)
+    filepath : str, optional
+        location of the table, by default defaultdir/data/footprint/D86_footprint.npz
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary.
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    array
+        footprint weighted D86 (cm)
+    """
+    nld=nld['config']
+    if filepath is None:
+        filepath = nld['defaultdir']+"/data/footprint/D86_footprint.npz"
+    if filepath not in _interpolators:
+        if not os.path.exists(filepath):
+            build_footprint_table(filepath)
+        table = np.load(filepath)
+        _interpolators[filepath] = RegularGridInterpolator(
+            (table['press'], table['hum'], table['sm']), table['d86'])
+    interp = _interpolators[filepath]
+    grid = interp.grid
+    points = [np.clip(np.asarray(x, dtype=float), g[0], g[-1]) for x, g in zip((press, hum, sm), grid)]
+    points = np.stack(np.broadcast_arrays(*points), axis=-1)
+    out = np.full(points.shape[:-1], np.nan)
+    valid = ~np.isnan(points).any(axis=-1)
+    out[valid] = interp(points[valid])
+    return out / bd
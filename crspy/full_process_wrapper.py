@@ -7,6 +7,7 @@ Created on Mon Jul  6 11:08:09 2020
 Wrapper function to process the data from start to finish
 """
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 # crspy funcs
 from crspy.tidy_data import prepare_data
@@ -16,6 +17,7 @@ from crspy.qa import flag_and_remove
 from crspy.qa import QA_plotting
 from crspy.theta import thetaprocess
 from crspy.gen_funcs import getlistoffiles
+from crspy.era5_land import era5_share, era5_attach, era5_unshare
 
 """
 To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
@@ -27,7 +29,7 @@ nld = RawConfigParser()
 nld.read('config.ini')
 
 
-def process_raw_data(filepath, calibrate=True, calib_start_time=None, calib_end_time=None, intentype=None, agg24=True, useera5=False, use_ah_data=False, theta_method="desilets", nld=nld):
+def process_raw_data(filepath, calibrate=True, calib_start_time=None, calib_end_time=None, intentype=None, agg24=True, useera5=False, use_ah_data=False, theta_method="desilets", inmemory=False, savefiles=True, aggregations=(), completeness=0, uncertainty="numeric", smoothing=None, adaptive=None, footprint=False, montecarlo=None, n0_mode="constant", calib_fit=None, nld=nld):
     """process_raw_data is a function that wraps all the necessary functions to process data. The user can select
     whether to complete n0 calibration (i.e. this may not be required if already done previously). It also gives the option to decide which
     intensity correction method to apply as there are two currently used. If a standard is agreed upon this will adjusted here.
@@ -55,6 +57,37 @@ def process_raw_data(filepath, calibrate=True, calib_start_time=None, calib_end_
         standard method is desilet, added option to use kohli method (see gen funcs - theta_kohli)
     agg24: bool, optional
         default is off, allows a user to request 24 hour aggregated data (for reducing uncertainty)
+    aggregations: iterable, optional
+        further resolutions to aggregate the final data to, any of "6h", "daily", "weekly" or "monthly"
+        (see theta.aggregate), default ()
+    completeness: float, optional
+        minimum fraction (0-1) of valid hours needed in an aggregation window, default 0
+    uncertainty: str, optional
+        how the count error is carried to soil moisture, "numeric", "linear" or "taylor" (see theta.sm_calc),
+        default "numeric"
+    smoothing: str, optional
+        add a smoothed soil moisture column (SM_SMOOTH) using "savgol", "ewma", "wma" or "kalman"
+        (see smoothing.smooth), default None
+    adaptive: float, optional
+        target relative count error (e.g. 0.01) for adaptive length windows written to _final_adaptive.txt
+        (see theta.adaptive_windows), default None
+    footprint: bool, optional
+        add the footprint weighted depth of measurement D86_FOOTPRINT (see footprint.footprint_d86), default False
+    montecarlo: int, optional
+        number of members for Monte Carlo SM uncertainty written to _final_mc.txt (see sensitivity.mc_theta),
+        default None
+    n0_mode: str, optional
+        "constant" uses the calibrated N0 in the metadata, "campaign", "interp" or "linear" use an N0 for each
+        hour from the N0 of each calibration day (see n0_calibration.n0_series), default "constant"
+    calib_fit: tuple, optional
+        fit N0 jointly with "bd" and/or "lw" in the calibration e.g. ("N0", "bd") (see n0_calibration.n0_fit),
+        default None which fits N0 alone
+    inmemory: bool, optional
+        pass each stage's dataframe directly to the next stage rather than re-reading the tables written
+        to the working directory, so the raw data is only parsed once. Default False
+    savefiles: bool, optional
+        write the tidy, level1 and final tables to the working directory, default True. If False the
+        pipeline is run in memory.
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -66,6 +99,10 @@ def process_raw_data(filepath, calibrate=True, calib_start_time=None, calib_end_
         folder structure
     """
     nld=nld['config']
+    if savefiles is False and inmemory is False:
+        print("Tables are not being saved so running in memory.")
+        inmemory = True
+
     if calibrate is True:
         
         m = re.search('/crns_data/raw/(.+?).txt', filepath)
@@ -82,25 +119,90 @@ def process_raw_data(filepath, calibrate=True, calib_start_time=None, calib_end_
 
     if intentype == "nearestGV":
         df, country, sitenum, meta, nmdbstation = prepare_data(
-            filepath, useeradata=useera5, intentype="nearestGV")
+            filepath, useeradata=useera5, intentype="nearestGV", savefile=savefiles)
         print("Processing " + str(country)+"_SITE_"+str(sitenum))
-        df, meta = neutcoeffs(df, country, sitenum, use_ah_data=use_ah_data, nmdbstation=nmdbstation)
+        tidy = df
+        df, meta = neutcoeffs(df, country, sitenum, use_ah_data=use_ah_data, nmdbstation=nmdbstation, savefile=savefiles)
     else:
-        df, country, sitenum, meta = prepare_data(filepath, useeradata=useera5)
+        df, country, sitenum, meta = prepare_data(filepath, useeradata=useera5, savefile=savefiles)
         print("Processing " + str(country)+"_SITE_"+str(sitenum))
-        df, meta = neutcoeffs(df, country, sitenum, use_ah_data=use_ah_data)
+        tidy = df
+        df, meta = neutcoeffs(df, country, sitenum, use_ah_data=use_ah_data, savefile=savefiles)
+
+    if inmemory is True:
+        calibdata = dict(tidy=tidy, lvl1=df)
+    else:
+        calibdata = dict()
 
     if calibrate is True:
         if calib_start_time and calib_end_time:
-            meta, N0 = n0_calib(meta, country, sitenum, defineaccuracy=float(nld['accuracy']), useeradata=useera5, calib_start_time = calib_start_time, calib_end_time = calib_end_time, theta_method=theta_method)
+            meta, N0 = n0_calib(meta, country, sitenum, defineaccuracy=float(nld['accuracy']), useeradata=useera5, calib_start_time = calib_start_time, calib_end_time = calib_end_time, theta_method=theta_method, fit=calib_fit, **calibdata)
         else:
-            meta, N0 = n0_calib(meta, country, sitenum, defineaccuracy=float(nld['accuracy']), useeradata=useera5, theta_method=theta_method)
+            meta, N0 = n0_calib(meta, country, sitenum, defineaccuracy=float(nld['accuracy']), useeradata=useera5, theta_method=theta_method, fit=calib_fit, **calibdata)
     else:
         N0 = meta.loc[(meta.COUNTRY == country) & (
             meta.SITENUM == sitenum), 'N0'].item()
 
-    df = flag_and_remove(df, N0, country, sitenum)
+    df = flag_and_remove(df, N0, country, sitenum, savefile=savefiles)
     df = QA_plotting(df, country, sitenum, nld['defaultdir'])
-    df = thetaprocess(df, meta, country, sitenum, agg24=agg24, theta_method=theta_method)
+    df = thetaprocess(df, meta, country, sitenum, agg24=agg24, theta_method=theta_method, inmemory=inmemory, savefile=savefiles,
+                      aggregations=aggregations, completeness=completeness, uncertainty=uncertainty,
+                      smoothing=smoothing, adaptive=adaptive,
+                      footprint=footprint, montecarlo=montecarlo, n0_mode=n0_mode)
     return df, meta
 
+
+def _process_site(task):
+    """
+    Run process_raw_data for one site (in a worker of process_raw_data_parallel)
+    """
+    filepath, kwargs = task
+    return process_raw_data(filepath, **kwargs)
+
+
+def process_raw_data_parallel(filepaths, workers=None, useera5=False, **kwargs):
+    """process_raw_data_parallel runs process_raw_data for many sites at once in a process pool.
+
+    With useera5 the ERA5-Land variables prepare_data needs are loaded from the site store once,
+    into shared memory (see era5_share), and every worker reads its sites from there rather than
+    each opening and decoding the file.
+
+    Parameters
+    ----------
+    filepaths : list
+        raw data files e.g. nld['defaultdir']+"/data/crns_data/raw/USA_SITE_011.txt"
+    workers : int, optional
+        number of processes, by default None which uses the number of cores
+    useera5 : boolean, optional
+        use ERA5-Land data for the meteorological variables, by default False
+    **kwargs
+        any other arguments of process_raw_data e.g. calibrate=False, theta_method="kohli"
+
+    Returns
+    -------
+    list
+        (df, meta) from process_raw_data for each file in order, (None, None) if a site failed
+    """
+    handle = None
+    if useera5 is True:
+        config = kwargs.get('nld', nld)['config']
+        sites = [re.search('/crns_data/raw/(.+?).txt', filepath).group(1) for filepath in filepaths]
+        handle = era5_share(config['defaultdir']+"/data/era5land/"+config['era5_filename']+".nc", sites=sites,
+                            variables=['temperature', 'dewpoint_temperature', 'pressure', 'snow_water_equiv',
+                                       'precipitation'])
+    kwargs = dict(kwargs, useera5=useera5)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=era5_attach if handle else None,
+                                 initargs=(handle,) if handle else ()) as executor:
+            futures = [executor.submit(_process_site, (filepath, kwargs)) for filepath in filepaths]
+            results = []
+            for filepath, future in zip(filepaths, futures):
+                try:
+                    results.append(future.result())
+                except Exception as err:
+                    print("Failed to process "+filepath+": "+repr(err))
+                    results.append((None, None))
+    finally:
+        if handle is not None:
+            era5_unshare(handle)
+    return results
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Fused correction to soil moisture kernel
+
+neutcoeffs and thetaprocess build the corrected counts, soil moisture and depth of
+measurement as a series of dataframe columns (pv, fawv, fbar, finten, fagb, MOD_CORR,
+MOD_ERR, SM...). This module does the same calculation for a block of records in a single
+pass without the intermediate columns. neutcoeffs/thetaprocess remain the reference
+implementation, see benchmarks/check_fused.py for the comparison with the stage functions
+and benchmarks/bench_fused.py for the timings.
+
+The kernel is pure numpy, working through the records in blocks so the temporary arrays
+stay small. If numba is installed the kernel is instead compiled to a single loop over
+the records.
+
+"""
+import math
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# crspy funcs
+from crspy.sensitivity import site_params
+"""
+To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
+to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
+"""
+from configparser import RawConfigParser
+nld = RawConfigParser()
+nld.read('config.ini')
+
+# Output columns in the order they are returned by the kernel
+FUSEDCOLS = ['MOD_CORR', 'MOD_ERR', 'SM', 'SM_RAW', 'SM_PLUS_ERR', 'SM_MINUS_ERR', 'D86avg']
+
+
+def _theta(method, a0, a1, a2, bd, N, N0, lw, soc):
+    # Same as gen_funcs.theta_calc (method 0) and gen_funcs.theta_kohli (method 1)
+    if method == 0:
+        return ((a0/((N/N0)-a1))-a2-lw-soc)*bd
+    Nmax = N0*((a0+(a1*a2))/a2)
+    ah1 = (a1*a2)/(a0+(a1*a2))
+    return ((-a2*((1-(N/Nmax))/(ah1-(N/Nmax))))-lw-soc)*bd
+
+
+def _fused_block(mod, press, vp, temp, count, ah, c, radii):
+    """
+    numpy kernel for a block of records, c is the array of constants from fused_theta
+    """
+    (pv0, beta, refpres, intenref, rccorr, fagb, method, a0, a1, a2, N0, bd, lw, soc,
+     sm_max, fveg) = c
+    method = int(method)
+    # neutron_correction_funcs: pv (g/m3), humfact, pressfact_B, finten, agb
+    pv = vp/(461.5*(temp+273.15))*1000
+    pv = np.where(np.isnan(pv), ah, pv)
+    corr = mod*np.exp(beta*(press-refpres))*((intenref/count - 1)*rccorr + 1)*(1+0.0054*(pv-pv0))*fagb
+    # Rows with no intensity correction are removed (as in neutcoeffs)
+    corr = np.where(np.isnan(count), np.nan, np.floor(corr))
+    err = np.floor(np.sqrt(mod)/mod*corr)
+
+    sm = _theta(method, a0, a1, a2, bd, corr, N0, lw, soc)
+    plus = np.abs(_theta(method, a0, a1, a2, bd, corr - err, N0, lw, soc) - sm)
+    minus = np.abs(_theta(method, a0, a1, a2, bd, corr + err, N0, lw, soc) - sm)
+    smclip = np.clip(sm, 0, sm_max)
+
+    # n0_calibration: D86 on rscaled radii, averaged
+    Fp = 0.4922/(0.86-np.exp(-press/1013.25))
+    Fveg = 1-fveg*(1+np.exp(-9.25*smclip))
+    d86 = 0
+    for r in radii:
+        rs = r/Fp/Fveg
+        d86 = d86 + 1/bd*(8.321+0.14249*(0.96655+np.exp(-0.01*rs))*(20+smclip)/(0.0429+smclip))
+    d86 = d86/len(radii)
+    return np.stack([corr, err, smclip, sm, np.clip(plus, 0, sm_max), np.clip(minus, 0, sm_max), d86])
+
+
+def _clip(x, lo, hi):
+    # nan passes through
+    if x < lo:
+        return lo
+    if x > hi:
+        return hi
+    return x
+
+
+def _fused_loop(mod, press, vp, temp, count, ah, c, radii, out):
+    """
+    Single loop over the records, compiled with numba when it is installed
+    """
+    (pv0, beta, refpres, intenref, rccorr, fagb, method, a0, a1, a2, N0, bd, lw, soc,
+     sm_max, fveg) = (c[0], c[1], c[2], c[3], c[4], c[5], c[6], c[7], c[8], c[9], c[10],
+                      c[11], c[12], c[13], c[14], c[15])
+    for i in range(len(mod)):
+        if np.isnan(count[i]):
+            for k in range(out.shape[0]):
+                out[k, i] = np.nan
+            continue
+        pv = vp[i]/(461.5*(temp[i]+273.15))*1000
+        if np.isnan(pv):
+            pv = ah[i]
+        corr = mod[i]*math.exp(beta*(press[i]-refpres))*((intenref/count[i] - 1)*rccorr + 1)*(1+0.0054*(pv-pv0))*fagb
+        err = math.sqrt(mod[i])/mod[i]*math.floor(corr) if not np.isnan(corr) else np.nan
+        corr = math.floor(corr) if not np.isnan(corr) else np.nan
+        err = math.floor(err) if not np.isnan(err) else np.nan
+        sm = _theta_jit(method, a0, a1, a2, bd, corr, N0, lw, soc)
+        plus = abs(_theta_jit(method, a0, a1, a2, bd, corr - err, N0, lw, soc) - sm)
+        minus = abs(_theta_jit(method, a0, a1, a2, bd, corr + err, N0, lw, soc) - sm)
+        smclip = _clip_jit(sm, 0.0, sm_max)
+        Fp = 0.4922/(0.86-math.exp(-press[i]/1013.25))
+        Fveg = 1-fveg*(1+math.exp(-9.25*smclip))
+        d86 = 0.0
+        for r in radii:
+            rs = r/Fp/Fveg
+            d86 += 1/bd*(8.321+0.14249*(0.96655+math.exp(-0.01*rs))*(20+smclip)/(0.0429+smclip))
+        out[0, i] = corr
+        out[1, i] = err
+        out[2, i] = smclip
+        out[3, i] = sm
+        out[4, i] = _clip_jit(plus, 0.0, sm_max)
+        out[5, i] = _clip_jit(minus, 0.0, sm_max)
+        out[6, i] = d86/len(radii)
+
+
+_theta_jit = _theta
+_clip_jit = _clip
+if njit is not None:
+    _theta_jit = njit(cache=True)(_theta)
+    _clip_jit = njit(cache=True)(_clip)
+    _fused_loop = njit(cache=True)(_fused_loop)
+
+
+def fused_theta(mod, press, vp, temp, count, beta, refpres, intenref, rccorr, fagb, N0, bd, lw, soc,
+                sm_max, ah=None, theta_method="desilets", hveg=0, radii=(10, 75, 150), blocksize=100000,
+                usenumba=True, nld=nld):
+    """fused_theta corrects the neutron counts and calculates soil moisture (with errors) and
+    the depth of measurement for every record in one pass. Gives the same values as the
+    columns of the same name from neutcoeffs and thetaprocess.
+
+    Parameters
+    ----------
+    mod : series or array
+        neutron count (MOD)
+    press : series or array
+        pressure (mb)
+    vp : series or array
+        vapour pressure (Pascals)
+    temp : series or array
+        temperature (C)
+    count : series or array
+        neutron monitor count (NMDB_COUNT)
+    beta : float
+        beta coefficient (BETA_COEFF)
+    refpres : float
+        reference pressure (REFERENCE_PRESS)
+    intenref : float
+        reference neutron monitor count e.g. jung_ref
+    rccorr : float
+        cutoff rigidity correction (see RcCorr), 1 if the monitor has the nearest GV
+    fagb : float
+        above ground biomass factor (see agb), 1 if unknown
+    N0 : int
+        N0 number
+    bd : float
+        bulk density (g/cm^3)
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon as water equivalent - decimal percent e.g. 0.02
+    sm_max : float
+        maximum soil moisture (porosity)
+    ah : series or array, optional
+        absolute humidity (g/m^3) to use where pv can't be calculated e.g. E_AH, by default None
+    theta_method : str, optional
+        "desilets" or "kohli", by default "desilets"
+    hveg : float, optional
+        height of vegetation (m), by default 0
+    radii : tuple, optional
+        distances from the sensor (m) to average D86 over, by default (10, 75, 150)
+    blocksize : int, optional
+        records per block for the numpy kernel, by default 100000
+    usenumba : bool, optional
+        use the compiled loop if numba is installed, by default True
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary.
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dict
+        arrays of MOD_CORR, MOD_ERR, SM, SM_RAW, SM_PLUS_ERR, SM_MINUS_ERR and D86avg
+    """
+    nld=nld['config']
+    if theta_method not in ("desilets", "kohli"):
+        raise ValueError("theta_method must be 'desilets' or 'kohli'")
+    arrays = [np.ascontiguousarray(x, dtype=float) for x in (mod, press, vp, temp, count)]
+    n = len(arrays[0])
+    if ah is None:
+        ah = np.full(n, np.nan)
+    arrays.append(np.ascontiguousarray(ah, dtype=float))
+    consts = np.array([float(nld['pv0']), beta, refpres, intenref, rccorr, fagb,
+                       0 if theta_method == "desilets" else 1,
+                       float(nld['a0']), float(nld['a1']), float(nld['a2']), N0, bd, lw, soc, sm_max,
+                       0.17*(1-np.exp(-0.41*hveg))], dtype=float)
+    radii = np.asarray(radii, dtype=float)
+
+    out = np.empty((len(FUSEDCOLS), n))
+    if njit is not None and usenumba is True:
+        _fused_loop(*arrays, consts, radii, out)
+    else:
+        for start in range(0, n, blocksize):
+            block = [x[start:start+blocksize] for x in arrays]
+            out[:, start:start+blocksize] = _fused_block(*block, consts, radii)
+    return dict(zip(FUSEDCOLS, out))
+
+
+def fused_process(df, meta, country, sitenum, theta_method="desilets", nmdbref=None, use_ah_data=False, usenumba=True,
+                  nld=nld):
+    """fused_process gives the corrected counts, soil moisture and depth of measurement for a
+    site's tidy data with fused_theta, in place of neutcoeffs and thetaprocess. Site constants
+    are taken from the metadata in the same way (N0 must already be calibrated).
+
+    Parameters
+    ----------
+    df : dataframe
+        tidy data (from prepare_data)
+    meta : dataframe
+        dataframe of metadata
+    country : str
+        country e.g. "USA"
+    sitenum : str
+        sitenum e.g. "011"
+    theta_method : str, optional
+        "desilets" or "kohli", by default "desilets"
+    nmdbref : float, optional
+        reference count of the NMDB station with the nearest GV (intentype="nearestGV"), by default None
+        which uses jung_ref with the cutoff rigidity correction
+    use_ah_data : bool, optional
+        fill missing humidity with E_AH, by default False
+    usenumba : bool, optional
+        use the compiled loop if numba is installed, by default True
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary.
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dataframe
+        df with the fused_theta columns added
+    """
+    site = meta.loc[(meta.COUNTRY == country) & (meta.SITENUM == sitenum)].iloc[0]
+    if nmdbref is None:
+        intenref = float(nld['config']['jung_ref'])
+        rccorr = -0.075*(float(site['GV'])-4.49)+1
+    else:
+        intenref = float(nmdbref)
+        rccorr = 1
+    fagb = 1 if math.isnan(site['AGBWEIGHT']) else 1/(1-(0.009*site['AGBWEIGHT']))
+    params = site_params(meta, country, sitenum, nld=nld)
+    bd, lw, sm_max = params['bd'], params['lw'], params['sm_max']
+    ah = df['E_AH'] if use_ah_data is True and 'E_AH' in df.columns else None
+
+    out = fused_theta(df['MOD'], df['PRESS'], df['VP'], df['TEMP'], df['NMDB_COUNT'],
+                      float(site['BETA_COEFF']), float(site['REFERENCE_PRESS']), intenref, rccorr, fagb,
+                      int(site['N0']), bd, lw, float(site['SOC'])*0.556, sm_max, ah=ah,
+                      theta_method=theta_method, usenumba=usenumba, nld=nld)
+    return df.assign(**out)
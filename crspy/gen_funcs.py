@@ -12,7 +12,12 @@ A collection of functions used in the processing of the data
 """
 import datetime
 import os
+import time
+import threading
+import uuid
+from contextlib import contextmanager
 import re
+import numpy as np
 import pandas as pd
 import math
 """
@@ -83,6 +88,353 @@ def theta_calc(a0, a1, a2, bd, N, N0, lw, wsom):
     return (((a0)/((N/N0)-a1))-(a2)-lw-wsom)*bd
 
 
+def theta_calc_deriv(a0, a1, a2, bd, N, N0):
+    """theta_calc_deriv first and second derivatives of theta_calc with respect to the
+    neutron count. Used to propagate the count error to soil moisture analytically.
+
+    Parameters
+    ----------
+    a0 : float
+        constant
+    a1 : float
+        constant
+    a2 : float
+        constant
+    bd : float
+        bulk density e.g. 1.4 g/cm3
+    N : int
+        Neutron count (corrected)
+    N0 : int
+        N0 number
+
+    Returns
+    -------
+    tuple
+        dtheta/dN and d2theta/dN2
+    """
+    x = (N/N0)-a1
+    d1 = -bd*a0/(N0*x*x)
+    return d1, -2*d1/(N0*x)
+
+
+def theta_kohli_deriv(a0, a1, a2, bd, N, N0):
+    """theta_kohli_deriv first and second derivatives of theta_kohli with respect to the
+    neutron count. Used to propagate the count error to soil moisture analytically.
+
+    Parameters
+    ----------
+    a0 : float
+        constant
+    a1 : float
+        constant
+    a2 : float
+        constant
+    bd : float
+        bulk density e.g. 1.4 g/cm3
+    N : int
+        Neutron count (corrected)
+    N0 : int
+        N0 number
+
+    Returns
+    -------
+    tuple
+        dtheta/dN and d2theta/dN2
+    """
+    Nmax = N0 * ( (a0+(a1*a2)) / (a2) )
+    ah0 = -a2
+    ah1 = (a1*a2)/(a0+(a1*a2))
+    x = ah1 - (N/Nmax)
+    d1 = bd*ah0*(1-ah1)/(Nmax*x*x)
+    return d1, 2*d1/(Nmax*x)
+
+
+# Compact storage types for site tables. Neutron counts are whole numbers so are stored as
+# nullable integers (missing values are held in a mask rather than as nan), flags are stored
+# as uint8 and everything else numeric (meteorological and derived variables) as float32.
+# Counts or flags that have been averaged (e.g. the daily aggregation) are kept as float32.
+COUNTCOLS = ['MOD', 'UNMOD', 'MOD_CORR', 'MOD_ERR', 'MOD_OBS', 'RAIN_OBS']
+FLAGCOLS = ['FLAG', 'pv_derived_qc']
+
+
+def compact_dtypes(df):
+    """compact_dtypes converts a site table to the compact schema: float32 for meteorological
+    and derived variables, nullable Int32 for neutron counts, uint8 for flags and the DT column
+    held once as the DatetimeIndex. This roughly halves the memory needed to hold a table,
+    which matters when a whole network of level1 data is loaded for cross-site analysis.
+
+    The schema is only used for tables loaded with read_table(compact=True) and read_network.
+    The processing stages (prepare_data to thetaprocess) do not use it: they run in float64
+    with a DT column, so a processed table is converted afterwards if it is to be held compact.
+
+    Parameters
+    ----------
+    df : dataframe
+        site table with a DT column (or already indexed by DT)
+
+    Returns
+    -------
+    dataframe
+        the site table in the compact schema
+    """
+    if 'DT' in df.columns:
+        df = df.set_index(pd.DatetimeIndex(pd.to_datetime(df['DT']), name='DT')).drop(columns='DT')
+    dtypes = {}
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_bool_dtype(df[col]):
+            continue
+        if col in COUNTCOLS or col in FLAGCOLS:
+            values = df[col].dropna().to_numpy(dtype=float)
+            if not np.allclose(values, values.round(), rtol=0, atol=1e-6):
+                dtypes[col] = "float32"
+            elif col in COUNTCOLS:
+                dtypes[col] = "Int32"
+            else:
+                # Flags without missing values fit in a plain uint8, otherwise keep a mask
+                dtypes[col] = "uint8" if df[col].notna().all() else "UInt8"
+        else:
+            dtypes[col] = "float32"
+    # Counts are whole numbers already but round so any float noise can't stop the cast
+    counts = [col for col, dt in dtypes.items() if dt != "float32"]
+    if counts:
+        df = df.assign(**{col: df[col].round() for col in counts})
+    return df.astype(dtypes)
+
+
+def full_dtypes(df):
+    """full_dtypes converts a compact site table (see compact_dtypes) back to the layout used
+    by the processing stages: float64 columns with nan for missing data and a DT column.
+    Complete flag columns stay as uint8.
+
+    Parameters
+    ----------
+    df : dataframe
+        site table in the compact schema
+
+    Returns
+    -------
+    dataframe
+        the site table with float64 columns and a DT column
+    """
+    data = {}
+    for col in df.columns:
+        # float32 and the masked integer columns go back to float64 with nan, uint8 flags are kept
+        if df[col].dtype == "float32" or (pd.api.types.is_extension_array_dtype(df[col])
+                                          and pd.api.types.is_numeric_dtype(df[col])):
+            data[col] = df[col].to_numpy(dtype=float, na_value=np.nan)
+        else:
+            data[col] = df[col].to_numpy()
+    out = pd.DataFrame(data, columns=df.columns)
+    if isinstance(df.index, pd.DatetimeIndex):
+        out.insert(0, 'DT', df.index.to_numpy())
+    return out
+
+
+def read_table(filepath, compact=False, nld=nld):
+    """read_table reads a crspy site table (tab seperated) such as the tidy, level1 or final data.
+    Missing data is written to file as the noval value (e.g. -999), this is converted to nan
+    while reading so data is always nan inside crspy. The DT column is read as datetimes.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the table
+        e.g. nld['defaultdir']+"/data/crns_data/final/USA_SITE_011_final.txt"
+    compact : bool, optional
+        return the table in the compact schema (see compact_dtypes), default False
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dataframe
+        the site table
+    """
+    nld=nld['config']
+    if compact is True:
+        # Read straight to float32 so the full size table is never held in memory
+        header = pd.read_csv(filepath, sep="\t", nrows=0).columns
+        dtypes = {col: "float32" for col in header if col != 'DT'}
+        df = pd.read_csv(filepath, sep="\t", na_values=[int(nld['noval'])], dtype=dtypes,
+                         parse_dates=['DT'], index_col='DT')
+        return compact_dtypes(df)
+    # DT is parsed so a table read from file matches the one the processing stages pass on
+    return pd.read_csv(filepath, sep="\t", na_values=[int(nld['noval'])], parse_dates=['DT'])
+
+
+def write_table(df, filepath, nld=nld):
+    """write_table writes a crspy site table in the standard format (tab seperated, no index).
+    This is the only place the processing stages write their output tables so writing can be
+    switched off when running the pipeline in memory. Nan values are written out as the
+    noval value (e.g. -999). Compact tables (see compact_dtypes) are written in the same
+    format as the DT index is written out as the DT column, counts and flags are written as
+    floats (e.g. 0.0).
+
+    Parameters
+    ----------
+    df : dataframe
+        site table to write
+    filepath : str
+        location to write to
+        e.g. nld['defaultdir']+"/data/crns_data/final/USA_SITE_011_final.txt"
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+    """
+    nld=nld['config']
+    if 'DT' not in df.columns and isinstance(df.index, pd.DatetimeIndex):
+        # pandas writes float32 columns at float32 precision (1000.547 rather than 1000.5469970703125)
+        # so only the count and flag columns are converted, to floats as in the level1 tables
+        ints = [col for col in df.columns if df[col].dtype != "float32" and pd.api.types.is_numeric_dtype(df[col])
+                and not pd.api.types.is_bool_dtype(df[col])]
+        df = df.assign(**{col: df[col].to_numpy(dtype=float, na_value=np.nan) for col in ints})
+        df.insert(0, 'DT', df.index.to_numpy())
+    df.to_csv(filepath, header=True, index=False, sep="\t", mode="w", na_rep=str(float(nld['noval'])))
+
+
+@contextmanager
+def file_lock(lockfile, timeout=60):
+    """file_lock holds a lock file while a file shared between processes is read and written,
+    e.g. with file_lock(filepath+".lock"): ... The lock file is made with O_EXCL so only one
+    process can hold it, the others wait. It holds a token unique to the holder and is only
+    removed by that holder. Its modified time is refreshed while it is held so a lock is only
+    taken to be left over from a crash once it hasn't been refreshed for timeout seconds.
+
+    Parameters
+    ----------
+    lockfile : str
+        location of the lock file
+    timeout : float, optional
+        seconds without a refresh after which a lock file is taken to be left over from a crash,
+        by default 60
+    """
+    token = str(os.getpid())+"-"+str(threading.get_ident())+"-"+uuid.uuid4().hex
+
+    def holder(path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    while True:
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, token.encode())
+            os.close(fd)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lockfile) > timeout:
+                    # Move it aside first so only one process removes it, and put it back if a
+                    # new lock was made in the meantime
+                    stale = holder(lockfile)
+                    os.replace(lockfile, lockfile+"."+token)
+                    if holder(lockfile+"."+token) == stale:
+                        os.remove(lockfile+"."+token)
+                    else:
+                        os.replace(lockfile+"."+token, lockfile)
+            except FileNotFoundError:
+                pass
+            time.sleep(0.05)
+
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(timeout/4):
+            if holder(lockfile) == token:
+                os.utime(lockfile)
+    refresher = threading.Thread(target=refresh, daemon=True)
+    refresher.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        refresher.join()
+        if holder(lockfile) == token:
+            os.remove(lockfile)
+
+
+def write_metadata(meta, country, sitenum, timeout=60, nld=nld):
+    """write_metadata saves the row of one site of the metadata into metadata.csv. The file is read
+    again and only the site's row is replaced, under a lock file, so sites processed at the same
+    time in different processes (see process_raw_data_parallel) don't overwrite each other's
+    changes. The file is written to a temporary file and moved into place so it is never read
+    half written.
+
+    Parameters
+    ----------
+    meta : dataframe
+        dataframe of metadata
+    country : str
+        country e.g. "USA"
+    sitenum : str
+        sitenum e.g. "011"
+    timeout : float, optional
+        seconds after which a lock file is taken to be left over from a crash, by default 60
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+    """
+    nld=nld['config']
+    filepath = nld['defaultdir'] + "/data/metadata.csv"
+    with file_lock(filepath + ".lock", timeout=timeout):
+        def issite(table):
+            return ((table['COUNTRY'] == country) &
+                    (pd.to_numeric(table['SITENUM'], errors='coerce') == int(sitenum))).to_numpy()
+        if os.path.exists(filepath):
+            # The other sites as they are in the file now, with this site in its place
+            current = pd.read_csv(filepath)
+            current['SITENUM'] = current.SITENUM.map("{:03}".format)  # Three digits as in meta
+            site = issite(current)
+            pos = np.flatnonzero(site)[0] if site.any() else len(current)
+            pieces = [current.iloc[:pos][~site[:pos]], meta[issite(meta)], current.iloc[pos:][~site[pos:]]]
+            columns = list(meta.columns) + [col for col in current.columns if col not in meta.columns]
+            meta = pd.concat([piece for i, piece in enumerate(pieces) if len(piece) or i == 1],
+                             ignore_index=True)[columns]
+        meta.to_csv(filepath + ".tmp", header=True, index=False, mode='w')
+        os.replace(filepath + ".tmp", filepath)
+
+
+def read_network(level="level1", compact=True, nld=nld):
+    """read_network reads the tables of every site at one processing level into a single dataframe
+    indexed by site and DT, for cross-site analysis. Tables are held in the compact schema by
+    default (see compact_dtypes) so a whole network fits in memory.
+
+    Parameters
+    ----------
+    level : str, optional
+        processing level to read, one of "tidy", "level1" or "final", default "level1"
+    compact : bool, optional
+        hold the tables in the compact schema, default True
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dataframe
+        tables of all sites with a (SITE, DT) index, e.g. df.loc['USA_SITE_011']
+    """
+    ends = {"tidy": "_TIDY.txt", "level1": "_LVL1.txt", "final": "_final.txt"}
+    if level not in ends:
+        raise ValueError("level must be one of "+", ".join(ends))
+    folder = nld['config']['defaultdir']+"/data/crns_data/"+level+"/"
+    tables = {}
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(ends[level]):
+            continue
+        site = filename[:-len(ends[level])]
+        df = read_table(folder+filename, compact=compact, nld=nld)
+        if compact is False:
+            df = df.set_index('DT')
+        tables[site] = df
+    if not tables:
+        raise FileNotFoundError("No "+level+" tables found in "+folder)
+    return pd.concat(tables, names=['SITE', 'DT'])
+
+
 def datechange(year, yday):
     """
     Datechange func takes as arguments year and yday and converts it into a
@@ -8,11 +8,16 @@ Collection for graphical representation of data. Ways to show data.
 """
 
 import os
+import json
+import hashlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import math
 import seaborn as sns
+
+# crspy funcs
+from crspy.gen_funcs import read_table
 """
 To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
 to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
@@ -21,10 +26,127 @@ from configparser import RawConfigParser
 nld = RawConfigParser()
 nld.read('config.ini')
 
-def colourts(country, sitenum, yearlysm, nld=nld):
+# Name of the json file (one per figure folder) storing the hash of the data behind each figure
+FIGCACHE = ".figcache.json"
+
+
+def downsample_minmax(x, y, nbuckets):
+    """downsample_minmax reduces a long time series to the minimum and maximum value found in each
+    of nbuckets equal width buckets. When nbuckets is set to the pixel width of the figure the plotted
+    line is visually the same as plotting every point, but matplotlib only has to draw 2*nbuckets points.
+
+    Buckets that are entirely missing are returned as nan so gaps in the data are still shown.
+
+    Parameters
+    ----------
+    x : array like
+        x values (e.g. datetimes) in plotting order
+    y : array like
+        y values, same length as x
+    nbuckets : int
+        number of buckets, usually the width of the figure in pixels
+
+    Returns
+    -------
+    x, y
+        numpy arrays of the downsampled series
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= 2*nbuckets:
+        return x, y
+    width = int(math.ceil(n / nbuckets))
+    nb = int(math.ceil(n / width))
+    # Pad with nan so the series can be reshaped into buckets
+    ypad = np.concatenate([y, np.full(nb*width - n, np.nan)]).reshape(nb, width)
+    missing = np.isnan(ypad)
+    imin = np.where(missing, np.inf, ypad).argmin(axis=1)
+    imax = np.where(missing, -np.inf, ypad).argmax(axis=1)
+    # Keep the min and max in time order within each bucket
+    start = np.arange(nb) * width
+    idx = np.column_stack([start + np.minimum(imin, imax),
+                           start + np.maximum(imin, imax)]).ravel()
+    return x[idx], y[idx]
+
+
+def figure_hash(data, params=None):
+    """figure_hash gives a hash of the data (and plotting parameters) used to create a figure.
+    If the hash has not changed since the figure was last written it does not need to be redrawn.
+
+    Parameters
+    ----------
+    data : dataframe or series
+        the columns that are plotted
+    params : list, optional
+        any other values that change the look of the figure (titles, dpi etc.), by default None
+
+    Returns
+    -------
+    str
+        hex digest of the hash
+    """
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+def figure_cached(figpath, key):
+    """figure_cached checks whether the figure at figpath exists and was created from data with
+    the same hash as key.
+
+    Parameters
+    ----------
+    figpath : str
+        full path of the figure e.g. nld['defaultdir']+"/data/figures/USA_011/SM_all.png"
+    key : str
+        hash from figure_hash
+
+    Returns
+    -------
+    bool
+        True if the figure is up to date and can be skipped
+    """
+    if not os.path.exists(figpath):
+        return False
+    cachefile = os.path.join(os.path.dirname(figpath), FIGCACHE)
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return cache.get(os.path.basename(figpath)) == key
+
+
+def figure_cache_update(figpath, key):
+    """figure_cache_update records the hash of the data used for the figure at figpath
+
+    Parameters
+    ----------
+    figpath : str
+        full path of the figure
+    key : str
+        hash from figure_hash
+    """
+    cachefile = os.path.join(os.path.dirname(figpath), FIGCACHE)
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = dict()
+    cache[os.path.basename(figpath)] = key
+    with open(cachefile, "w") as f:
+        json.dump(cache, f, indent=1)
+
+
+def colourts(country, sitenum, yearlysm, downsample=True, usecache=True, df=None, nld=nld):
     """
     This function will output a series of plots and figures that can demonstrate
     conditions of a site for easy viewing.
+
+    Long hourly records are downsampled to the min/max of each pixel column before plotting
+    and figures are skipped if the data behind them has not changed since they were written.
     
     PARAMETERS:
         country: string - country as in metadata
@@ -33,6 +155,10 @@ def colourts(country, sitenum, yearlysm, nld=nld):
             e.g. "101"
         yearlysm: boolean - if turned to true it will output yearly 
                             plots of soil moisture for more granular viewing
+        downsample: boolean - downsample series to the figure's pixel width before plotting, default True
+        usecache: boolean - skip figures whose data hash matches the last run, default True
+        df: dataframe - final table of the site (output of thetaprocess), if None it is read
+                        from the final folder, default None
         nld : dictionary
             nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
             This will store variables such as the wd and other global vars
@@ -41,7 +167,6 @@ def colourts(country, sitenum, yearlysm, nld=nld):
     nld=nld['config']
     meta = pd.read_csv(nld['defaultdir'] + "/data/metadata.csv")
     meta['SITENUM'] = meta.SITENUM.map("{:03}".format) # Add leading zeros
-    df = pd.read_csv(nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final.txt", sep="\t")
 
     """
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -62,20 +187,20 @@ def colourts(country, sitenum, yearlysm, nld=nld):
     
     os.chdir(nld['defaultdir']) # Change back to main wd
     print("Done")
+    figfolder = nld['defaultdir']+"/data/figures/"+uniquefolder
+    dpi = 250
     
     sitename = meta.loc[(meta.COUNTRY == country) & (meta.SITENUM == sitenum), 'SITE_NAME'].item()
-    df = pd.read_csv(nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final.txt", sep="\t")
+    if df is None:
+        df = read_table(nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final.txt")
+    else:
+        df = df.reset_index(drop=True)
     ymax = df.SM_12h.max()
     ymaxplus = ymax*1.05
-    df.loc[df.SM_12h == int(nld['noval']), "SM_12h"] = np.nan
-    df.loc[df.MOD_CORR == int(nld['noval']), "MOD_CORR"] = np.nan
-    sm = df['SM_12h']
     dtime = pd.to_datetime(df['DT'], format= "%Y-%m-%d %H:%M:%S") # Create dt series for using in fill_between
+    df['DT'] = dtime
     lower_bound = 0
     
-     #DATETIME INDEXED
-    dfdt = df.set_index(dtime)
-    
     # CREATE COLOUR PALLETE
     #from colour import Color
     #basecol = Color("brown")
@@ -90,56 +215,65 @@ def colourts(country, sitenum, yearlysm, nld=nld):
     steps = ymax/nsteps
     gradrange = list(np.arange(0,ymax, steps))  # Figure 100 steps between min and max water content
     
-    
+    def smplot(dt, sm, title, figpath):
+        """
+        Colour shaded soil moisture plot
+        """
+        figsize = (15,3.75)
+        if downsample == True:
+            dt, sm = downsample_minmax(dt, sm, int(figsize[0]*dpi))
+        fig, ax = plt.subplots(figsize=figsize)
+        ax.plot(dt, sm, lw=0.1, label='Soil Moisture Volumetric (cm$^3$/cm$^3$)', color='black')
+        ax.set_ylabel("Soil Moisture - Volumetric (cm$^3$/cm$^3$)")
+        ax.set_xlabel("Date")
+        ax.set_title(title)
+        ax.set_ylim(lower_bound, ymaxplus) # Xlim to below 0 to allow brown colour to show
+        for i in range(len(colrange2)):
+            ax.fill_between(dt, lower_bound, sm, where=sm > gradrange[i], facecolor=colrange2[i],
+                            alpha=0.2)
+        fig.savefig(figpath, dpi=dpi)
+        plt.close(fig)
+
     #CREATE MOD_CORR PLOT
-    fig, ax = plt.subplots(figsize=(10,2.5))
-    ax.plot(dfdt['MOD_CORR'], lw=0.1, label="Neutron Counts - "+str(sitename)+", "+str(country), color='black')
-    ax.set_title("Neutron Counts - "+str(sitename)+", "+str(country))
-    ax.set_ylabel("Neutron Count")
-    fig.savefig(nld['defaultdir']+"/data/figures/"+uniquefolder+"/MOD_CORR.png", dpi=250)
+    figpath = figfolder+"/MOD_CORR.png"
+    title = "Neutron Counts - "+str(sitename)+", "+str(country)
+    key = figure_hash(df[['DT', 'MOD_CORR']], [title, dpi, downsample])
+    if usecache == True and figure_cached(figpath, key):
+        print("MOD_CORR figure unchanged, skipping")
+    else:
+        figsize = (10,2.5)
+        dt, modcorr = dtime.values, df['MOD_CORR'].values
+        if downsample == True:
+            dt, modcorr = downsample_minmax(dt, modcorr, int(figsize[0]*dpi))
+        fig, ax = plt.subplots(figsize=figsize)
+        ax.plot(dt, modcorr, lw=0.1, label=title, color='black')
+        ax.set_title(title)
+        ax.set_ylabel("Neutron Count")
+        fig.savefig(figpath, dpi=dpi)
+        plt.close(fig)
+        figure_cache_update(figpath, key)
 
-    
     #CREATE COLOUR TS PLOT
-    fig, ax = plt.subplots(figsize=(15,3.75))
-    
-    ax.plot(dfdt['SM_12h'], lw=0.1, label='Soil Moisture Volumetric (cm$^3$/cm$^3$)', color='black')
-    ax.set_ylabel("Soil Moisture - Volumetric (cm$^3$/cm$^3$)")
-    ax.set_xlabel("Date")
-    ax.set_title("Soil Moisture over time at "+str(sitename)+", "+str(country))
-    
-    ax.plot(dtime, sm, lw=0.1, label='Soil Moisture Volumetric (cm$^3$/cm$^3$)', color='black')
-    ax.set_ylim(lower_bound, ymaxplus) # Xlim to below 0 to allow brown colour to show
-    for i in range(len(colrange2)):
-        ax.fill_between(dtime, lower_bound, sm, where=sm > gradrange[i], facecolor=colrange2[i],
-                        alpha=0.2)
-    fig.savefig(nld['defaultdir']+"/data/figures/"+uniquefolder+"/SM_all.png", dpi=250)
-
+    figpath = figfolder+"/SM_all.png"
+    title = "Soil Moisture over time at "+str(sitename)+", "+str(country)
+    key = figure_hash(df[['DT', 'SM_12h']], [title, dpi, downsample])
+    if usecache == True and figure_cached(figpath, key):
+        print("SM_all figure unchanged, skipping")
+    else:
+        smplot(dtime.values, df['SM_12h'].values, title, figpath)
+        figure_cache_update(figpath, key)
 
-    
     if yearlysm == True:
-        df['DT'] = pd.to_datetime(df['DT'])
         df['YEAR'] = df['DT'].dt.year
         years = df['YEAR'].unique()
         
         for year in years:
             tmp = df.loc[df['YEAR'] == year]
-            tmp = tmp.set_index(tmp.DT)
-            dtime=tmp['DT']
-            sm = tmp['SM_12h']
-            steps = ymax/nsteps
-            gradrange = list(np.arange(0,ymax, steps))
-            
-            fig, ax = plt.subplots(figsize=(15,3.75))
-            ax.plot(tmp['SM_12h'], lw=0.1, label='Soil Moisture Volumetric (cm$^3$/cm$^3$)', color='black')
-            ax.set_ylabel("Soil Moisture - Volumetric (cm$^3$/cm$^3$)")
-            ax.set_xlabel("Date")
-            ax.set_title("Soil Moisture over the year "+str(year)+" at "+str(sitename)+", "+str(country))
-            
-            ax.plot(dtime, sm, lw=0.1, label='Soil Moisture Volumetric (cm$^3$/cm$^3$)', color='black')
-            ax.set_ylim(lower_bound, ymaxplus) # Xlim to below 0 to allow brown colour to show
-            for i in range(len(colrange2)):
-                ax.fill_between(dtime, lower_bound, sm, where=sm > gradrange[i], facecolor=colrange2[i],
-                                alpha=0.2)
-            fig.savefig(nld['defaultdir']+"/data/figures/"+uniquefolder+"/SM_year_"+str(year)+".png", dpi=250)
-            plt.close()
-           
\ No newline at end of file
+            figpath = figfolder+"/SM_year_"+str(year)+".png"
+            title = "Soil Moisture over the year "+str(year)+" at "+str(sitename)+", "+str(country)
+            # ymax is taken from the full record so it is part of the key
+            key = figure_hash(tmp[['DT', 'SM_12h']], [title, dpi, downsample, ymax])
+            if usecache == True and figure_cached(figpath, key):
+                continue
+            smplot(tmp['DT'].values, tmp['SM_12h'].values, title, figpath)
+            figure_cache_update(figpath, key)
@@ -18,14 +18,18 @@ References:
 import pandas as pd  # Pandas for dataframe
 import re
 import os
+import json
+import hashlib
 import numpy as np
 import math
 import matplotlib.pyplot as plt
 import warnings
+from scipy.optimize import least_squares
 
 # crspy funcs
 from crspy.neutron_correction_funcs import pv, es, ea
-from crspy.gen_funcs import theta_calc, theta_kohli
+from crspy.gen_funcs import theta_calc, theta_kohli, read_table, write_metadata
+from crspy.sensitivity import mc_sd
 
 # Brought in to stop warning around missing data
 warnings.filterwarnings("ignore", category=RuntimeWarning)
@@ -235,9 +239,302 @@ def rscaled(r, p, Hveg, y):
     return(r / Fp / Fveg)
 
 
-def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_time="16:00:00", calib_end_time="23:00:00", theta_method="desilets", nld=nld):
+def n0_invert(vwc, N, bd, lw, soc, theta_method="desilets", nld=nld):
+    """n0_invert gives the N0 that converts the neutron count N to exactly the soil moisture vwc,
+    i.e. theta_calc (or theta_kohli) solved for N0. Inputs can be arrays.
+
+    Parameters
+    ----------
+    vwc : float
+        soil moisture (m^3/m^3) e.g. the weighted theta of a calibration day
+    N : float
+        corrected neutron count e.g. the average count of a calibration day
+    bd : float
+        bulk density (g/cm^3)
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon - decimal percent e.g, 0.02
+    theta_method : str, optional
+        "desilets" or "kohli", by default "desilets"
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    float
+        N0
+    """
+    nld=nld['config']
+    a0, a1, a2 = float(nld['a0']), float(nld['a1']), float(nld['a2'])
+    if theta_method == "desilets":
+        return N / (a1 + a0/(vwc/bd + a2 + lw + soc))
+    elif theta_method == "kohli":
+        f = vwc/bd + lw + soc
+        ah0 = -a2
+        ah1 = (a1*a2)/(a0+(a1*a2))
+        Nmax = N * (ah0 - f) / (ah0 - f*ah1)
+        return Nmax * a2 / (a0+(a1*a2))
+    raise ValueError("theta_method must be 'desilets' or 'kohli'")
+
+
+def n0_campaigns(filepath, unidate, AvgTheta, avgN, bd, lw, soc, theta_method="desilets"):
+    """n0_campaigns gives the N0 of each calibration day (campaign) on its own using n0_invert.
+    The results are kept in a table (filepath) and a day is only recalculated if its weighted
+    theta, count or site constants have changed, so adding a new calibration day only
+    calculates that day.
+
+    Parameters
+    ----------
+    filepath : str
+        location of the campaign table
+    unidate : array
+        calibration dates
+    AvgTheta : dict
+        weighted theta of each calibration day
+    avgN : dict
+        average corrected count of each calibration day
+    bd : float
+        bulk density (g/cm^3)
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon - decimal percent e.g, 0.02
+    theta_method : str, optional
+        "desilets" or "kohli", by default "desilets"
+
+    Returns
+    -------
+    dataframe
+        DATE, VWC, N_AVG, BD, LW, SOC, METHOD and N0 of each calibration day
+    """
+    rows = pd.DataFrame({'DATE': [str(d) for d in unidate],
+                         'VWC': [AvgTheta[i] for i in range(len(unidate))],
+                         'N_AVG': [avgN[i] for i in range(len(unidate))],
+                         'BD': bd, 'LW': lw, 'SOC': soc, 'METHOD': theta_method})
+    rows['N0'] = np.nan
+    if os.path.exists(filepath):
+        old = pd.read_csv(filepath, dtype={'DATE': str})
+        old = old.set_index('DATE').reindex(rows['DATE'])
+        same = ((old['METHOD'].to_numpy() == theta_method) &
+                np.isclose(old[['VWC', 'N_AVG', 'BD', 'LW', 'SOC']].to_numpy(dtype=float),
+                           rows[['VWC', 'N_AVG', 'BD', 'LW', 'SOC']].to_numpy(dtype=float),
+                           rtol=0, atol=1e-9).all(axis=1))
+        rows.loc[same, 'N0'] = old['N0'].to_numpy()[same]
+    new = rows['N0'].isna()
+    print("N0 per calibration day: "+str(int(new.sum()))+" calculated, "+str(int((~new).sum()))+" unchanged")
+    rows.loc[new, 'N0'] = n0_invert(rows.loc[new, 'VWC'], rows.loc[new, 'N_AVG'], bd, lw, soc,
+                                    theta_method=theta_method)
+    rows = rows.sort_values('DATE').reset_index(drop=True)
+    rows.to_csv(filepath, header=True, index=False, mode='w')
+    return rows
+
+
+def n0_series(dt, campaigns, mode="campaign"):
+    """n0_series gives an N0 for every time step from the N0 of each calibration campaign (see
+    n0_campaigns), so drift in the sensor can be followed.
+
+    Parameters
+    ----------
+    dt : series or array
+        date times to give N0 for (e.g. the DT column)
+    campaigns : dataframe
+        DATE and N0 of each calibration day
+    mode : str, optional
+        "campaign" uses the N0 of the latest campaign (the first campaign before that),
+        "interp" interpolates linearly between campaigns and
+        "linear" fits a straight line through the campaigns. Outside the campaigns N0 is
+        held at the value of the nearest campaign. By default "campaign"
+
+    Returns
+    -------
+    array
+        N0 for each time step
+    """
+    campaigns = campaigns.sort_values('DATE')
+    ct = pd.to_datetime(campaigns['DATE']).to_numpy().astype('datetime64[s]').astype(float)
+    cn0 = campaigns['N0'].to_numpy(dtype=float)
+    t = pd.to_datetime(pd.Series(dt)).to_numpy().astype('datetime64[s]').astype(float)
+    if mode == "campaign":
+        idx = np.clip(np.searchsorted(ct, t, side='right') - 1, 0, len(ct) - 1)
+        return cn0[idx]
+    elif mode == "interp":
+        return np.interp(t, ct, cn0)
+    elif mode == "linear":
+        if len(ct) < 2:
+            return np.full(len(t), cn0[0])
+        slope, intercept = np.polyfit(ct - ct[0], cn0, 1)
+        return intercept + slope*(np.clip(t, ct[0], ct[-1]) - ct[0])
+    raise ValueError("mode must be 'campaign', 'interp' or 'linear'")
+
+
+def n0_fit(vwc, N, bd, lw, soc, fit=("N0",), theta_method="desilets", N0_init=None, bd_sd=None, lw_sd=None,
+           theta_sd=0.02, nld=nld):
+    """n0_fit fits N0 together with (optionally) bulk density and/or an offset to lattice water to the
+    weighted theta of all calibration days at once by bounded least squares. The residuals of
+    all days are evaluated together so a fit takes milliseconds.
+
+    Bulk density and lattice water are only loosely known at many sites (e.g. BD from ISRIC), so
+    if bd_sd or lw_sd are given the metadata value is used as a prior, adding a residual of
+    (value - metadata value)/sd. Without a prior at least as many calibration days as fitted
+    parameters are needed.
+
+    Parameters
+    ----------
+    vwc : array
+        weighted theta of each calibration day
+    N : array
+        average corrected count of each calibration day
+    bd : float
+        bulk density (g/cm^3) from the metadata, the starting value if fitted
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon - decimal percent e.g, 0.02
+    fit : tuple, optional
+        parameters to fit, "N0" plus any of "bd" and "lw", by default ("N0",)
+    theta_method : str, optional
+        "desilets" or "kohli", by default "desilets"
+    N0_init : float, optional
+        starting N0, by default the mean of the N0 of each day on its own (see n0_invert)
+    bd_sd : float, optional
+        uncertainty of the metadata bulk density used as a prior, by default None
+    lw_sd : float, optional
+        uncertainty of the metadata lattice water used as a prior, by default None
+    theta_sd : float, optional
+        uncertainty of the weighted theta of a calibration day (m^3/m^3), by default 0.02
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dict
+        N0, BD and LW (fitted or fixed), the standard deviation of each fitted parameter (N0_SD,
+        BD_SD, LW_SD), the covariance matrix (COV, a dataframe), the residual theta of each day
+        (RESID) and the RMSE
+    """
+    fit = list(fit)
+    if "N0" not in fit or not set(fit) <= {"N0", "bd", "lw"}:
+        raise ValueError("fit must include 'N0' and only 'bd' and 'lw' besides")
+    if theta_method == "desilets":
+        thetafunc = theta_calc
+    elif theta_method == "kohli":
+        thetafunc = theta_kohli
+    else:
+        raise ValueError("theta_method must be 'desilets' or 'kohli'")
+    a0, a1, a2 = float(nld['config']['a0']), float(nld['config']['a1']), float(nld['config']['a2'])
+    vwc = np.asarray(vwc, dtype=float)
+    N = np.asarray(N, dtype=float)
+    if N0_init is None:
+        N0_init = float(np.nanmean(n0_invert(vwc, N, bd, lw, soc, theta_method=theta_method, nld=nld)))
+    priors = {"bd": bd_sd, "lw": lw_sd}
+    nobs = len(vwc) + sum(1 for p in fit if priors.get(p))
+    if nobs < len(fit):
+        raise ValueError("Fitting "+", ".join(fit)+" needs at least "+str(len(fit)) +
+                         " calibration days or a prior (bd_sd/lw_sd)")
+
+    start = {"N0": N0_init, "bd": bd, "lw": 0.0}
+    lower = {"N0": 1.0, "bd": 0.5, "lw": -lw}
+    upper = {"N0": np.inf, "bd": 2.65, "lw": 0.3}
+    # Scale of each parameter so the optimiser steps are comparable
+    scale = {"N0": 1000.0, "bd": 1.0, "lw": 0.01}
+
+    def unpack(x):
+        values = {"N0": N0_init, "bd": bd, "lw": 0.0}
+        values.update(dict(zip(fit, x)))
+        return values
+
+    def residuals(x):
+        v = unpack(x)
+        res = (thetafunc(a0, a1, a2, v["bd"], N, v["N0"], lw + v["lw"], soc) - vwc) / theta_sd
+        prior = [((v["bd"] - bd) / bd_sd) if p == "bd" else (v["lw"] / lw_sd)
+                 for p in fit if priors.get(p)]
+        return np.concatenate([res, prior])
+
+    x0 = np.clip([start[p] for p in fit], [lower[p] for p in fit], [upper[p] for p in fit])
+    out = least_squares(residuals, x0, bounds=([lower[p] for p in fit], [upper[p] for p in fit]),
+                        x_scale=[scale[p] for p in fit])
+    v = unpack(out.x)
+    # Covariance from the jacobian, scaled by the residual variance when there are spare observations
+    J = out.jac
+    cov = np.linalg.pinv(J.T @ J)
+    dof = nobs - len(fit)
+    if dof > 0:
+        cov = cov * max(2 * out.cost / dof, 1.0)
+    cov = pd.DataFrame(cov, index=fit, columns=fit)
+    resid = thetafunc(a0, a1, a2, v["bd"], N, v["N0"], lw + v["lw"], soc) - vwc
+    result = {"N0": v["N0"], "BD": v["bd"], "LW": lw + v["lw"], "COV": cov, "RESID": resid,
+              "RMSE": float(np.sqrt(np.mean(resid**2)))}
+    for p in fit:
+        result[p.upper()+"_SD"] = float(np.sqrt(cov.loc[p, p]))
+    return result
+
+
+def calib_hash(*items):
+    """calib_hash gives a sha256 hash of dataframes and parameters, used to key the calibration cache
+    so a calibration day is only recalculated when its inputs change.
+
+    Parameters
+    ----------
+    *items : dataframes or json serialisable values
+        e.g. the soil samples of a day, the tidy data of that day and a dict of parameters
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    h = hashlib.sha256()
+    for item in items:
+        if isinstance(item, pd.DataFrame):
+            h.update(",".join(map(str, item.columns)).encode())
+            h.update(pd.util.hash_pandas_object(item, index=False).to_numpy().tobytes())
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def calib_window_mean(day, date, col, calib_start_time, calib_end_time):
+    """calib_window_mean gives the mean of a column over the calibration time on a calibration day.
+    Very few sites had no data at time of COSMOS calib - if thats the case the day average is used.
+
+    Parameters
+    ----------
+    day : dataframe
+        data of the calibration day with a DT column
+    date : date
+        calibration date
+    col : str
+        column to average e.g. "PRESS"
+    calib_start_time : str
+        start time of the calibration period e.g. "16:00:00"
+    calib_end_time : str
+        end time of the calibration period e.g. "23:00:00"
+
+    Returns
+    -------
+    float
+        mean value
+    """
+    tmp = day[(day['DT'] > str(date)+' '+str(calib_start_time)) & (day['DT']
+                                                           <= str(date)+' '+str(calib_end_time))]  # COSMOS time of Calib
+    check = float(np.nanmean(tmp[col], axis=0))
+    if np.isnan(check):
+        return float(np.nanmean(day[col], axis=0))
+    return check
+
+
+def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_time="16:00:00", calib_end_time="23:00:00", theta_method="desilets", tidy=None, lvl1=None, usecache=True, fit=None, nld=nld):
     """n0_calib the full calibration process
 
+    The weighted theta, average meteorology and error curve of each calibration day are kept in
+    a cache (_calib_cache.json in the site's n0_calibration folder) keyed by a hash of that day's
+    soil samples, tidy and level 1 data and the parameters. Days that haven't changed are loaded
+    from the cache, so adding a calibration day or changing the accuracy only recalculates the
+    days affected.
+
     Parameters
     ----------
     meta : dataframe
@@ -256,6 +553,18 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
         end time of the calibration period in UTC time e.g."23:00:00" 
     theta_method : str
         choice of method to convert N/N0 to sm. Standard is "desilets" method, with option to choose "kohli" method
+    tidy : dataframe, optional
+        tidy data of the site (output of prepare_data). If None it is read from the tidy folder, by default None
+    lvl1 : dataframe, optional
+        level 1 data of the site (output of neutcoeffs). If None it is read from the level1 folder, by default None
+    usecache : bool, optional
+        load unchanged calibration days from the cache, by default True
+    fit : tuple, optional
+        fit N0 jointly with "bd" and/or "lw" (an offset to lattice water) across the calibration days by
+        least squares (see n0_fit), e.g. ("N0", "bd"). The metadata uncertainties (BD_UC/BD_ISRIC_UC,
+        LW_UC) are used as priors. Fitted values are written to the metadata as BD_FIT and LW_FIT, which
+        are then used in place of BD and LW, and the N0 uncertainty as N0_UC. By default None which
+        finds N0 alone from the summed error curve
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -428,11 +737,13 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
     find the average pressure - obtained from the level 1 data
     """
     # ERROR - if lvl1['DATE'] = NA check formatting (line 163)
-    lvl1 = pd.read_csv(nld['defaultdir'] + "/data/crns_data/tidy/" +
-                       country+"_SITE_" + sitenum+"_TIDY.txt", sep="\t")
-    lvl1['DATE'] = pd.to_datetime(
-        lvl1['DT'], format='%Y/%m/%d')  # Use correct formatting
-    lvl1['DATE'] = lvl1['DATE'].dt.date     # Remove the time portion
+    if tidy is None:
+        tidy = read_table(nld['defaultdir'] + "/data/crns_data/tidy/" +
+                          country+"_SITE_" + sitenum+"_TIDY.txt")
+    dftidy = tidy.reset_index(drop=True)
+    dftidy['DATE'] = pd.to_datetime(
+        dftidy['DT'], format='%Y/%m/%d')  # Use correct formatting
+    dftidy['DATE'] = dftidy['DATE'].dt.date     # Remove the time portion
     
     # if lvl1['E_RH'].mean() == int(nld['noval']):
     #     isrh = False                         #Check if external RH is available
@@ -445,85 +756,47 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
     else:
         isrh = True
     
-    lvl1[lvl1 == int(nld['noval'])] = np.nan
-
     # Creates dictionary of dfs for calibration days found
     dflvl1Days = dict()
     for i in range(numdays):
-        dflvl1Days[i] = lvl1.loc[lvl1['DATE'] == unidate[i]]
-
-    # Create a dict of avg pressure for each Calibday
-    avgP = dict()
-    for i in range(len(dflvl1Days)):
-        tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-        tmp = tmp[(tmp['DT'] > str(unidate[i])+' '+str(calib_start_time)) & (tmp['DT']
-                                                               <= str(unidate[i])+' '+str(calib_end_time))]  # COSMOS time of Calib
-        check = float(np.nanmean(tmp['PRESS'], axis=0))
-
-        if np.isnan(check):
-            tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-            avgP[i] = float(np.nanmean(tmp['PRESS'], axis=0))
-        else:
-            avgP[i] = check
-        # Very few sites had no data at time of COSMOS calib - if thats the case use day average
-
-    avgT = dict()
-    for i in range(len(dflvl1Days)):
-        tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-        tmp = tmp[(tmp['DT'] > str(unidate[i])+' '+str(calib_start_time)) & (tmp['DT']
-                                                               <= str(unidate[i])+' '+str(calib_end_time))]  # COSMOS time of Calib
-        check = float(np.nanmean(tmp['TEMP'], axis=0))
-        # Very few sites had no data at time of COSMOS calib - if thats the case use day average
-        if np.isnan(check):
-            tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-            avgT[i] = float(np.nanmean(tmp['TEMP'], axis=0))
-        else:
-            avgT[i] = check
-    
-    # Introduce flux AH possibility
-    try:
-        avgAH = dict()
-        for i in range(len(dflvl1Days)):
-            tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-            tmp = tmp[(tmp['DT'] > str(unidate[i])+' '+str(calib_start_time)) & (tmp['DT']
-                                                               <= str(unidate[i])+' '+str(calib_end_time))]  # COSMOS time of Calib
-            check = float(np.nanmean(tmp['E_AH_FLUX'], axis=0))
-            # Very few sites had no data at time of COSMOS calib - if thats the case use day average
-            if np.isnan(check):
-                tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-                avgAH[i] = float(np.nanmean(tmp['E_AH_FLUX'], axis=0))
-            else:
-                avgAH[i] = check
-    except:
-        pass
+        dflvl1Days[i] = dftidy.loc[dftidy['DATE'] == unidate[i]]
+
+    # Calibration cache, one entry per calibration date
+    cachefile = nld['defaultdir'] + "/data/n0_calibration/" + uniquefolder + "/" + country + '_SITE_' + sitenum + \
+        '_calib_cache.json'
+    cache = dict()
+    if usecache and os.path.exists(cachefile):
+        with open(cachefile) as f:
+            cache = json.load(f)
+    metcols = ['PRESS', 'TEMP', 'E_RH' if isrh else 'VP']
+    if 'E_AH_FLUX' in dftidy.columns:  # Introduce flux AH possibility
+        metcols.append('E_AH_FLUX')
+    params = {'bd': bd, 'lw': lw, 'soc': soc, 'accuracy': defineaccuracy, 'Hveg': Hveg, 'isrh': isrh,
+              'calib_start_time': calib_start_time, 'calib_end_time': calib_end_time}
+    calibkey = dict()
+    cached = dict()
+    for i in range(numdays):
+        calibkey[i] = calib_hash(dfCalib[i], dflvl1Days[i][['DT'] + metcols], params)
+        entry = cache.get(str(unidate[i]))
+        if entry is not None and entry['key'] == calibkey[i]:
+            cached[i] = entry
 
+    # Create a dict of avg meteorology for each Calibday
+    avgMet = dict()
+    for i in range(numdays):
+        if i in cached:
+            avgMet[i] = cached[i]['MET']
+        else:
+            avgMet[i] = {col: calib_window_mean(dflvl1Days[i], unidate[i], col, calib_start_time, calib_end_time)
+                         for col in metcols}
+    avgP = {i: avgMet[i]['PRESS'] for i in range(numdays)}
+    avgT = {i: avgMet[i]['TEMP'] for i in range(numdays)}
+    if 'E_AH_FLUX' in metcols:
+        avgAH = {i: avgMet[i]['E_AH_FLUX'] for i in range(numdays)}
     if isrh:
-        avgRH = dict()
-        for i in range(len(dflvl1Days)):
-            tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-            tmp = tmp[(tmp['DT'] > str(unidate[i])+' '+str(calib_start_time)) & (tmp['DT']
-                                                               <= str(unidate[i])+' '+str(calib_end_time))]  # COSMOS time of Calib
-            check = float(np.nanmean(tmp['E_RH'], axis=0))
-            # Very few sites had no data at time of COSMOS calib - if thats the case use day average
-            if np.isnan(check):
-                tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-                avgRH[i] = float(np.nanmean(tmp['E_RH'], axis=0))
-            else:
-                avgRH[i] = check
-        
+        avgRH = {i: avgMet[i]['E_RH'] for i in range(numdays)}
     if isrh == False:
-        avgVP = dict()
-        for i in range(len(dflvl1Days)):
-            tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-            tmp = tmp[(tmp['DT'] > str(unidate[i])+' '+str(calib_start_time)) & (tmp['DT']
-                                                               <= str(unidate[i])+' '+str(calib_end_time))]  # COSMOS time of Calib
-            check = float(np.nanmean(tmp['VP'], axis=0))
-            # Very few sites had no data at time of COSMOS calib - if thats the case use day average
-            if np.isnan(check):
-                tmp = pd.DataFrame.from_dict(dflvl1Days[i])
-                avgVP[i] = float(np.nanmean(tmp['VP']))
-            else:
-                avgVP[i] = check
+        avgVP = {i: avgMet[i]['VP'] for i in range(numdays)}
     print("Done")
 
     ##TODO: Introduce a check here to see if data is available
@@ -544,6 +817,10 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
 
     for i in range(len(dflvl1Days)):  # for i in number of calib days...
 
+        if i in cached:
+            AvgTheta[i] = cached[i]['AvgTheta']
+            print("Calibration day "+str(i+1)+" unchanged, loaded from cache")
+            continue
         print("Calibrating to day "+str(i+1)+"...")
         # Assign first calib day df to df1
         df1 = pd.DataFrame.from_dict(dfCalib[i])
@@ -710,10 +987,12 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
     
     """
     print("Finding Optimised N0......")
-    tmp = pd.read_csv(nld['defaultdir'] + '/data/crns_data/level1/' +
-                      country + '_SITE_'+sitenum+'_LVL1.txt', sep='\t')
+    if lvl1 is None:
+        tmp = read_table(nld['defaultdir'] + '/data/crns_data/level1/' +
+                         country + '_SITE_'+sitenum+'_LVL1.txt')
+    else:
+        tmp = lvl1.reset_index(drop=True)
     # Use correct formatting - MAY NEED CHANGING AGAIN DUE TO EXCEL
-    tmp = tmp.replace(int(nld['noval']), np.nan)
     #n_max = tmp['MOD_CORR'].max()
     n_avg = int(np.nanmean(tmp['MOD_CORR']))
     if n_avg >= 4000:
@@ -743,20 +1022,25 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
                        header=True, index=False,  mode='w')
         os.chdir(nld['defaultdir'])  # Change back
 
+    # The error curve also depends on the counts of the day, n_avg and the theta method
+    errkey = dict()
+    for i in range(numdays):
+        errkey[i] = calib_hash(calibkey[i], NeutCount[i][['DT', 'MOD_CORR']], n_avg, theta_method,
+                               [nld['a0'], nld['a1'], nld['a2']])
+        if i in cached and cached[i].get('errkey') != errkey[i]:
+            cached[i] = {k: v for k, v in cached[i].items() if k not in ('errkey', 'avgN', 'RelErr')}
+
     avgN = dict()
     for i in range(len(NeutCount)):
-        # Find the daily mean neutron count for each calibration day
-        tmp = pd.DataFrame.from_dict(NeutCount[i])
-        tmp = tmp[(tmp['DT'] > str(unidate[i])+' '+str(calib_start_time)) & (tmp['DT']
-                                                               <= str(unidate[i])+' '+str(calib_end_time))]  # COSMOS time of Calib
-        check = float(np.nanmean(tmp['MOD_CORR']))
-       # Need another catch to stop errors with missing data
-        if np.isnan(check):
-            # Find the daily mean neutron count for each calibration day
-            tmp = pd.DataFrame.from_dict(NeutCount[i])
-            avgN[i] = float(np.nanmean(tmp['MOD_CORR']))
+        if i in cached and 'avgN' in cached[i]:
+            avgN[i] = cached[i]['avgN']
         else:
-            avgN[i] = check
+            # Find the mean neutron count for each calibration day
+            avgN[i] = calib_window_mean(NeutCount[i], unidate[i], 'MOD_CORR', calib_start_time, calib_end_time)
+
+    # N0 of each calibration day on its own (for time varying N0 in thetaprocess)
+    n0_campaigns(nld['defaultdir'] + "/data/n0_calibration/" + uniquefolder + "/" + country + '_SITE_' + sitenum +
+                 '_N0_campaigns.csv', unidate, AvgTheta, avgN, bd, lw, soc, theta_method=theta_method)
 
     RelerrDict = dict()
     with np.errstate(divide='ignore'):  # prevent divide by 0 error message
@@ -766,29 +1050,17 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
             # Avg theta divided by 100 to be given as decimal
             vwc = AvgTheta[i]
             Nave = avgN[i]  # Taken as average for calibration period
-            sm = pd.DataFrame(columns=['sm'])
-            reler = pd.DataFrame(columns=['RelErr'])
-
-            if theta_method == "desilets":
-                for j in range(len(N0)):
-
-                    sm.loc[j] = theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, Nave, N0.loc[j], lw, soc)
-                    
-                    sm.loc[j] = ((float(nld["a0"]) / ((Nave / N0.loc[j]) -
-                                            float(nld["a1"]))) - float(nld["a2"]) - lw - soc) * bd
-                    tmp = sm.iat[j, 0]
-                    # Accuracy normalised to vwc
-                    # reler.loc[j] = abs((sm.iat[j, 0] - vwc)/vwc)
-                    # Accuracy not normalised to vwc
-                    reler.loc[j] = abs(sm.iat[j, 0] - vwc)
-            elif theta_method == "kohli":
-                for j in range(len(N0)):
-                    sm.loc[j] = theta_kohli(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, Nave, N0.loc[j], lw, soc)
-                    tmp = sm.iat[j, 0]
-                    # Accuracy normalised to vwc
-                    # reler.loc[j] = abs((sm.iat[j, 0] - vwc)/vwc)
-                    # Accuracy not normalised to vwc                    
-                    reler.loc[j] = abs(sm.iat[j, 0] - vwc)
+
+            # Error curve for every N0 at once
+            if i in cached and 'RelErr' in cached[i]:
+                reler = pd.DataFrame({'RelErr': np.asarray(cached[i]['RelErr'], dtype=float)})
+            else:
+                if theta_method == "desilets":
+                    sm = theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, Nave, N0.to_numpy(), lw, soc)
+                elif theta_method == "kohli":
+                    sm = theta_kohli(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, Nave, N0.to_numpy(), lw, soc)
+                # Accuracy not normalised to vwc
+                reler = pd.DataFrame({'RelErr': np.abs(sm - vwc)})
 
             RelerrDict[i] = reler['RelErr']
 
@@ -802,6 +1074,15 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
                          header=True, index=False,  mode='w')
             os.chdir(nld['defaultdir'])  # Change back
 
+    # Update the calibration cache (only the current calibration dates are kept)
+    cache = dict()
+    for i in range(numdays):
+        cache[str(unidate[i])] = {'key': calibkey[i], 'AvgTheta': float(AvgTheta[i]), 'MET': avgMet[i],
+                                  'errkey': errkey[i], 'avgN': avgN[i],
+                                  'RelErr': RelerrDict[i].tolist()}
+    with open(cachefile, 'w') as f:
+        json.dump(cache, f)
+
     """
                         N0 Optimisation
     
@@ -831,11 +1112,33 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
 
     N0 = minindex['N0'].item()
 
+    RFit = ""
+    if fit is not None:
+        print("Fitting "+", ".join(fit)+" across the calibration days...")
+        sd = mc_sd(meta, country, sitenum)
+        jointfit = n0_fit([AvgTheta[i] for i in range(numdays)], [avgN[i] for i in range(numdays)], bd, lw, soc,
+                          fit=fit, theta_method=theta_method, N0_init=N0, bd_sd=sd['bd'] or None,
+                          lw_sd=sd['lw'] or None)
+        N0 = int(round(jointfit['N0']))
+        RFit = "\n\nJoint fit of " + ", ".join(fit) + ": N0 = " + str(N0) + " (sd " + str(round(jointfit['N0_SD'], 1)) + \
+            "), BD = " + str(jointfit['BD']) + ", LW = " + str(jointfit['LW']) + ", RMSE = " + str(jointfit['RMSE']) + \
+            "\nCovariance: \n" + str(jointfit['COV'])
+        print(RFit)
+        meta.loc[(meta['SITENUM'] == sitenum) & (
+            meta['COUNTRY'] == country), 'N0_UC'] = jointfit['N0_SD']
+    # Fitted BD and LW replace the metadata values in later stages (cleared if not fitted)
+    for col, p, value in [('BD_FIT', 'bd', 'BD'), ('LW_FIT', 'lw', 'LW')]:
+        if fit is not None and p in fit:
+            meta.loc[(meta['SITENUM'] == sitenum) & (
+                meta['COUNTRY'] == country), col] = jointfit[value]
+        elif col in meta.columns:
+            meta.loc[(meta['SITENUM'] == sitenum) & (
+                meta['COUNTRY'] == country), col] = np.nan
+
     meta.loc[(meta['SITENUM'] == sitenum) & (
         meta['COUNTRY'] == country), 'N0'] = N0
 
-    meta.to_csv(nld['defaultdir'] + "/data/metadata.csv",
-                header=True, index=False, mode='w')
+    write_metadata(meta, country, sitenum)
 
     plt.plot(totalerror['RelErr'])
     plt.yscale('log')
@@ -867,7 +1170,7 @@ def n0_calib(meta, country, sitenum, defineaccuracy, useeradata, calib_start_tim
     """
 
     N0R = "The optimised N0 is calculated as: \nN0   |  Total Relative Error  \n" + \
-        str(minindex)
+        str(minindex) + RFit
     R1 = "The site calibrated was site number " + sitenum + \
         " in  " + str(country) + " and the name is " + sitename
     if bdunavailable == False:
@@ -40,6 +40,7 @@ from crspy.neutron_correction_funcs import (
     agb,
 )
 from crspy.additional_metadata import nmdb_get
+from crspy.gen_funcs import write_table, write_metadata
 """
 To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
 to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
@@ -49,7 +50,7 @@ nld = RawConfigParser()
 nld.read('config.ini')
 
 
-def neutcoeffs(df, country, sitenum, use_ah_data, nmdbstation=None, nld=nld):
+def neutcoeffs(df, country, sitenum, use_ah_data, nmdbstation=None, savefile=True, nld=nld):
     """neutcoeffs provides the factors to multiply the neutron count by to account for external impacts
 
     Parameters
@@ -62,6 +63,8 @@ def neutcoeffs(df, country, sitenum, use_ah_data, nmdbstation=None, nld=nld):
         sitenume e.g. "011"
     nmdbstation : str, optional
         if not JUNG then here goes the nmdb station code, by default None
+    savefile : bool, optional
+        write the level 1 table to the working directory, by default True
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -79,7 +82,8 @@ def neutcoeffs(df, country, sitenum, use_ah_data, nmdbstation=None, nld=nld):
     meta['SITENUM'] = meta.SITENUM.map(
         "{:03}".format)  # Ensure its three digits
 
-    df = df.replace(int(nld['noval']), np.nan)
+    # Work on a copy so the tidy data passed in is left as it is (it is also used by n0_calib)
+    df = df.copy()
 
     ###############################################################################
     #                    Atmospheric Water Vapour                                 #
@@ -188,13 +192,11 @@ def neutcoeffs(df, country, sitenum, use_ah_data, nmdbstation=None, nld=nld):
     df.loc[df['finten'].isnull(), :] = np.nan
     df = df.set_index(DTstore)
     df['DT'] = df.index
-    df = df.replace(np.nan, int(nld['noval']))
     df = df.round(3)  # decimal place limit
 
     # Save Lvl1 data
-    df.to_csv(nld['defaultdir'] + "/data/crns_data/level1/"+country+"_SITE_" + sitenum+"_LVL1.txt",
-              header=True, index=False, sep="\t",  mode='w')
-    meta.to_csv(nld['defaultdir'] + "/data/metadata.csv",
-                header=True, index=False, mode='w')
+    if savefile:
+        write_table(df, nld['defaultdir'] + "/data/crns_data/level1/"+country+"_SITE_" + sitenum+"_LVL1.txt")
+    write_metadata(meta, country, sitenum)
     print("Done")
     return df, meta
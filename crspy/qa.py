@@ -10,6 +10,11 @@ import pandas as pd
 import numpy as np
 import os
 
+# crspy funcs
+from crspy.graphical_functions import (downsample_minmax, figure_hash, figure_cached,
+                                       figure_cache_update)
+from crspy.gen_funcs import write_table
+
 from configparser import RawConfigParser
 nld = RawConfigParser()
 nld.read('config.ini')
@@ -17,7 +22,7 @@ nld.read('config.ini')
 ###############################################################################
 #                          The flagging                                       #
 ###############################################################################
-def flag_and_remove(df, N0, country, sitenum, nld=nld):
+def flag_and_remove(df, N0, country, sitenum, savefile=True, nld=nld):
     """flag_and_remove identifies data that should be flagged based on the following criteria and removes it:
     Flags:
         1 = fast neutron counts more than 20% difference to previous count
@@ -36,6 +41,8 @@ def flag_and_remove(df, N0, country, sitenum, nld=nld):
         string of country e.g. "USA"
     sitenum : str
         string o sitenum e.g. "011"
+    savefile : bool, optional
+        write the flagged table to the final folder, by default True
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -64,14 +71,14 @@ def flag_and_remove(df, N0, country, sitenum, nld=nld):
     df2.loc[df2.MOD_CORR > (N0 * 1.075), "FLAG"] = 3
     df = df.drop(df[df.MOD_CORR > (N0 * 1.075)].index)   # drop above N0
 
-    df2.loc[(df2.MOD_CORR < (N0*(int(nld['belowN0'])/100))) &
-            (df2.MOD_CORR != int(nld['noval'])), "FLAG"] = 2
-    # drop below 0.3 N0
-    df = df.drop(df[df.MOD_CORR < (N0*(int(nld['belowN0'])/100))].index)
+    df2.loc[df2.MOD_CORR < (N0*(int(nld['belowN0'])/100)), "FLAG"] = 2
+    # drop below 0.3 N0 (missing values are dropped too so timestep differences are taken
+    # between the remaining observations)
+    df = df.drop(df[(df.MOD_CORR < (N0*(int(nld['belowN0'])/100))) | (df.MOD_CORR.isna())].index)
    # df = df.reset_index(drop=True)
 
-    df2.loc[(df2.BATT < 10) & (df2.BATT != int(nld['noval'])), "FLAG"] = 4
-    df = df.drop(df[df.BATT < 10].index)
+    df2.loc[df2.BATT < 10, "FLAG"] = 4
+    df = df.drop(df[(df.BATT < 10) | (df.BATT.isna())].index)
 
    # df = df.reset_index(drop=True)
     # Drop >20% diff in timestep
@@ -114,7 +121,6 @@ def flag_and_remove(df, N0, country, sitenum, nld=nld):
 
     # Fill in master time again after removing
     # Need this to handle below code
-    df.replace(int(nld['noval']), np.nan, inplace=True)
     df['DT'] = pd.to_datetime(df['DT'], format="%Y-%m-%d %H:%M:%S")
     df = df.set_index(df.DT)
     df = df.reindex(idx, fill_value=np.nan)
@@ -139,10 +145,8 @@ def flag_and_remove(df, N0, country, sitenum, nld=nld):
     df['DEWPOINT_TEMP'] = tmpdp
     df['SWE'] = tmpswe
 
-    df = df.replace(np.nan, int(nld['noval']))
-
-    df.to_csv(nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_" + sitenum+"_final.txt",
-              header=True, index=False, sep="\t", mode='w')
+    if savefile:
+        write_table(df, nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_" + sitenum+"_final.txt")
     print("Done")
     return df
 
@@ -151,7 +155,7 @@ def flag_and_remove(df, N0, country, sitenum, nld=nld):
 ###############################################################################
 
 
-def tseriesplots(var, df, defaultdir, country, sitenum):
+def tseriesplots(var, df, defaultdir, country, sitenum, downsample=True, usecache=True):
     """tseriesplots creates time series plots of variables in df for visual checks
 
     Parameters
@@ -166,16 +170,28 @@ def tseriesplots(var, df, defaultdir, country, sitenum):
         country e.g. "USA"
     sitenum : str
         sitenum e.g. "011"
+    downsample : bool, optional
+        plot the min/max of each pixel column rather than every point, by default True
+    usecache : bool, optional
+        skip the plot if the data is unchanged since it was last written, by default True
     
     """
-    x = df['DT']
-    y = df[var]
-    plt.figure(var, figsize=(10, 5))
+    figsize = (10, 5)
+    dpi = 250
+    figpath = defaultdir+"/data/qa/"+country + "_SITE_"+sitenum+"/"+var+".png"
+    key = figure_hash(df[['DT', var]], [var, dpi, downsample])
+    if usecache == True and figure_cached(figpath, key):
+        return
+    x = df['DT'].values
+    y = df[var].values
+    if downsample == True:
+        x, y = downsample_minmax(x, y, int(figsize[0]*dpi))
+    plt.figure(var, figsize=figsize)
     plt.title(var, fontsize=16)
     plt.plot(x, y, marker='o', markersize=0.3,  color='r', linewidth=0.3)
-    plt.savefig(defaultdir+"/data/qa/"+country +
-                "_SITE_"+sitenum+"/"+var+".png", dpi=250)
+    plt.savefig(figpath, dpi=dpi)
     plt.close()
+    figure_cache_update(figpath, key)
 
 
 def QA_plotting(df, country, sitenum, defaultdir, nld=nld):
@@ -199,14 +215,14 @@ def QA_plotting(df, country, sitenum, defaultdir, nld=nld):
     nld=nld['config']
     print("~~~~~~~~~~~~~ Plotting QA Graphs ~~~~~~~~~~~~~")
     print("Saving plots...")
-    # set error to nan values for plotting
-    df = df.replace(int(nld['noval']), np.nan)
-    df['YEAR'] = df['DT'].dt.year
-    df['MONTH'] = df['DT'].dt.month
-    df['DAY'] = df['DT'].dt.day
+    # Dates are kept in a seperate table so df is not changed
+    dfdate = pd.DataFrame({'DT': df['DT'], 'YEAR': df['DT'].dt.year,
+                           'MONTH': df['DT'].dt.month, 'DAY': df['DT'].dt.day})
     # Reduce the size to include the variables to be compared - otherwise it's far too big
-    dfcomp = pd.DataFrame(df, columns=["MOD", "UNMOD", "YEAR", "MONTH", "DAY", "PRESS", "finten", "fbar", "fawv", "TEMP",  # !!!
-                                       "BATT", "I_TEMP", "I_RH"])
+    dfcomp = df.reindex(columns=["MOD", "UNMOD", "YEAR", "MONTH", "DAY", "PRESS", "finten", "fbar", "fawv", "TEMP",  # !!!
+                                 "BATT", "I_TEMP", "I_RH"])
+    for col in ['YEAR', 'MONTH', 'DAY']:
+        dfcomp[col] = dfdate[col]
 
     # Folder Housekeeping - create if not already there
     # Create a folder name for output
@@ -230,9 +246,9 @@ def QA_plotting(df, country, sitenum, defaultdir, nld=nld):
     plt.close()
 
     # Plot the day/year/month - check for down time
-    tseriesplots("YEAR", df, defaultdir, country, sitenum)
-    tseriesplots("MONTH", df, defaultdir, country, sitenum)
-    tseriesplots("DAY", df, defaultdir, country, sitenum)
+    tseriesplots("YEAR", dfdate, defaultdir, country, sitenum)
+    tseriesplots("MONTH", dfdate, defaultdir, country, sitenum)
+    tseriesplots("DAY", dfdate, defaultdir, country, sitenum)
 
     # Plot MOD
     tseriesplots("MOD", df, defaultdir, country, sitenum)
@@ -274,7 +290,5 @@ def QA_plotting(df, country, sitenum, defaultdir, nld=nld):
         tseriesplots("I_RH", df, defaultdir, country, sitenum)
     except:
         print("No I_RH data")
-    df = df.drop(['YEAR', 'MONTH', 'DAY'], axis=1)
-    df = df.replace(np.nan, int(nld['noval']))
     print("Done")
     return df
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Sensitivity of soil moisture to the theta parameters
+
+Re-running process_raw_data to see the effect of a different N0, bulk density, lattice
+water or a0/a1/a2 re-reads the raw data and calls external services. The functions here
+start from a site's corrected counts (e.g. MOD_CORR from the level1 or final table) and
+calculate soil moisture for a whole ensemble of parameter sets at once, giving an
+(ensemble x time) array.
+
+mc_theta uses the same idea for Monte Carlo uncertainty: the site constants and the
+neutron counts are sampled together and the soil moisture quantiles are kept for each hour.
+
+"""
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# crspy funcs
+from crspy.gen_funcs import theta_calc, theta_kohli
+"""
+To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
+to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
+"""
+from configparser import RawConfigParser
+nld = RawConfigParser()
+nld.read('config.ini')
+
+# Parameters of the theta functions that can be varied
+PARAMS = ['a0', 'a1', 'a2', 'N0', 'bd', 'lw', 'soc']
+
+
+def site_params(meta, country, sitenum, nld=nld):
+    """site_params gives the theta parameters of a site from the metadata, the same values
+    that thetaprocess uses (BD falls back to BD_ISRIC, BD_FIT and LW_FIT from a joint calibration
+    are used if present, SOC is converted to water equivalent and SM_MAX falls back to the porosity
+    from bulk density).
+
+    Parameters
+    ----------
+    meta : dataframe
+        dataframe of metadata
+    country : str
+        country e.g. "USA"
+    sitenum : str
+        sitenum e.g. "011"
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary.
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dict
+        a0, a1, a2, N0, bd, lw, soc and sm_max
+    """
+    nld=nld['config']
+    site = meta.loc[(meta.COUNTRY == country) & (meta.SITENUM == sitenum)].iloc[0]
+    bd = float(site['BD']) if 'BD' in site.index else np.nan
+    if math.isnan(bd):
+        bd = float(site['BD_ISRIC'])
+    if 'BD_FIT' in site.index and not math.isnan(float(site['BD_FIT'])):
+        bd = float(site['BD_FIT'])
+    lw = float(site['LW_FIT']) if 'LW_FIT' in site.index and not math.isnan(float(site['LW_FIT'])) else float(site['LW'])
+    sm_max = float(site['SM_MAX']) if 'SM_MAX' in site.index else np.nan
+    if math.isnan(sm_max):
+        sm_max = 1-(bd/(float(nld['density'])))
+    return {'a0': float(nld['a0']), 'a1': float(nld['a1']), 'a2': float(nld['a2']),
+            'N0': float(site['N0']), 'bd': bd, 'lw': lw,
+            'soc': float(site['SOC'])*0.556, 'sm_max': sm_max}
+
+
+def param_grid(**values):
+    """param_grid makes every combination of the given parameter values, one row per ensemble
+    member, for use with theta_sweep.
+
+    e.g. param_grid(N0=[2000, 2100, 2200], bd=[1.2, 1.4], method=["desilets", "kohli"])
+
+    Returns
+    -------
+    dataframe
+        a column per parameter
+    """
+    return pd.DataFrame(list(itertools.product(*values.values())), columns=list(values))
+
+
+def theta_sweep(N, params, defaults=None, sm_max=None, nld=nld):
+    """theta_sweep calculates soil moisture from corrected counts for a batch of parameter sets
+    at once. Each parameter is broadcast against the counts so the result is an
+    (ensemble x time) array, calculated with theta_calc or theta_kohli.
+
+    Parameters
+    ----------
+    N : series or array
+        corrected neutron counts, e.g. MOD_CORR of the level1 table
+    params : dataframe or dict
+        a column (or array) per parameter being varied, one row per ensemble member. Any of
+        a0, a1, a2, N0, bd, lw, soc (water equivalent) and method ("desilets" or "kohli")
+    defaults : dict, optional
+        values of the parameters not in params e.g. from site_params, a0/a1/a2 default to the config
+    sm_max : float, optional
+        if given soil moisture is constrained to be between 0 and sm_max, by default None
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary.
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    array
+        soil moisture with shape (ensemble, time)
+    """
+    nld=nld['config']
+    params = pd.DataFrame(params)
+    values = {'a0': float(nld['a0']), 'a1': float(nld['a1']), 'a2': float(nld['a2'])}
+    if defaults is not None:
+        values.update({k: v for k, v in defaults.items() if k in PARAMS})
+    missing = [p for p in PARAMS if p not in params.columns and p not in values]
+    if missing:
+        raise ValueError("No value given for "+", ".join(missing))
+    N = np.asarray(N, dtype=float)[None, :]
+
+    methods = params['method'].to_numpy() if 'method' in params.columns else np.full(len(params), "desilets")
+    if not np.isin(methods, ["desilets", "kohli"]).all():
+        raise ValueError("method must be 'desilets' or 'kohli'")
+    sm = np.empty((len(params), N.shape[1]))
+    for method, thetafunc in [("desilets", theta_calc), ("kohli", theta_kohli)]:
+        members = methods == method
+        if not members.any():
+            continue
+        # (members x 1) columns broadcast against the (1 x time) counts
+        args = {p: params.loc[members, p].to_numpy(dtype=float)[:, None] if p in params.columns else values[p]
+                for p in PARAMS}
+        sm[members] = thetafunc(args['a0'], args['a1'], args['a2'], args['bd'], N, args['N0'],
+                                args['lw'], args['soc'])
+    if sm_max is not None:
+        sm = np.clip(sm, 0, sm_max)
+    return sm
+
+
+def mc_sd(meta, country, sitenum):
+    """mc_sd gives the standard deviations of the site constants for mc_theta from the metadata.
+    Columns BD_UC, SOC_UC and N0_UC (standard deviations in the units of the value) are used if
+    present. Otherwise bulk density and SOC come from BD_ISRIC_UC and SOC_ISRIC_UC (from
+    fill_metadata). These are the SoilGrids uncertainty, the width of the 90% prediction interval
+    over the median (x10), stored with the unit conversion of the value (/100 for BD, /1000 for
+    SOC). They are converted to a standard deviation of a normal distribution as
+    value * width/median / (2 * 1.645).
+
+    Nothing in crspy gives an uncertainty for lattice water so it is fixed (0) unless an LW_UC
+    column is added to the metadata. Anything missing is 0, i.e. not varied.
+
+    Parameters
+    ----------
+    meta : dataframe
+        dataframe of metadata
+    country : str
+        country e.g. "USA"
+    sitenum : str
+        sitenum e.g. "011"
+
+    Returns
+    -------
+    dict
+        standard deviations of N0, bd, lw and soc (water equivalent)
+    """
+    site = meta.loc[(meta.COUNTRY == country) & (meta.SITENUM == sitenum)].iloc[0]
+
+    def value(*cols):
+        for col in cols:
+            if col in site.index and not pd.isna(site[col]):
+                return float(site[col])
+        return np.nan
+
+    def sd(col, isric, scale, *values):
+        # scale undoes the unit conversion fill_metadata applied to the SoilGrids uncertainty
+        if not math.isnan(value(col)):
+            return value(col)
+        ratio = value(isric) * scale / 10
+        out = value(*values) * ratio / (2 * 1.645)
+        return 0.0 if math.isnan(out) else out
+    return {'N0': sd('N0_UC', None, 0), 'bd': sd('BD_UC', 'BD_ISRIC_UC', 100, 'BD', 'BD_ISRIC'),
+            'lw': sd('LW_UC', None, 0), 'soc': sd('SOC_UC', 'SOC_ISRIC_UC', 1000, 'SOC', 'SOC_ISRIC')*0.556}
+
+
+def _mc_chunk(task):
+    """
+    Soil moisture quantiles for one chunk of hours (run in a worker when parallel)
+    """
+    mod, modcorr, n0, members, seed, quantiles, theta_method, sm_max = task
+    valid = ~np.isnan(mod) & ~np.isnan(modcorr) & (mod > 0)
+    rng = np.random.default_rng(seed)
+    # Poisson counts scaled by each hour's correction factor
+    counts = rng.poisson(np.where(valid, mod, 0), size=(len(members['bd']), len(mod)))
+    factor = np.where(valid, modcorr, 0) / np.where(valid, mod, 1)
+    # Each member's N0 is a deviation from the N0 of each hour
+    N0 = np.maximum(n0[None, :] + members['N0'][:, None], 0)
+    thetafunc = theta_calc if theta_method == "desilets" else theta_kohli
+    sm = thetafunc(members['a0'], members['a1'], members['a2'], members['bd'][:, None], counts*factor,
+                   N0, members['lw'][:, None], members['soc'][:, None])
+    if sm_max is not None:
+        sm = np.clip(sm, 0, sm_max)
+    q = np.quantile(sm, quantiles, axis=0)
+    q[:, ~valid] = np.nan
+    return q
+
+
+def mc_theta(mod, modcorr, params, sd, nmembers=1000, quantiles=(0.05, 0.5, 0.95), chunksize=1000,
+             theta_method="desilets", sm_max=None, seed=None, workers=None, nld=nld):
+    """mc_theta Monte Carlo soil moisture uncertainty. Each ensemble member has its own N0, bulk
+    density, lattice water and SOC drawn from normal distributions (truncated at 0) and every
+    hour's count is drawn from a Poisson distribution around MOD, so the uncertainties are
+    sampled jointly. Only the quantiles of each hour are kept.
+
+    The hours are worked through in chunks so memory is bounded by nmembers x chunksize
+    whatever the length of the record, and the chunks can be spread over a process pool.
+    Random numbers for each chunk come from their own SeedSequence child so the results
+    are the same with or without workers.
+
+    Parameters
+    ----------
+    mod : series or array
+        uncorrected neutron count (MOD)
+    modcorr : series or array
+        corrected neutron count (MOD_CORR)
+    params : dict
+        mean values of N0, bd, lw and soc (water equivalent) e.g. from site_params. N0 can also
+        be an array with an N0 for each hour (see n0_series)
+    sd : dict
+        standard deviations of N0, bd, lw and soc e.g. from mc_sd, missing are 0
+    nmembers : int, optional
+        number of ensemble members, by default 1000
+    quantiles : tuple, optional
+        quantiles to give for each hour, by default (0.05, 0.5, 0.95)
+    chunksize : int, optional
+        hours per chunk, by default 1000
+    theta_method : str, optional
+        "desilets" or "kohli", by default "desilets"
+    sm_max : float, optional
+        if given soil moisture is constrained to be between 0 and sm_max, by default None
+    seed : int, optional
+        seed for reproducible results, by default None
+    workers : int, optional
+        number of processes to use, by default None which runs in this process
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary.
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dataframe
+        a column per quantile e.g. SM_Q5, SM_Q50, SM_Q95
+    """
+    nld=nld['config']
+    if theta_method not in ("desilets", "kohli"):
+        raise ValueError("theta_method must be 'desilets' or 'kohli'")
+    mod = np.asarray(mod, dtype=float)
+    modcorr = np.asarray(modcorr, dtype=float)
+    quantiles = np.asarray(quantiles, dtype=float)
+    nchunks = max(1, math.ceil(len(mod) / chunksize))
+    seeds = np.random.SeedSequence(seed).spawn(nchunks + 1)
+
+    rng = np.random.default_rng(seeds[0])
+    n0 = np.broadcast_to(np.asarray(params['N0'], dtype=float), mod.shape)
+    members = {'a0': float(nld['a0']), 'a1': float(nld['a1']), 'a2': float(nld['a2']),
+               'N0': rng.normal(0, sd.get('N0', 0), nmembers)}
+    for p in ['bd', 'lw', 'soc']:
+        members[p] = np.maximum(rng.normal(params[p], sd.get(p, 0), nmembers), 0)
+
+    tasks = ((mod[i*chunksize:(i+1)*chunksize], modcorr[i*chunksize:(i+1)*chunksize],
+              n0[i*chunksize:(i+1)*chunksize], members,
+              seeds[i+1], quantiles, theta_method, sm_max) for i in range(nchunks))
+    if workers is None:
+        out = [_mc_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            out = list(executor.map(_mc_chunk, tasks))
+    out = np.concatenate(out, axis=1)
+    return pd.DataFrame({"SM_Q"+format(q*100, "g"): row for q, row in zip(quantiles, out)})
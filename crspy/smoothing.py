@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Smoothing filters for soil moisture time series
+
+The hourly soil moisture record has gaps (removed or missing counts) so standard filters,
+such as scipy's savgol_filter, can't be used directly. The filters here use only the valid
+data and all run in linear time over the record. Values are only returned where there
+is an observation, gaps are left as nan.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+def savgol_nan(y, window=13, polyorder=4, min_periods=None):
+    """savgol_nan Savitzky-Golay filter for data with nan values. A polynomial is fitted by
+    least squares to the valid values in the window around each point and evaluated at
+    that point. With no missing data this is the same as scipy.signal.savgol_filter.
+
+    The least squares sums for every window are found with one convolution per power of
+    the time offset, so the cost is linear in the length of the record.
+
+    Parameters
+    ----------
+    y : series or array
+        values to smooth e.g. SM
+    window : int, optional
+        window length (odd number of time steps), by default 13
+    polyorder : int, optional
+        order of the fitted polynomial, by default 4
+    min_periods : int, optional
+        minimum valid values in a window to fit, by default polyorder + 1
+
+    Returns
+    -------
+    array
+        smoothed values
+    """
+    if window % 2 == 0 or window <= polyorder:
+        raise ValueError("window must be odd and larger than polyorder")
+    if min_periods is None:
+        min_periods = polyorder + 1
+    min_periods = max(min_periods, polyorder + 1)
+    y = np.asarray(y, dtype=float)
+    valid = ~np.isnan(y)
+    mask = valid.astype(float)
+    yv = np.where(valid, y, 0)
+    half = window // 2
+    # Scale the offset to -1..1 to keep the normal equations well conditioned
+    t = np.arange(-half, half + 1) / half
+
+    def windowsum(x, k):
+        # sum over the window of x * t**k centred on each point
+        return np.convolve(x, (t**k)[::-1], mode='same')
+
+    moments = np.stack([windowsum(mask, k) for k in range(2*polyorder + 1)], axis=-1)
+    rhs = np.stack([windowsum(yv, k) for k in range(polyorder + 1)], axis=-1)
+    # Normal equations: A[i, j] = sum(t**(i+j)) over the valid values in the window
+    powers = np.add.outer(np.arange(polyorder + 1), np.arange(polyorder + 1))
+    A = moments[:, powers]
+
+    nvalid = moments[:, 0]
+    fit = valid & (nvalid >= min_periods)
+    # Windows with gaps can still be singular (e.g. all points on one side), skip those
+    A = A[fit]
+    ok = np.abs(np.linalg.det(A)) > 1e-12
+    coef = np.linalg.solve(A[ok], rhs[fit][ok][..., None])[..., 0]
+    out = np.full(len(y), np.nan)
+    out[np.flatnonzero(fit)[ok]] = coef[:, 0]
+    return out
+
+
+def ewma_nan(y, span=12):
+    """ewma_nan exponentially weighted moving average that skips nan values. Weights decay
+    with time steps, so the values before a gap count for less after it.
+
+    Parameters
+    ----------
+    y : series or array
+        values to smooth e.g. SM
+    span : float, optional
+        decay in time steps (alpha = 2/(span+1)), by default 12
+
+    Returns
+    -------
+    array
+        smoothed values
+    """
+    y = np.asarray(y, dtype=float)
+    out = pd.Series(y).ewm(span=span, ignore_na=False).mean().to_numpy(copy=True)
+    out[np.isnan(y)] = np.nan
+    return out
+
+
+def weighted_ma(y, var, window=12, min_periods=6):
+    """weighted_ma moving average with each value weighted by its inverse variance, so hours with
+    low counts (large Poisson error) count for less. Uses rolling sums so is linear in the
+    length of the record.
+
+    Parameters
+    ----------
+    y : series or array
+        values to smooth e.g. SM
+    var : series or array
+        variance of each value e.g. from the SM error
+    window : int, optional
+        window length (time steps), by default 12
+    min_periods : int, optional
+        minimum valid values in a window, by default 6
+
+    Returns
+    -------
+    array
+        smoothed values
+    """
+    y = np.asarray(y, dtype=float)
+    var = np.asarray(var, dtype=float)
+    w = 1 / var
+    valid = ~np.isnan(y) & np.isfinite(w) & (w > 0)
+    w = np.where(valid, w, 0)
+    wy = pd.Series(np.where(valid, y*w, 0)).rolling(window, center=True, min_periods=1).sum()
+    wsum = pd.Series(w).rolling(window, center=True, min_periods=1).sum()
+    nvalid = pd.Series(valid.astype(float)).rolling(window, center=True, min_periods=1).sum()
+    out = (wy / wsum).to_numpy(copy=True)
+    out[(nvalid < min_periods).to_numpy() | ~valid] = np.nan
+    return out
+
+
+def kalman_smooth(y, var, q=1e-5):
+    """kalman_smooth Kalman filter and Rauch-Tung-Striebel smoother for a local level (random
+    walk) model. Each observation has its own variance, e.g. from the Poisson error of the
+    neutron count, so noisy hours are trusted less. Gaps are handled by skipping the update
+    step.
+
+    Parameters
+    ----------
+    y : series or array
+        values to smooth e.g. SM
+    var : series or array
+        observation variance of each value
+    q : float, optional
+        variance of the change in the level per time step, by default 1e-5
+
+    Returns
+    -------
+    array
+        smoothed values
+    """
+    y = np.asarray(y, dtype=float)
+    var = np.asarray(var, dtype=float)
+    n = len(y)
+    valid = ~np.isnan(y) & np.isfinite(var) & (var > 0)
+    out = np.full(n, np.nan)
+    if not valid.any():
+        return out
+    xf = np.empty(n)  # filtered level
+    pf = np.empty(n)  # filtered variance
+    first = np.argmax(valid)
+    x, p = y[first], var[first]
+    for i in range(first, n):
+        if i > first:
+            p = p + q
+        if valid[i]:
+            gain = p / (p + var[i])
+            x = x + gain * (y[i] - x)
+            p = (1 - gain) * p
+        xf[i] = x
+        pf[i] = p
+    xs = xf.copy()
+    for i in range(n - 2, first - 1, -1):
+        gain = pf[i] / (pf[i] + q)
+        xs[i] = xf[i] + gain * (xs[i + 1] - xf[i])
+    out[first:] = xs[first:]
+    out[~valid] = np.nan
+    return out
+
+
+def smooth(y, method, var=None, window=12):
+    """smooth applies one of the smoothing filters in this module.
+
+    Parameters
+    ----------
+    y : series or array
+        values to smooth e.g. SM
+    method : str
+        "savgol", "ewma", "wma" (inverse variance weighted moving average) or "kalman"
+    var : series or array, optional
+        variance of each value, needed for "wma" and "kalman"
+    window : int, optional
+        time steps to smooth over (savgol uses the next odd number), by default 12
+
+    Returns
+    -------
+    array
+        smoothed values
+    """
+    if method == "savgol":
+        return savgol_nan(y, window=window + 1 - window % 2)
+    elif method == "ewma":
+        return ewma_nan(y, span=window)
+    elif method in ("wma", "kalman"):
+        if var is None:
+            raise ValueError(method+" smoothing needs the variance of each value")
+        if method == "wma":
+            return weighted_ma(y, var, window=window, min_periods=window // 2)
+        return kalman_smooth(y, var)
+    raise ValueError("method must be 'savgol', 'ewma', 'wma' or 'kalman'")
@@ -6,14 +6,20 @@ Email: daniel.power@bristol.ac.uk
 
 
 """
+import os
 import pandas as pd
 import numpy as np
 import math
 
 # crspy funcs
-from crspy.n0_calibration import (rscaled, D86)
+from crspy.n0_calibration import (rscaled, D86, n0_series)
 from crspy.graphical_functions import colourts
-from crspy.gen_funcs import theta_calc, theta_kohli, checkdata
+from crspy.smoothing import smooth
+from crspy.footprint import footprint_d86
+from crspy.sensitivity import mc_theta, mc_sd, site_params
+from crspy.gen_funcs import (theta_calc, theta_kohli, theta_calc_deriv, theta_kohli_deriv,
+                             read_table, write_table)
+from pandas.tseries.frequencies import to_offset
 """
 To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
 to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
@@ -32,7 +38,295 @@ nld.read('config.ini')
 ## NOTE: theta_calc has been moved to gen_funcs.py
 
 
-def thetaprocess(df, meta, country, sitenum, agg24, yearlysmfig=True, theta_method="desilets", nld=nld):
+def sm_calc(N, Nerr, N0, bd, lw, soc, sm_max, theta_method="desilets", uncertainty="numeric", nld=nld):
+    """sm_calc converts corrected neutron counts into soil moisture along with the error bands.
+    All inputs can be whole columns (series or arrays) so the calculation is done in one
+    pass rather than row by row.
+
+    Soil moisture is constrained to be between 0 and sm_max. As the relationship is inverse
+    N - Nerr gives the positive error and N + Nerr gives the negative error.
+
+    The error can be found by evaluating theta at N - Nerr and N + Nerr ("numeric") or by
+    propagating Nerr with the analytic derivative of the theta function, which only needs
+    theta evaluated once. "linear" uses the first derivative (symmetric error) and "taylor"
+    adds the second derivative so the positive and negative errors differ as they do with
+    "numeric".
+
+    Parameters
+    ----------
+    N : series or array
+        corrected neutron count (MOD_CORR)
+    Nerr : series or array
+        error of the corrected count (MOD_ERR)
+    N0 : int or array
+        N0 number
+    bd : float
+        bulk density e.g. 1.4 g/cm3
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon as water equivalent - decimal percent e.g. 0.02
+    sm_max : float
+        maximum soil moisture (porosity)
+    theta_method : str, optional
+        "desilets" or "kohli" (see gen_funcs), by default "desilets"
+    uncertainty : str, optional
+        "numeric", "linear" or "taylor", by default "numeric"
+    nld : dictionary
+        nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
+        This will store variables such as the wd and other global vars
+
+    Returns
+    -------
+    dict
+        arrays of soil moisture (SM), unconstrained soil moisture (SM_RAW) and the absolute
+        positive/negative errors (SM_PLUS_ERR/SM_MINUS_ERR)
+    """
+    nld=nld['config']
+    if theta_method == "desilets":
+        thetafunc, derivfunc = theta_calc, theta_calc_deriv
+    elif theta_method == "kohli":
+        thetafunc, derivfunc = theta_kohli, theta_kohli_deriv
+    else:
+        raise ValueError("theta_method must be 'desilets' or 'kohli'")
+    a0, a1, a2 = float(nld['a0']), float(nld['a1']), float(nld['a2'])
+    N = np.asarray(N, dtype=float)
+    Nerr = np.asarray(Nerr, dtype=float)
+
+    sm = thetafunc(a0, a1, a2, bd, N, N0, lw, soc)
+    # Find error (inverse relationship so use MOD minus for soil moisture positive Error)
+    if uncertainty == "numeric":
+        sm_plus_err = np.abs(thetafunc(a0, a1, a2, bd, N - Nerr, N0, lw, soc) - sm)
+        sm_minus_err = np.abs(thetafunc(a0, a1, a2, bd, N + Nerr, N0, lw, soc) - sm)
+    elif uncertainty in ("linear", "taylor"):
+        d1, d2 = derivfunc(a0, a1, a2, bd, N, N0)
+        if uncertainty == "taylor":
+            curve = 0.5 * d2 * Nerr * Nerr
+        else:
+            curve = 0
+        sm_plus_err = np.abs(-d1*Nerr + curve)
+        sm_minus_err = np.abs(d1*Nerr + curve)
+    else:
+        raise ValueError("uncertainty must be 'numeric', 'linear' or 'taylor'")
+
+    # Remove values above or below max and min vols
+    return {'SM': np.clip(sm, 0, sm_max),
+            'SM_RAW': sm,
+            'SM_PLUS_ERR': np.clip(sm_plus_err, 0, sm_max),
+            'SM_MINUS_ERR': np.clip(sm_minus_err, 0, sm_max)}
+
+
+def d86_avg(press, sm, bd, hveg=0, radii=(10, 75, 150)):
+    """d86_avg estimates the depth of measurement as the average D86 (Schron et al., 2017) at a
+    selection of radii from the sensor. Inputs can be whole columns.
+
+    Parameters
+    ----------
+    press : series or array
+        pressure (mb)
+    sm : series or array
+        soil moisture (m^3/m^3)
+    bd : float
+        bulk density (g/cm^3)
+    hveg : float, optional
+        height of vegetation (m), by default 0
+    radii : tuple, optional
+        distances from the sensor (m) to average over, by default (10, 75, 150)
+
+    Returns
+    -------
+    array
+        average D86 (cm)
+    """
+    press = np.asarray(press, dtype=float)
+    sm = np.asarray(sm, dtype=float)
+    total = 0
+    for r in radii:
+        total = total + D86(rscaled(r, press, hveg, sm), bd, sm)
+    return total / len(radii)
+
+
+# Aggregation resolutions: resample rule and the file ending of the output table. Windows
+# are labelled by their start time.
+RESOLUTIONS = {"6h": ("6h", "_final_6h.txt"),
+               "daily": ("D", "_final_24agg.txt"),
+               "weekly": ("W-MON", "_final_weekly.txt"),
+               "monthly": ("MS", "_final_monthly.txt")}
+
+
+def aggregate(df, N0, bd, lw, soc, sm_max, resolutions=("daily",), completeness=0, theta_method="desilets",
+              uncertainty="numeric"):
+    """aggregate combines hourly corrected counts into longer windows to reduce the count
+    uncertainty, giving soil moisture with the Poisson error of each window.
+
+    Each resolution is made with one resample pass over the hourly data which gives the
+    sum and the number of valid observations of every column. Counts (and rain) in a window
+    are the mean of the valid hours multiplied by the hours in the window, so a few missing
+    hours don't bias the total, and N0 is scaled by the hours in the window to match (a time
+    varying N0 is averaged over the window first).
+    Windows where the fraction of valid hours of MOD_CORR is below completeness have the
+    count and soil moisture columns removed.
+
+    Parameters
+    ----------
+    df : dataframe
+        hourly dataframe of CRNS data with DT, MOD and MOD_CORR columns
+    N0 : int or array
+        N0 number (hourly), or an N0 for each row of df (see n0_series)
+    bd : float
+        bulk density e.g. 1.4 g/cm3
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon as water equivalent - decimal percent e.g. 0.02
+    sm_max : float
+        maximum soil moisture (porosity)
+    resolutions : iterable, optional
+        any of "6h", "daily", "weekly" or "monthly", by default ("daily",)
+    completeness : float, optional
+        minimum fraction (0-1) of valid hours needed in a window, by default 0 which keeps
+        every window with data
+    theta_method : str, optional
+        "desilets" or "kohli" (see gen_funcs), by default "desilets"
+    uncertainty : str, optional
+        how the count error is carried to soil moisture, see sm_calc, by default "numeric"
+
+    Returns
+    -------
+    dict
+        a dataframe for each resolution
+    """
+    for res in resolutions:
+        if res not in RESOLUTIONS:
+            raise ValueError("resolutions must be from "+", ".join(RESOLUTIONS))
+    hourly = df.set_index(pd.DatetimeIndex(pd.to_datetime(df['DT']), name='DT')).drop(columns='DT')
+    hourly = hourly.select_dtypes("number")
+    if np.ndim(N0) > 0:
+        hourly['N0'] = np.asarray(N0, dtype=float)
+    totals = ['MOD', 'MOD_CORR', 'RAIN']
+    countcols = ['MOD', 'UNMOD', 'MOD_CORR', 'MOD_ERR', 'MOD_CORR_PLUS', 'MOD_CORR_MINUS',
+                 'SM', 'SM_RAW', 'SM_PLUS_ERR', 'SM_MINUS_ERR']
+
+    out = {}
+    for res in resolutions:
+        rule = RESOLUTIONS[res][0]
+        agg = hourly.resample(rule, label='left', closed='left').agg(['sum', 'count'])
+        sums = agg.xs('sum', axis=1, level=1)
+        counts = agg.xs('count', axis=1, level=1)
+        dfagg = sums / counts.where(counts > 0)
+        n0win = dfagg.pop('N0').to_numpy() if 'N0' in dfagg.columns else N0
+
+        # Hours in the full calendar window (months differ in length). Totals are scaled to the full
+        # window, including partial windows at the ends of the record, COMPLETENESS gives how much was observed
+        hours = (dfagg.index + to_offset(rule) - dfagg.index) / pd.Timedelta(hours=1)
+        hours = np.asarray(hours, dtype=float)
+        for col in totals:
+            if col in dfagg.columns:
+                dfagg[col] = dfagg[col] * hours
+
+        # calc err
+        dfagg['MOD_ERR'] = np.floor((np.sqrt(dfagg['MOD'])/dfagg['MOD']) * dfagg['MOD_CORR'])
+        dfagg['MOD_OBS'] = counts['MOD_CORR']
+        dfagg['RAIN_OBS'] = counts['RAIN'] if 'RAIN' in counts.columns else 0
+        dfagg['HOURS'] = hours
+        dfagg['COMPLETENESS'] = dfagg['MOD_OBS'] / hours
+        dfagg['MOD_CORR_PLUS'] = dfagg['MOD_CORR'] + dfagg['MOD_ERR']
+        dfagg['MOD_CORR_MINUS'] = dfagg['MOD_CORR'] - dfagg['MOD_ERR']
+        dfagg = dfagg.assign(**sm_calc(dfagg['MOD_CORR'], dfagg['MOD_ERR'], n0win*hours, bd, lw, soc, sm_max,
+                                       theta_method=theta_method, uncertainty=uncertainty))
+        incomplete = (dfagg['COMPLETENESS'] < completeness) | (dfagg['MOD_OBS'] == 0)
+        dfagg.loc[incomplete, [col for col in countcols if col in dfagg.columns]] = np.nan
+        out[res] = dfagg.round(3).reset_index()
+    return out
+
+
+def adaptive_windows(df, N0, bd, lw, soc, sm_max, target=0.01, max_hours=72, theta_method="desilets",
+                     uncertainty="numeric"):
+    """adaptive_windows splits the record into consecutive windows that are just long enough for
+    the neutron count to reach a target relative (Poisson) error, 1/sqrt(counts). Sites or
+    periods with low count rates get longer windows, high count rates shorter ones. A window
+    is closed at max_hours even if the target has not been reached (TARGET_MET is 0).
+
+    The counts in each window come from cumulative sums and the windows are found with a
+    single two-pointer scan, so the cost is linear in the length of the record.
+
+    Parameters
+    ----------
+    df : dataframe
+        hourly dataframe of CRNS data with DT, MOD and MOD_CORR columns
+    N0 : int or array
+        N0 number (hourly), or an N0 for each row of df (see n0_series) which is averaged
+        over the valid hours of each window
+    bd : float
+        bulk density e.g. 1.4 g/cm3
+    lw : float
+        lattice water - decimal percent e.g. 0.002
+    soc : float
+        soil organic carbon as water equivalent - decimal percent e.g. 0.02
+    sm_max : float
+        maximum soil moisture (porosity)
+    target : float, optional
+        target relative error of the window count e.g. 0.01 for 1%, by default 0.01
+    max_hours : float, optional
+        maximum length of a window in hours, by default 72
+    theta_method : str, optional
+        "desilets" or "kohli" (see gen_funcs), by default "desilets"
+    uncertainty : str, optional
+        how the count error is carried to soil moisture, see sm_calc, by default "numeric"
+
+    Returns
+    -------
+    dataframe
+        a row per window with START, END, MOD_OBS (valid hours), MOD (total count), MOD_CORR
+        and MOD_ERR (hourly rate), REL_ERR, TARGET_MET and SM with its errors
+    """
+    dt = pd.to_datetime(df['DT']).to_numpy()
+    hours = (dt - dt[0]) / np.timedelta64(1, 'h')
+    mod = df['MOD'].to_numpy(dtype=float)
+    modcorr = df['MOD_CORR'].to_numpy(dtype=float)
+    valid = ~np.isnan(mod) & ~np.isnan(modcorr)
+    # Cumulative sums with a leading 0 so the sum of rows i..j is c[j+1] - c[i]
+    cmod = np.concatenate([[0], np.cumsum(np.where(valid, mod, 0))])
+    ccorr = np.concatenate([[0], np.cumsum(np.where(valid, modcorr, 0))])
+    cvalid = np.concatenate([[0], np.cumsum(valid)])
+    needed = 1 / target**2
+
+    starts = []
+    ends = []
+    n = len(df)
+    i = 0
+    while i < n:
+        if not valid[i]:
+            i += 1
+            continue
+        j = i
+        while cmod[j+1] - cmod[i] < needed and j+1 < n and hours[j+1] - hours[i] < max_hours:
+            j += 1
+        starts.append(i)
+        ends.append(j)
+        i = j + 1
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+
+    total = cmod[ends+1] - cmod[starts]
+    nobs = cvalid[ends+1] - cvalid[starts]
+    relerr = 1 / np.sqrt(total)
+    # Hourly rate so N0 doesn't need scaling
+    N = (ccorr[ends+1] - ccorr[starts]) / nobs
+    if np.ndim(N0) > 0:
+        cn0 = np.concatenate([[0], np.cumsum(np.where(valid, np.asarray(N0, dtype=float), 0))])
+        N0 = (cn0[ends+1] - cn0[starts]) / nobs
+    dfad = pd.DataFrame({'MOD_OBS': nobs, 'MOD': total, 'MOD_CORR': N, 'MOD_ERR': N * relerr,
+                         'REL_ERR': relerr, 'TARGET_MET': (relerr <= target).astype(int)})
+    dfad = dfad.assign(**sm_calc(dfad['MOD_CORR'], dfad['MOD_ERR'], N0, bd, lw, soc, sm_max,
+                                 theta_method=theta_method, uncertainty=uncertainty))
+    dfad = dfad.round(3)
+    dfad.insert(0, 'START', dt[starts])
+    dfad.insert(1, 'END', dt[ends])
+    return dfad
+
+
+def thetaprocess(df, meta, country, sitenum, agg24, yearlysmfig=True, theta_method="desilets", inmemory=False, savefile=True, aggregations=(), completeness=0, uncertainty="numeric", smoothing=None, adaptive=None, footprint=False, montecarlo=None, n0_mode="constant", nld=nld):
     """thetaprocess takes the dataframe provided by previous steps and uses the theta calculations
     to give an estimate of soil moisture. 
 
@@ -59,10 +353,42 @@ def thetaprocess(df, meta, country, sitenum, agg24, yearlysmfig=True, theta_meth
     sitenum : str  
         sitenum e.g. "011"
     agg24 : bool
-        input from full process wrapper on whether to calc agg24 vals 
-        TODO: consider whether this needs to be done earlier in process
+        input from full process wrapper on whether to calc agg24 vals (same as adding "daily" to aggregations)
     yearlysmfig : bool, optional
         whether to output yearly figures when creating time series, by default True
+    theta_method : str, optional
+        standard method is "desilets", with option to use "kohli" (see gen_funcs - theta_kohli). Used for the
+        hourly and the aggregated (including agg24) soil moisture
+    inmemory : bool, optional
+        use the df passed in rather than re-reading the final table from the working directory, by default False
+    savefile : bool, optional
+        write the final (and aggregated) tables to the working directory, by default True
+    aggregations : iterable, optional
+        extra resolutions to aggregate to, any of "6h", "daily", "weekly" or "monthly" (see aggregate).
+        Each is written to its own final table e.g. _final_weekly.txt, by default ()
+    completeness : float, optional
+        minimum fraction (0-1) of valid hours needed in an aggregation window, by default 0
+    uncertainty : str, optional
+        how the count error is carried to soil moisture: "numeric" evaluates theta at MOD_CORR +/- MOD_ERR,
+        "linear" or "taylor" propagate it with the analytic derivative (see sm_calc), by default "numeric"
+    smoothing : str, optional
+        also smooth SM with a nan aware filter over the smwindow, written as SM_SMOOTH. One of "savgol",
+        "ewma", "wma" or "kalman" (see smoothing.smooth), by default None
+    adaptive : float, optional
+        target relative count error (e.g. 0.01) for adaptive length windows (see adaptive_windows),
+        written to _final_adaptive.txt, by default None
+    footprint : bool, optional
+        also give the depth of measurement as D86 weighted over the whole footprint for each hour's
+        pressure, humidity and SM (D86_FOOTPRINT, see footprint.footprint_d86), by default False
+    montecarlo : int, optional
+        number of Monte Carlo members for SM uncertainty from the counts and the metadata uncertainty of
+        N0, BD, LW and SOC (see sensitivity.mc_theta). The 5th, 50th and 95th percentiles for each hour are
+        written to _final_mc.txt, by default None
+    n0_mode : str, optional
+        "constant" uses the N0 in the metadata. "campaign", "interp" or "linear" use an N0 for each hour
+        from the N0 of each calibration day (written by n0_calib, see n0_series) to follow drift in the
+        sensor, also written as an N0 column. If the site has no N0 for each day yet the constant N0 is used
+        (with a warning). By default "constant"
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -73,26 +399,12 @@ def thetaprocess(df, meta, country, sitenum, agg24, yearlysmfig=True, theta_meth
     #                       Constants                                             #
     ###############################################################################
     print("Read in constants...")
-    lw = meta.loc[(meta.COUNTRY == country) & (
-        meta.SITENUM == sitenum), 'LW'].item()
-    lw = float(lw)
     soc = meta.loc[(meta.COUNTRY == country) & (
         meta.SITENUM == sitenum), 'SOC'].item()
     soc = float(soc)
-    try:
-        bd = meta.loc[(meta.COUNTRY == country) & (
-            meta.SITENUM == sitenum), 'BD'].item()
-        bd = float(bd)
-        if math.isnan(bd):
-            print("BD is nan value, using ISRIC data instead.")
-            bd = meta.loc[(meta.COUNTRY == country) & (
-                meta.SITENUM == sitenum), 'BD_ISRIC'].item()
-            bd = float(bd)
-    except:
-        print("Couldn't find local bulk density data, using ISRIC data instead.")
-        bd = meta.loc[(meta.COUNTRY == country) & (
-            meta.SITENUM == sitenum), 'BD_ISRIC'].item()
-        bd = float(bd)
+    # BD falls back to BD_ISRIC, BD and LW fitted together with N0 (n0_calib with fit) take priority
+    params = site_params(meta, country, sitenum)
+    bd, lw = params['bd'], params['lw']
     print("BD is "+str(bd))
     N0 = meta.loc[(meta.COUNTRY == country) & (
         meta.SITENUM == sitenum), 'N0'].item()
@@ -111,61 +423,33 @@ def thetaprocess(df, meta, country, sitenum, agg24, yearlysmfig=True, theta_meth
     # convert SOC to water equivelant (see Hawdon et al., 2014)
     soc = soc * 0.556
     hveg = 0  # Set to 0 to remove as data avilability low and impact low
-    sm_min = 0  # Cannot have less than zero
     print("Done")
     ###############################################################################
     #                       Import Data                                           #
     ###############################################################################
     print("Calculating soil moisture along with estimated error...")
-    df = pd.read_csv(nld['defaultdir']+"/data/crns_data/final/" +
-                     country+"_SITE_"+sitenum+"_final.txt", sep="\t")
-    df = df.replace(int(nld['noval']), np.nan)
-
-    # Create MOD count to min and max of error
-    df['MOD_CORR_PLUS'] = df['MOD_CORR'] + df['MOD_ERR']
-    df['MOD_CORR_MINUS'] = df['MOD_CORR'] - df['MOD_ERR']
-    
-    if theta_method == "desilets":
-        # Calculate soil moisture - including min and max error
-        df['SM'] = df.apply(lambda row: theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR'], N0, lw,
-                                                soc), axis=1)
-        df['SM'] = df['SM']
-        df['SM_RAW'] = df['SM']
-
-        df['SM_PLUS_ERR'] = df.apply(lambda row: theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR_MINUS'], N0, lw,
-                                                            soc), axis=1)  # Find error (inverse relationship so use MOD minus for soil moisture positive Error)
-        df['SM_PLUS_ERR'] = df['SM_PLUS_ERR']
-        df['SM_PLUS_ERR'] = abs(df['SM_PLUS_ERR'] - df['SM'])
-
-        df['SM_MINUS_ERR'] = df.apply(lambda row: theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR_PLUS'], N0, lw,
-                                                            soc), axis=1)
-        df['SM_MINUS_ERR'] = df['SM_MINUS_ERR']
-        df['SM_MINUS_ERR'] = abs(df['SM_MINUS_ERR'] - df['SM'])
-    elif theta_method == "kohli":
-        df['SM'] = df.apply(lambda row: theta_kohli(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR'], N0, lw,
-                                                soc), axis=1)
-        df['SM'] = df['SM']
-        df['SM_RAW'] = df['SM']
-
-        df['SM_PLUS_ERR'] = df.apply(lambda row: theta_kohli(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR_MINUS'], N0, lw,
-                                                            soc), axis=1)  # Find error (inverse relationship so use MOD minus for soil moisture positive Error)
-        df['SM_PLUS_ERR'] = df['SM_PLUS_ERR']
-        df['SM_PLUS_ERR'] = abs(df['SM_PLUS_ERR'] - df['SM'])
-
-        df['SM_MINUS_ERR'] = df.apply(lambda row: theta_kohli(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR_PLUS'], N0, lw,
-                                                            soc), axis=1)
-        df['SM_MINUS_ERR'] = df['SM_MINUS_ERR']
-        df['SM_MINUS_ERR'] = abs(df['SM_MINUS_ERR'] - df['SM'])        
-    
-    # Remove values above or below max and min vols
-    df.loc[df['SM'] < sm_min, 'SM'] = 0
-    df.loc[df['SM'] > sm_max, 'SM'] = sm_max
-
-    df.loc[df['SM_PLUS_ERR'] < sm_min, 'SM_PLUS_ERR'] = 0
-    df.loc[df['SM_PLUS_ERR'] > sm_max, 'SM_PLUS_ERR'] = sm_max
-
-    df.loc[df['SM_MINUS_ERR'] < sm_min, 'SM_MINUS_ERR'] = 0
-    df.loc[df['SM_MINUS_ERR'] > sm_max, 'SM_MINUS_ERR'] = sm_max
+    if inmemory == False:
+        df = read_table(nld['defaultdir']+"/data/crns_data/final/" +
+                        country+"_SITE_"+sitenum+"_final.txt")
+    else:
+        # Same layout as the table read from file (a DT column and a plain index)
+        df = df.reset_index(drop=True)
+    dfin = df  # keep the input table for the aggregations
+    campaignfile = (nld['defaultdir']+"/data/n0_calibration/"+country+"_"+str(sitenum)+"/" +
+                    country+"_SITE_"+sitenum+"_N0_campaigns.csv")
+    if n0_mode != "constant" and not os.path.exists(campaignfile):
+        # e.g. calibrate=False for a site calibrated before the N0 of each day was kept
+        print("WARNING: no N0 for each calibration day ("+campaignfile+"), run n0_calib for this site to use "
+              "n0_mode=\""+n0_mode+"\". Using the constant N0 from the metadata instead.")
+        n0_mode = "constant"
+    if n0_mode != "constant":
+        print("Using an N0 for each hour from the calibration days ("+n0_mode+")")
+        campaigns = pd.read_csv(campaignfile, dtype={'DATE': str})
+        N0 = n0_series(df['DT'], campaigns, mode=n0_mode)
+        df = df.assign(N0=N0)
+
+    df = df.assign(**sm_calc(df['MOD_CORR'], df['MOD_ERR'], N0, bd, lw, soc, sm_max,
+                             theta_method=theta_method, uncertainty=uncertainty))
     print("Done")
 
     #df['SM_ERROR'] = (df['SM_PLUS_ERR'] - df['SM_MINUS_ERR'])/2
@@ -174,93 +458,53 @@ def thetaprocess(df, meta, country, sitenum, agg24, yearlysmfig=True, theta_meth
     print("Averaging and writing table...")
     df['SM_12h'] = df['SM'].rolling(int(nld['smwindow']), min_periods=6).mean()
 
-    #!!! df['SM_12h_SG'] = savgol_filter(df['SM'], 13, 4)#Cannot be used on data with nan values - consider another method?
+    if smoothing is not None:
+        # Variance of SM from the mean of the positive and negative errors
+        smvar = ((df['SM_PLUS_ERR'] + df['SM_MINUS_ERR'])/2)**2
+        df['SM_SMOOTH'] = smooth(df['SM'], smoothing, var=smvar, window=int(nld['smwindow']))
 
     # Depth calcs - use new Schron style. Depth is given considering radius and bd
-    df['rs10m'] = df.apply(lambda row: rscaled(
-        10, row['PRESS'], hveg, (row['SM'])), axis=1)
-    df['rs75m'] = df.apply(lambda row: rscaled(
-        75, row['PRESS'], hveg, (row['SM'])), axis=1)
-    df['rs150m'] = df.apply(lambda row: rscaled(
-        150, row['PRESS'], hveg, (row['SM'])), axis=1)
-
-    df['D86_10m'] = df.apply(lambda row: D86(
-        row['rs10m'], bd, (row['SM'])), axis=1)
-    df['D86_75m'] = df.apply(lambda row: D86(
-        row['rs75m'], bd, (row['SM'])), axis=1)
-    df['D86_150m'] = df.apply(lambda row: D86(
-        row['rs150m'], bd, (row['SM'])), axis=1)
-    df['D86avg'] = (df['D86_10m'] + df['D86_75m'] + df['D86_150m']) / 3
+    df['D86avg'] = d86_avg(df['PRESS'], df['SM'], bd, hveg)
     df['D86avg_12h'] = df['D86avg'].rolling(window=int(nld['smwindow']), min_periods=6).mean()
+    if footprint is True:
+        df['D86_FOOTPRINT'] = footprint_d86(df['PRESS'], df['pv'], df['SM'], bd)
+
+
+    # agg24 uses theta_method like the hourly data (it used to always use Desilets)
+    if agg24 == True and "daily" not in aggregations:
+        aggregations = ["daily"] + list(aggregations)
+    if aggregations:
+        print("Aggregating to "+", ".join(aggregations)+"...")
+        dfagg = aggregate(dfin, N0, bd, lw, soc, sm_max, resolutions=aggregations,
+                          completeness=completeness, theta_method=theta_method,
+                          uncertainty=uncertainty)
+        if savefile:
+            for res, table in dfagg.items():
+                write_table(table, nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+RESOLUTIONS[res][1])
+
+    if adaptive is not None:
+        print("Aggregating to windows with "+str(adaptive*100)+"% count error...")
+        dfad = adaptive_windows(dfin, N0, bd, lw, soc, sm_max, target=adaptive, theta_method=theta_method,
+                                uncertainty=uncertainty)
+        if savefile:
+            write_table(dfad, nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final_adaptive.txt")
+
+    if montecarlo is not None:
+        print("Monte Carlo SM uncertainty with "+str(montecarlo)+" members...")
+        dfmc = mc_theta(dfin['MOD'], dfin['MOD_CORR'], {'N0': N0, 'bd': bd, 'lw': lw, 'soc': soc},
+                        mc_sd(meta, country, sitenum), nmembers=montecarlo, theta_method=theta_method,
+                        sm_max=sm_max)
+        dfmc.insert(0, 'DT', dfin['DT'].to_numpy())
+        dfmc = dfmc.round(3)
+        if savefile:
+            write_table(dfmc, nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final_mc.txt")
 
-
-    if agg24 == True:
-        #read in data
-        df24 = pd.read_csv(nld['defaultdir']+"/data/crns_data/final/" +
-                     country+"_SITE_"+sitenum+"_final.txt", sep="\t")
-        df24 = df24.replace(int(nld['noval']), np.nan)
-            # Error is the ((standard deviation) / MOD)*MODCORR
-        df24['DT'] = pd.to_datetime(df24['DT'])
-        df24 = df24.set_index(df24['DT'])
-
-        #mean sample rest
-        # Missing obs will affect avg - take avg and multiply by 24 hours.
-        # Create a measure of missing vals
-        df24['MOD_OBS_IN_DAY'] = df24.apply(lambda row: checkdata(row['MOD']),axis=1)
-        df24['RAIN_OBS_IN_DAY'] = df24.apply(lambda row: checkdata(row['RAIN']),axis=1)
-        df24 = df24.resample('D').mean()
-        df24['MOD'] = df24['MOD']*24
-        df24['MOD_CORR'] = df24['MOD_CORR']*24
-        df24['RAIN'] = df24['RAIN']*24
-
-        #calc err
-        df24['MOD_ERR'] = (np.sqrt(df24['MOD'])/df24['MOD']) * df24['MOD_CORR']
-        df24['MOD_ERR'] = df24['MOD_ERR'].apply(np.floor)
-        df24['MOD_CORR_PLUS'] = df24['MOD_CORR'] + df24['MOD_ERR']
-        df24['MOD_CORR_MINUS'] = df24['MOD_CORR'] - df24['MOD_ERR']
-
-        df24['SM'] = df24.apply(lambda row: theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR'], N0*24, lw,
-                                                soc), axis=1)
-        df24['SM'] = df24['SM']
-        df24['SM_RAW'] = df24['SM']
-
-        df24['SM_PLUS_ERR'] = df24.apply(lambda row: theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR_MINUS'], N0*24, lw,
-                                                            soc), axis=1)  # Find error (inverse relationship so use MOD minus for soil moisture positive Error)
-        df24['SM_PLUS_ERR'] = df24['SM_PLUS_ERR']
-        df24['SM_PLUS_ERR'] = abs(df24['SM_PLUS_ERR'] - df24['SM'])
-
-        df24['SM_MINUS_ERR'] = df24.apply(lambda row: theta_calc(float(nld['a0']), float(nld['a1']), float(nld['a2']), bd, row['MOD_CORR_PLUS'], N0*24, lw,
-                                                            soc), axis=1)
-        df24['SM_MINUS_ERR'] = df24['SM_MINUS_ERR']
-        df24['SM_MINUS_ERR'] = abs(df24['SM_MINUS_ERR'] - df24['SM'])
-
-        df24.loc[df24['SM'] < sm_min, 'SM'] = 0
-        df24.loc[df24['SM'] > sm_max, 'SM'] = sm_max
-
-        df24.loc[df24['SM_PLUS_ERR'] < sm_min, 'SM_PLUS_ERR'] = 0
-        df24.loc[df24['SM_PLUS_ERR'] > sm_max, 'SM_PLUS_ERR'] = sm_max
-
-        df24.loc[df24['SM_MINUS_ERR'] < sm_min, 'SM_MINUS_ERR'] = 0
-        df24.loc[df24['SM_MINUS_ERR'] > sm_max, 'SM_MINUS_ERR'] = sm_max
-
-        df24.fillna(int(nld['noval']), inplace=True)
-        df24 = df24.round(3)
-        df24 = df24.reset_index()
-        df24.to_csv(nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final_24agg.txt",
-              header=True, index=False, sep="\t", mode="w") 
-
-    # Replace nans with -999
-    df.fillna(int(nld['noval']), inplace=True)
     df = df.round(3)
-    df = df.drop(['rs10m', 'rs75m', 'rs150m', 'D86_10m',
-                  'D86_75m', 'D86_150m', 'MOD_CORR_PLUS', 'MOD_CORR_MINUS'], axis=1)  # ,
-    #     'MOD_CORR_PLUS', 'MOD_CORR_MINUS', 'SM_PLUS_ERR', 'SM_MINUS_ERR'], axis=1)
-
-    df.to_csv(nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final.txt",
-              header=True, index=False, sep="\t", mode="w")
+    if savefile:
+        write_table(df, nld['defaultdir'] + "/data/crns_data/final/"+country+"_SITE_"+sitenum+"_final.txt")
 
     # Add the graphical function to output timeseries
-    colourts(country, sitenum, yearlysmfig)
+    colourts(country, sitenum, yearlysmfig, df=df)
 
     print("Done")
     return df
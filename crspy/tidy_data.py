@@ -12,7 +12,6 @@ counts based on Pressure, Water Humidity, Solar Intensity and Above Ground Bioma
 """
 
 import pylab
-import xarray as xr
 import datetime
 import re
 import numpy as np
@@ -21,6 +20,8 @@ pylab.show()
 
 from crspy.neutron_correction_funcs import (es, ea, dew2vap)
 from crspy.additional_metadata import nmdb_get
+from crspy.gen_funcs import write_table, write_metadata
+from crspy.era5_land import era5_site
 """
 To stop import issue with the config file when importing crspy in a wd without a config.ini file in it we need
 to read in the config file below and add `nld=nld['config']` into each function that requires the nld variables.
@@ -35,7 +36,7 @@ nld.read('config.ini')
 
 
 def dropemptycols(colstocheck, df, nld=nld):
-    """dropemptycols drop any columns that are empty (i.e. all -999)
+    """dropemptycols drop any columns that are empty (i.e. all -999 in the raw data, read as nan)
 
     Parameters
     ----------
@@ -50,7 +51,7 @@ def dropemptycols(colstocheck, df, nld=nld):
         col = colstocheck[i]
         if col in df:
             try:
-                if df[col].mean() == int(nld['noval']):
+                if df[col].isna().all():
                     df = df.drop([col], axis=1)
                 else:
                     pass
@@ -61,7 +62,7 @@ def dropemptycols(colstocheck, df, nld=nld):
     return df
 
 
-def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
+def prepare_data(fileloc, useeradata, intentype=None, savefile=True, nld=nld):
     """prepare_data provided with the location of the raw data it will prepare the data.
 
     Steps include: 
@@ -79,6 +80,9 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
         input from full_process_wrapper on whether to use era5 land data or skip
     intentype : str, optional
         can be set to nearestGV if using the alternative method, by default None
+    savefile : bool, optional
+        write the dupe check and tidy tables to the working directory, by default True. Can be
+        turned off when the tidy data is passed on in memory (see full_process_wrapper)
     nld : dictionary
         nld should be defined in the main script (from name_list import nld), this will be the name_list.py dictionary. 
         This will store variables such as the wd and other global vars
@@ -114,9 +118,10 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
 
     sitecode = country+"_SITE_"+sitenum  # create full title for use on ERA5Land data
 
-    # Read in files and sort time and date columns
+    # Read in files and sort time and date columns. Missing values (noval) are read as nan
+    # and only written back out as noval when tables are saved.
     df = pd.read_csv(nld['defaultdir'] + "/data/crns_data/raw/" +
-                     country+"_SITE_" + sitenum+".txt", sep="\t")
+                     country+"_SITE_" + sitenum+".txt", sep="\t", na_values=[int(nld['noval'])])
 
     # # Introduce a converter for the CosmOz style when using AUS data:
     # if country == "AUS":
@@ -194,8 +199,8 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
     df['dupes'] = df.duplicated(subset="DT")
     # Add a save for dupes here - need to test a selection of sites to see
     # whether dupes are the same.
-    df.to_csv(nld['defaultdir'] + "/data/crns_data/dupe_check/"+country+"_SITE_" + sitenum+"_DUPES.txt",
-              header=True, index=False, sep="\t",  mode='w')
+    if savefile:
+        write_table(df, nld['defaultdir'] + "/data/crns_data/dupe_check/"+country+"_SITE_" + sitenum+"_DUPES.txt")
     df = df.drop(df[df.dupes == True].index)
     df = df.set_index(df.DT)
     if df.DATE.iloc[0] > df.DATE.iloc[-1]:
@@ -205,7 +210,6 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
     idx = pd.date_range(
         df.DATE.iloc[0], df.DATE.iloc[-1], freq='1H', closed='left')
     df = df.reindex(idx, fill_value=np.nan)
-    df = df.replace(np.nan, int(nld['noval'])) # add replace to make checks on whole cols later
 
     df['DT'] = df.index
     print("Done")
@@ -226,13 +230,12 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
         # Read in the time zone of the site
         print("Collecting ERA-5 Land variables...")
         try:
-            era5 = xr.open_dataset(
-                nld['defaultdir']+"/data/era5land/"+nld['era5_filename']+".nc")
+            # Only this site's variables over the span of the data (and the hour before for the rain)
+            era5site = era5_site(nld['defaultdir']+"/data/era5land/"+nld['era5_filename']+".nc", sitecode,
+                                 variables=['temperature', 'dewpoint_temperature', 'pressure',
+                                            'snow_water_equiv', 'precipitation'],
+                                 start=df['DT'].min() - pd.Timedelta(hours=1), end=df['DT'].max())
             print('Read in file')
-            try:
-                era5site = era5.sel(site=sitecode)
-            except:
-                era5site = era5  # If user only has one site it breaks here - this stops that
 
             era5time = pd.to_datetime(era5site.time.values)
 
@@ -276,11 +279,7 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
             df['ERA5L_PRESS'] = df['DT'].map(press_dict)
 
             # PRESS2 is more accurate pressure gauge - use if available and if not fill in with PRESS1
-            press_series = df['PRESS2']
-            df['PRESS'] = df['PRESS2']
-            
-            df.loc[df['PRESS'] == int(nld['noval']), 'PRESS'] = df['PRESS1']
-            df = df.replace(int(nld['noval']), np.nan)
+            df['PRESS'] = df['PRESS2'].fillna(df['PRESS1'])
 
             if rh == False:
                 df['VP'] = df.apply(lambda row: dew2vap(
@@ -296,9 +295,7 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
         except:
             print("An error occured in ERA5-Land data writing. Attempting to use local data.")
             # Introduced this bit to allow using sites that don't need ERA5_Land
-            df['PRESS'] = df['PRESS2']
-            df.loc[df['PRESS'] == int(nld['noval']), 'PRESS'] = df['PRESS1']  # !!!added
-            df = df.replace(int(nld['noval']), np.nan)
+            df['PRESS'] = df['PRESS2'].fillna(df['PRESS1'])  # !!!added
 
             df['TEMP'] = df['E_TEM']
 
@@ -309,9 +306,7 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
             print("Cannot load era5_land data. Please download data as it is needed.")
     
     elif useeradata == False:
-            df['PRESS'] = df['PRESS2']
-            df.loc[df['PRESS'] == int(nld['noval']), 'PRESS'] = df['PRESS1']  # !!!added
-            df = df.replace(int(nld['noval']), np.nan)
+            df['PRESS'] = df['PRESS2'].fillna(df['PRESS1'])  # !!!added
 
             df['TEMP'] = df['E_TEM']
 
@@ -335,7 +330,7 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
         key, value = min(nmdblist.items(), key=lambda x: abs(sitegv - x[1]))
         print("Getting NMDB data from "+str(key))
         nmdbdict = nmdb_get(startdate, enddate, station=str(key))
-        df['NMDB_COUNT'] = int(nld['noval'])  # make sure its empty
+        df['NMDB_COUNT'] = np.nan  # make sure its empty
         df['NMDB_COUNT'] = df['DT'].map(nmdbdict)
         # Keep as Jung Count to save changing scripts
         df['NMDB_COUNT'] = df['NMDB_COUNT'].astype(float)
@@ -346,7 +341,7 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
         try:
             print("NMDB data from: "+str(startdate)+" to "+str(enddate))
             nmdbdict = nmdb_get(startdate, enddate)
-            df['NMDB_COUNT'] = int(nld['noval']) # make sure its empty
+            df['NMDB_COUNT'] = np.nan # make sure its empty
             df['NMDB_COUNT'] = df['DT'].map(nmdbdict)
             df['NMDB_COUNT'] = df['NMDB_COUNT'].astype(float)
             print("Done")
@@ -383,19 +378,19 @@ def prepare_data(fileloc, useeradata, intentype=None, nld=nld):
         df.drop(labels=['fsol'], axis=1, inplace=True)
     except:
         pass
-    # Add list of columns that some sites wont have data on - removes them if empty
-    df = dropemptycols(df.columns.tolist(), df)
+    # Add list of columns that some sites wont have data on - removes them if empty. Columns the
+    # later stages need are kept even when empty (e.g. DEWPOINT_TEMP without ERA5-Land data)
+    needed = ['DT', 'MOD', 'PRESS', 'TEMP', 'RAIN', 'VP', 'DEWPOINT_TEMP', 'SWE', 'NMDB_COUNT', 'BATT']
+    df = dropemptycols([col for col in df.columns if col not in needed], df)
     df = df.round(3)
-    df = df.replace(np.nan, int(nld['noval']))
     # SD card data had some 0 values - should be nan
-    df['MOD'] = df['MOD'].replace(0, int(nld['noval']))
+    df.loc[df['MOD'] == 0, 'MOD'] = np.nan
     # Change Order
 
-    meta.to_csv(nld['defaultdir'] + "/data/metadata.csv",
-                header=True, index=False, mode='w')
+    write_metadata(meta, country, sitenum)
     # Save Tidy data
-    df.to_csv(nld['defaultdir'] + "/data/crns_data/tidy/"+country+"_SITE_" + sitenum+"_TIDY.txt",
-              header=True, index=False, sep="\t",  mode='w')
+    if savefile:
+        write_table(df, nld['defaultdir'] + "/data/crns_data/tidy/"+country+"_SITE_" + sitenum+"_TIDY.txt")
     print("Done")
     if intentype != None:
         return df, country, sitenum, meta, nmdbstation